@@ -0,0 +1,266 @@
+﻿using System;
+using System.Collections.Generic;
+using System.Linq;
+using System.Net;
+using System.Net.Sockets;
+using System.Text;
+using System.Threading;
+
+namespace Load_Balancer_Server
+{
+    /// <summary>
+    /// The ways in which a stream on a framed connection can end.
+    /// </summary>
+    enum FramedStreamResult
+    {
+        // The whole response was passed to the client
+        Completed,
+        // The agent couldn't serve the request
+        Reset,
+        // The connection to the agent broke before the response ended
+        ConnectionFailed
+    }
+
+    /// <summary>
+    /// A long-lived connection to a proxy agent in the framed protocol (see proxy_protocol.py in the Web Server).
+    /// Many requests are sent on it at the same time, each one on its own stream,
+    /// and the frames of their responses are passed to the clients as they arrive.
+    /// </summary>
+    class FramedAgentConnection
+    {
+        // The preface that opens the connection: 6 zero bytes and the name of the protocol
+        private static readonly byte[] FRAME_PREFACE = new byte[6].Concat(Encoding.ASCII.GetBytes("PROXY-FRAMED/1\r\n")).ToArray();
+        private const byte PROTOCOL_VERSION = 1;
+        // |-VERSION-|-FLAGS-|-STREAM ID-|---ENDPOINT---|-LENGTH-| (the numbers are big-endian)
+        private const int FRAME_HEADER_SIZE = 16;
+        private const int ENDPOINT_OFFSET = 6;
+        private const int ENDPOINT_LENGTH = 6;
+        private const int LENGTH_OFFSET = 12;
+        // The maximum length of the payload of a single frame
+        private const int MAX_FRAME_PAYLOAD = 64 * 1024;
+        // The flags of a frame
+        private const byte FLAG_END_STREAM = 0x01;
+        private const byte FLAG_RESET = 0x02;
+
+        /// <summary>
+        /// A request that was sent on the connection, and whose response didn't end yet.
+        /// </summary>
+        private class PendingStream
+        {
+            public ProxyMessage Request;
+            public Action<FramedStreamResult, bool> OnEnd;
+            // Whether any part of the response was passed to the client
+            public bool ResponseStarted;
+        }
+
+        private readonly Socket _socket;
+        private readonly object _sendLock = new object();
+        private readonly Dictionary<uint, PendingStream> _streams = new Dictionary<uint, PendingStream>();
+        private uint _nextStreamId = 1;
+
+        /// <summary>
+        /// Whether the connection is closed (a new one should be opened for the next requests).
+        /// </summary>
+        public bool Closed { get; private set; }
+
+        /// <summary>
+        /// Whether a frame was received on the connection, which means that the agent knows the framed protocol.
+        /// </summary>
+        public bool Confirmed { get; private set; }
+
+        /// <summary>
+        /// Connects to the given agent and starts receiving the frames of the responses.
+        /// </summary>
+        /// <param name="agentEP">The endpoint of the proxy agent.</param>
+        public FramedAgentConnection(IPEndPoint agentEP)
+        {
+            _socket = new Socket(SocketType.Stream, ProtocolType.Tcp);
+            try
+            {
+                _socket.Connect(agentEP);
+                _socket.Send(FRAME_PREFACE);
+            }
+            catch
+            {
+                _socket.Dispose();
+                throw new Exception("Connection to server failed.");
+            }
+
+            Thread receivingThread = new Thread(ReceiveFrames);
+            receivingThread.IsBackground = true;
+            receivingThread.Start();
+        }
+
+        /// <summary>
+        /// Sends the given client message on a new stream.
+        /// </summary>
+        /// <param name="request">The message of the client, its response is passed to the client's socket.</param>
+        /// <param name="onEnd">Called with the result of the stream, and with whether any part of the response was passed to the client.</param>
+        public void SendRequest(ProxyMessage request, Action<FramedStreamResult, bool> onEnd)
+        {
+            byte[] endpointBytes = ProxyServer.GetEndpointBytes(request.ClientEndpoint);
+
+            lock (_sendLock)
+            {
+                if (Closed)
+                    throw new Exception("The framed connection is closed.");
+
+                uint streamId = _nextStreamId;
+                _nextStreamId += 2;
+                lock (_streams)
+                {
+                    _streams[streamId] = new PendingStream { Request = request, OnEnd = onEnd };
+                }
+
+                try
+                {
+                    // The request is sent in frames, and the last one ends the stream
+                    int offset = 0;
+                    do
+                    {
+                        int length = Math.Min(request.Content.Length - offset, MAX_FRAME_PAYLOAD);
+                        bool last = offset + length == request.Content.Length;
+                        byte[] header = BuildFrameHeader(streamId, endpointBytes, last ? FLAG_END_STREAM : (byte)0, length);
+                        _socket.Send(new List<ArraySegment<byte>>
+                        {
+                            new ArraySegment<byte>(header),
+                            new ArraySegment<byte>(request.Content, offset, length)
+                        });
+                        offset += length;
+                    } while (offset < request.Content.Length);
+                }
+                catch
+                {
+                    // The caller handles the failure of this stream
+                    lock (_streams)
+                    {
+                        _streams.Remove(streamId);
+                    }
+
+                    // A partly sent frame breaks the whole connection,
+                    // its other streams are failed by the receiving thread
+                    Closed = true;
+                    _socket.Shutdown(SocketShutdown.Both);
+                    throw new Exception("Sending to server failed.");
+                }
+            }
+        }
+
+        /// <summary>
+        /// Receives frames until the connection closes, and passes their payloads to the clients of their streams.
+        /// </summary>
+        private void ReceiveFrames()
+        {
+            try
+            {
+                byte[] header = new byte[FRAME_HEADER_SIZE];
+                while (ReceiveExactly(header, FRAME_HEADER_SIZE))
+                {
+                    if (header[0] != PROTOCOL_VERSION)
+                        throw new Exception("Unsupported version of the framed protocol.");
+                    byte flags = header[1];
+                    uint streamId = (uint)ReadBigEndian(header, 2);
+                    int length = ReadBigEndian(header, LENGTH_OFFSET);
+                    if (length < 0 || length > MAX_FRAME_PAYLOAD)
+                        throw new Exception("The frame's payload is too large.");
+
+                    byte[] payload = new byte[length];
+                    if (!ReceiveExactly(payload, length))
+                        break;
+                    Confirmed = true;
+
+                    PendingStream stream;
+                    lock (_streams)
+                    {
+                        // The frames of a stream that already ended are ignored
+                        if (!_streams.TryGetValue(streamId, out stream))
+                            continue;
+                        if ((flags & (FLAG_END_STREAM | FLAG_RESET)) != 0)
+                            _streams.Remove(streamId);
+                    }
+
+                    if ((flags & FLAG_RESET) != 0)
+                    {
+                        stream.OnEnd(FramedStreamResult.Reset, stream.ResponseStarted);
+                        continue;
+                    }
+
+                    if (length > 0)
+                    {
+                        try
+                        {
+                            stream.Request.Socket.Send(payload);
+                            stream.ResponseStarted = true;
+                        }
+                        catch
+                        {
+                            // The client is gone, the rest of the response is received and ignored
+                        }
+                    }
+
+                    if ((flags & FLAG_END_STREAM) != 0)
+                        stream.OnEnd(FramedStreamResult.Completed, stream.ResponseStarted);
+                }
+            }
+            catch
+            {
+                // The connection is broken, the streams that didn't end are failed below
+            }
+
+            PendingStream[] failedStreams;
+            lock (_sendLock)
+            {
+                Closed = true;
+                _socket.Dispose();
+                lock (_streams)
+                {
+                    failedStreams = _streams.Values.ToArray();
+                    _streams.Clear();
+                }
+            }
+            foreach (var stream in failedStreams)
+                stream.OnEnd(FramedStreamResult.ConnectionFailed, stream.ResponseStarted);
+        }
+
+        /// <summary>
+        /// Receives exactly the given amount of bytes into the buffer.
+        /// </summary>
+        /// <returns>False if the connection was closed before they were received.</returns>
+        private bool ReceiveExactly(byte[] buffer, int count)
+        {
+            int received = 0;
+            while (received < count)
+            {
+                int size = _socket.Receive(buffer, received, count - received, SocketFlags.None);
+                if (size == 0)
+                    return false;
+                received += size;
+            }
+            return true;
+        }
+
+        /// <summary>
+        /// Builds the header of a frame.
+        /// </summary>
+        private static byte[] BuildFrameHeader(uint streamId, byte[] endpointBytes, byte flags, int length)
+        {
+            byte[] header = new byte[FRAME_HEADER_SIZE];
+            header[0] = PROTOCOL_VERSION;
+            header[1] = flags;
+            WriteBigEndian(header, 2, (int)streamId);
+            Array.Copy(endpointBytes, 0, header, ENDPOINT_OFFSET, ENDPOINT_LENGTH);
+            WriteBigEndian(header, LENGTH_OFFSET, length);
+            return header;
+        }
+
+        private static int ReadBigEndian(byte[] buffer, int offset)
+        {
+            return IPAddress.NetworkToHostOrder(BitConverter.ToInt32(buffer, offset));
+        }
+
+        private static void WriteBigEndian(byte[] buffer, int offset, int number)
+        {
+            BitConverter.GetBytes(IPAddress.HostToNetworkOrder(number)).CopyTo(buffer, offset);
+        }
+    }
+}
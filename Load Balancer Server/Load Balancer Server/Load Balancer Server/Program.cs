@@ -14,11 +14,16 @@ namespace Load_Balancer_Server
         static HashSet<IPEndPoint> _servers = new HashSet<IPEndPoint>();
         static LoadBalancer<IPEndPoint> _loadBalancer = new LoadBalancer<IPEndPoint>(_servers);
         static Dictionary<IPEndPoint, Socket> _clients = new Dictionary<IPEndPoint, Socket>();
+        static Dictionary<IPEndPoint, FramedAgentConnection> _framedConnections = new Dictionary<IPEndPoint, FramedAgentConnection>();
+        // Servers that closed a framed connection without answering on it (they know only the raw protocol)
+        static HashSet<IPEndPoint> _rawOnlyServers = new HashSet<IPEndPoint>();
         const string SERVER_REGEX = @"(?<ip>(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)):(?<port>\d+)";
         const string SERVERS_FILE = "servers.cfg";
         const int SERVE_PORT = 80;
         const int PROXY_PORT = 7070;
         const int SECOND = 1000;
+        // Pass the requests on a long-lived framed connection to every server (see FramedAgentConnection)
+        const bool FRAMED_PROTOCOL_ENABLED = true;
 
         static void Main(string[] args)
         {
@@ -64,7 +69,6 @@ namespace Load_Balancer_Server
             {
                 // Get request from client
                 ProxyMessage clientRequest = proxyServer.ReceiveClientMessage();
-                _clients[clientRequest.ClientEndpoint] = clientRequest.Socket;
                 //ColorizedWriteLine($"REQUEST from {clientRequest.ClientEndpoint}", ConsoleColor.Green);
                 
                 // Pick the most available server
@@ -76,57 +80,212 @@ namespace Load_Balancer_Server
                     //Console.WriteLine($"Picked {handlingServer}");
                 }
                 
+                // Pass the request in the framed protocol, unless the server knows only the raw protocol
+                bool rawOnlyServer;
+                lock (_rawOnlyServers)
+                {
+                    rawOnlyServer = _rawOnlyServers.Contains(handlingServer);
+                }
+                if (FRAMED_PROTOCOL_ENABLED && !rawOnlyServer)
+                    PassFramedRequest(proxyServer, clientRequest, handlingServer);
+                else
+                    PassRawRequest(proxyServer, clientRequest, handlingServer);
+            }
+        }
+
+        /// <summary>
+        /// Passes the request of the client to the server in the raw protocol,
+        /// and queues a thread that passes the response back to the client.
+        /// </summary>
+        /// <param name="proxyServer">The proxy server that received the request.</param>
+        /// <param name="clientRequest">The request of the client.</param>
+        /// <param name="handlingServer">The server that handles the request.</param>
+        static void PassRawRequest(ProxyServer proxyServer, ProxyMessage clientRequest, IPEndPoint handlingServer)
+        {
+            lock (_clients)
+            {
+                _clients[clientRequest.ClientEndpoint] = clientRequest.Socket;
+            }
+
+            try
+            {
+                // Pass the request of the client to the server
+                //Console.WriteLine($"Passing Client Request to {handlingServer}");
+                proxyServer.PassClientMessage(clientRequest, handlingServer);
+                // Add the load to the handling server
+                _loadBalancer.AddLoad(handlingServer);
+            }
+            catch // There's a problem with the web server
+            {
+                // Send the client an error message
+                byte[] problemResponseData = Encoding.ASCII.GetBytes("HTTP/1.1 500 Internal Server Error");
+                var clientEP = clientRequest.ClientEndpoint;
+                proxyServer.PassResponse(new ProxyMessage(clientEP, null, problemResponseData), clientRequest.Socket);
+
+                // Remove the load from the handling server
+                _loadBalancer.RemoveLoad(handlingServer);
+                
+                // Notify in the console that the web server has a problem
+                ColorizedWriteLine($"Web Server {handlingServer} has a problem! (2)", ConsoleColor.Red);
+                return;
+            }
+
+            // Queue a thread for handling the request
+            ThreadPool.QueueUserWorkItem((obj) =>
+            {
                 try
                 {
-                    // Pass the request of the client to the server
-                    //Console.WriteLine($"Passing Client Request to {handlingServer}");
-                    proxyServer.PassClientMessage(clientRequest, handlingServer);
-                    // Add the load to the handling server
-                    _loadBalancer.AddLoad(handlingServer);
+                    // Get the response for the client form the server
+                    ProxyMessage serverResponse = proxyServer.ReceiveResponse();
+                    
+                    // Pass the response to the client
+                    Socket clientSocket;
+                    lock (_clients)
+                    {
+                        clientSocket = _clients[serverResponse.ClientEndpoint];
+                        _clients.Remove(serverResponse.ClientEndpoint);
+                    }
+                    proxyServer.PassResponse(serverResponse, clientSocket);
+                    //ColorizedWriteLine($"RESPONSE to {clientRequest.ClientEndpoint}", ConsoleColor.Blue);
                 }
-                catch // There's a problem with the web server
+                catch (Exception e)
                 {
                     // Send the client an error message
                     byte[] problemResponseData = Encoding.ASCII.GetBytes("HTTP/1.1 500 Internal Server Error");
                     var clientEP = clientRequest.ClientEndpoint;
                     proxyServer.PassResponse(new ProxyMessage(clientEP, null, problemResponseData), clientRequest.Socket);
 
-                    // Remove the load from the handling server
-                    _loadBalancer.RemoveLoad(handlingServer);
-                    
                     // Notify in the console that the web server has a problem
-                    ColorizedWriteLine($"Web Server {handlingServer} has a problem! (2)", ConsoleColor.Red);
-                    continue;
+                    ColorizedWriteLine($"Web Server {handlingServer} has a problem!\n", ConsoleColor.Red);
                 }
 
-                // Queue a thread for handling the request
-                ThreadPool.QueueUserWorkItem((obj) =>
+                // Remove the load from the handling server
+                _loadBalancer.RemoveLoad(handlingServer);
+            });
+        }
+
+        /// <summary>
+        /// Passes the request of the client to the server on the framed connection to it
+        /// (the connection is opened if there isn't one yet).
+        /// The response is passed to the client as it arrives, and then the client's connection is closed.
+        /// </summary>
+        /// <param name="proxyServer">The proxy server that received the request.</param>
+        /// <param name="clientRequest">The request of the client.</param>
+        /// <param name="handlingServer">The server that handles the request.</param>
+        static void PassFramedRequest(ProxyServer proxyServer, ProxyMessage clientRequest, IPEndPoint handlingServer)
+        {
+            // Add the load to the handling server
+            lock (_loadBalancer)
+            {
+                _loadBalancer.AddLoad(handlingServer);
+            }
+
+            FramedAgentConnection connection = null;
+            try
+            {
+                lock (_framedConnections)
                 {
-                    try
+                    // Open a new connection if there isn't one, or if the last one was closed
+                    if (!_framedConnections.TryGetValue(handlingServer, out connection) || connection.Closed)
                     {
-                        // Get the response for the client form the server
-                        ProxyMessage serverResponse = proxyServer.ReceiveResponse();
-                        
-                        // Pass the response to the client
-                        proxyServer.PassResponse(serverResponse, _clients[serverResponse.ClientEndpoint]);
-                        _clients.Remove(serverResponse.ClientEndpoint);
-                        //ColorizedWriteLine($"RESPONSE to {clientRequest.ClientEndpoint}", ConsoleColor.Blue);
+                        // (a failure to open it is not a failure of the closed one)
+                        connection = null;
+                        connection = new FramedAgentConnection(handlingServer);
+                        _framedConnections[handlingServer] = connection;
                     }
-                    catch (Exception e)
+                }
+
+                var streamConnection = connection;
+                connection.SendRequest(clientRequest, (result, responseStarted) =>
+                    EndFramedRequest(proxyServer, clientRequest, handlingServer, streamConnection, result, responseStarted));
+            }
+            catch // There's a problem with the web server
+            {
+                // Remove the load from the handling server
+                lock (_loadBalancer)
+                {
+                    _loadBalancer.RemoveLoad(handlingServer);
+                }
+
+                // The server may have closed a new connection because it doesn't know the framed protocol
+                if (connection != null && !connection.Confirmed)
+                {
+                    FallBackToRawProtocol(proxyServer, clientRequest, handlingServer);
+                    return;
+                }
+
+                // Send the client an error message
+                byte[] problemResponseData = Encoding.ASCII.GetBytes("HTTP/1.1 500 Internal Server Error");
+                var clientEP = clientRequest.ClientEndpoint;
+                proxyServer.PassResponse(new ProxyMessage(clientEP, null, problemResponseData), clientRequest.Socket);
+                clientRequest.Socket.Close();
+
+                // Notify in the console that the web server has a problem
+                ColorizedWriteLine($"Web Server {handlingServer} has a problem! (2)", ConsoleColor.Red);
+            }
+        }
+
+        /// <summary>
+        /// Finishes a request that was passed on a framed connection, after its stream ended.
+        /// Runs in the thread that receives the frames of the connection.
+        /// </summary>
+        static void EndFramedRequest(ProxyServer proxyServer, ProxyMessage clientRequest, IPEndPoint handlingServer,
+                                     FramedAgentConnection connection, FramedStreamResult result, bool responseStarted)
+        {
+            // Remove the load from the handling server
+            lock (_loadBalancer)
+            {
+                _loadBalancer.RemoveLoad(handlingServer);
+            }
+
+            // The server closed the connection without ever answering in the framed protocol
+            if (result == FramedStreamResult.ConnectionFailed && !connection.Confirmed)
+            {
+                FallBackToRawProtocol(proxyServer, clientRequest, handlingServer);
+                return;
+            }
+
+            try
+            {
+                if (result != FramedStreamResult.Completed)
+                {
+                    // Send the client an error message, unless a part of the response was already sent
+                    if (!responseStarted)
                     {
-                        // Send the client an error message
                         byte[] problemResponseData = Encoding.ASCII.GetBytes("HTTP/1.1 500 Internal Server Error");
                         var clientEP = clientRequest.ClientEndpoint;
                         proxyServer.PassResponse(new ProxyMessage(clientEP, null, problemResponseData), clientRequest.Socket);
-
-                        // Notify in the console that the web server has a problem
-                        ColorizedWriteLine($"Web Server {handlingServer} has a problem!\n", ConsoleColor.Red);
                     }
 
-                    // Remove the load from the handling server
-                    _loadBalancer.RemoveLoad(handlingServer);
-                });
+                    // Notify in the console that the web server has a problem
+                    ColorizedWriteLine($"Web Server {handlingServer} has a problem!\n", ConsoleColor.Red);
+                }
+
+                // The response ended, and the client's connection carries a single request
+                clientRequest.Socket.Shutdown(SocketShutdown.Both);
             }
+            catch
+            {
+                // The client is gone
+            }
+            clientRequest.Socket.Close();
+        }
+
+        /// <summary>
+        /// Marks the given server as one that knows only the raw protocol,
+        /// and passes the request to it again in the raw protocol.
+        /// </summary>
+        static void FallBackToRawProtocol(ProxyServer proxyServer, ProxyMessage clientRequest, IPEndPoint handlingServer)
+        {
+            bool added;
+            lock (_rawOnlyServers)
+            {
+                added = _rawOnlyServers.Add(handlingServer);
+            }
+            if (added)
+                ColorizedWriteLine($"Web Server {handlingServer} does not know the framed protocol, using the raw protocol.", ConsoleColor.Yellow);
+
+            PassRawRequest(proxyServer, clientRequest, handlingServer);
         }
 
         /// <summary>
@@ -62,9 +62,7 @@ namespace Load_Balancer_Server
         {
             // Build the message in our proxy format:
             // <endpoint_bytes><client_message>
-            var ipBytes = message.ClientEndpoint.Address.GetAddressBytes();
-            var portBytes = BitConverter.GetBytes(message.ClientEndpoint.Port).Take(PORT_LENGTH_IN_BYTES).ToArray();
-            byte[] messageToSend = ipBytes.Concat(portBytes).Concat(message.Content).ToArray();
+            byte[] messageToSend = GetEndpointBytes(message.ClientEndpoint).Concat(message.Content).ToArray();
 
             // Send the proxy-formatted message to the destination
             Socket socket = new Socket(SocketType.Stream, ProtocolType.Tcp);
@@ -79,6 +77,18 @@ namespace Load_Balancer_Server
             socket.Send(messageToSend);
         }
 
+        /// <summary>
+        /// Converts the given client endpoint to the format of our proxy protocol.
+        /// </summary>
+        /// <param name="clientEP">The endpoint of the client.</param>
+        /// <returns>The bytes of the IP followed by the bytes of the port.</returns>
+        public static byte[] GetEndpointBytes(IPEndPoint clientEP)
+        {
+            var ipBytes = clientEP.Address.GetAddressBytes();
+            var portBytes = BitConverter.GetBytes(clientEP.Port).Take(PORT_LENGTH_IN_BYTES).ToArray();
+            return ipBytes.Concat(portBytes).ToArray();
+        }
+
         /// <summary>
         /// Passes the given response message to the endpoint.
         /// </summary>
@@ -104,9 +114,9 @@ namespace Load_Balancer_Server
 
             var clientSocket = _tcpClientListener.AcceptSocket();
 
-            // Get the message from the client and return it
-            clientSocket.Receive(buffer);
-            return new ProxyMessage((IPEndPoint)clientSocket.RemoteEndPoint, clientSocket, buffer);
+            // Get the message from the client and return it (without the unused part of the buffer)
+            int receivedLength = clientSocket.Receive(buffer);
+            return new ProxyMessage((IPEndPoint)clientSocket.RemoteEndPoint, clientSocket, buffer.Take(receivedLength).ToArray());
         }
 
         /// <summary>
@@ -2,9 +2,20 @@ import socket
 import threading
 import pickle
 import os
+import shutil
+import secrets
+import hashlib
+import json
+import zlib
+import lzma
 from Cryptodome.Cipher import AES
 from Cryptodome.Util.Padding import unpad
 import sys
+import errno
+import ctypes
+import ctypes.util
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 AES_ENCRYPTION_KEY = b"N44vCTcb<W8sBXD@"
 AES_BLOCKSIZE = 16
@@ -15,28 +26,802 @@ CHUNK_SIZE = 16384
 GOOGLE_DNS_IP = "8.8.8.8"
 DNS_PORT = 53
 
+# Streaming uploads settings
+STREAM_PROTOCOL_VERSIONS = [1]          # Versions of the streaming archive that can be received
+MAX_STREAM_FRAME_SIZE = 1024 * 1024     # Max size of a single encrypted frame (in bytes)
+STAGING_FOLDER_PREFIX = '.upload-'      # Websites are written to hidden staging folders until they're complete
+
+# The records of the streaming archive (see upload_website.py)
+RECORD_FOLDER = b'D'
+RECORD_FOLDER_END = b'U'
+RECORD_FILE = b'F'
+RECORD_COMPRESSED_FILE = b'C'
+RECORD_END = b'E'
+
+# Encryption settings of the streaming archive and the sync (the legacy format is always one AES-CBC buffer)
+CIPHER_AES_CBC = 'aes-cbc'      # One AES-CBC stream
+CIPHER_AES_GCM = 'aes-gcm'      # Independent AES-GCM chunks, decrypted in parallel and authenticated one by one
+SUPPORTED_CIPHERS = [CIPHER_AES_GCM, CIPHER_AES_CBC]
+GCM_NONCE_PREFIX_SIZE = 8       # The nonce of a chunk is a random prefix (per stream) + the chunk's index (4 bytes)
+GCM_TAG_SIZE = 16
+CRYPTO_WORKERS = os.cpu_count() or 1    # Amount of threads that decrypt chunks at the same time
+
+# Compression settings
+SUPPORTED_COMPRESSION_METHODS = ['zlib', 'lzma']
+MAX_DECOMPRESSED_PIECE_SIZE = 256 * 1024    # Compressed data is decompressed in pieces of up to this size
+
+# Staged writer settings (for websites in the legacy format)
+WRITER_WORKERS = 8                  # Amount of threads that write the files of a website at the same time
+WRITE_BATCH_FILES = 32              # Max amount of files that a thread writes (and syncs) in one go
+WRITE_BATCH_SIZE = 4 * 1024 * 1024  # A batch ends once its files reach this size (in bytes)
+FSYNC_WEBSITES = True               # Make sure that a website is on the disk before it's moved into place
+
+# Sync (delta uploads) settings
+SYNC_PROTOCOL_VERSIONS = [1]            # Versions of the sync protocol that can be received
+MAX_MANIFEST_SIZE = 64 * 1024 * 1024    # Max size of the manifest of a synced website (in bytes)
+HASHES_FILE_PREFIX = '.hashes-'         # The hashes of a synced website's files are kept in a hidden file next to it
+
+# renameat2() (Linux) - renames without replacing, or swaps two paths, in a single step
+AT_FDCWD = -100
+RENAME_NOREPLACE = 1
+RENAME_EXCHANGE = 2
+
 client_threads = []
 websites_folder = ""
 
+# Only one synced website at a time may be swapped into place
+publish_lock = threading.Lock()
+# A synced website is built from its current version and swapped into place by one sync at a time
+website_locks = {}      # {website name : threading.Lock}
+website_locks_lock = threading.Lock()
+
 def recv_data_in_chunks(sock, total_size, chunk_size):
     '''
     This function recieves data of size total_size using given socket in chunks of chunk_size.
+    The data is received straight into one preallocated buffer.
     '''
-    full_data = b''
+    # The data is encrypted after it's padded to the next multiple of the block size
+    # (a whole block of padding is added if it's already a multiple)
+    encrypted_size = (total_size // AES_BLOCKSIZE + 1) * AES_BLOCKSIZE
+    full_data = bytearray(encrypted_size)
+    recv_exact_into(sock, memoryview(full_data), chunk_size)
+    print(f"Recieved {encrypted_size}")
 
-    # Recieve the data pieces and join them together
-    while len(full_data) < total_size:
-        chunk_data = sock.recv(chunk_size)
-        print(f"Recieved {len(chunk_data)}")
-        full_data = full_data + chunk_data
-    
     # Return the decrypted data
     return decrypt_data(full_data)
 
 
-def json_to_folder(folder_json, relative_path=''):
+def recv_exact_into(sock, view, chunk_size=CHUNK_SIZE):
+    '''
+    This function fills the given memoryview with data from the given socket, in chunks of up to chunk_size.
+    '''
+    received = 0
+    while received < len(view):
+        chunk_length = sock.recv_into(view[received:received + chunk_size])
+        if chunk_length == 0:
+            raise ConnectionError('The connection closed in the middle of the data')
+        received += chunk_length
+
+
+def is_valid_entry_name(name):
+    '''
+    This function checks that the given name is a plain name of a file or a folder,
+    so nothing is written outside of the website folder.
+    '''
+    return name not in ('', '.', '..') and '/' not in name and '\\' not in name
+
+
+def negotiate_compression(request):
+    '''
+    This function returns the first compression method that the client offered in its request
+    (like 'STREAM:1:zlib,lzma') and is supported here, or None if the data won't be compressed.
+    '''
+    request_parts = request.split(':')
+    if len(request_parts) < 3:
+        return None
+    for compression in request_parts[2].split(','):
+        if compression in SUPPORTED_COMPRESSION_METHODS:
+            return compression
+    return None
+
+
+def negotiate_cipher(request):
+    '''
+    This function returns the first cipher that the client offered in its request
+    (like 'STREAM:1:zlib,lzma:aes-gcm,aes-cbc') and is supported here, or AES-CBC if there's none.
+    '''
+    request_parts = request.split(':')
+    if len(request_parts) < 4:
+        return CIPHER_AES_CBC
+    for cipher in request_parts[3].split(','):
+        if cipher in SUPPORTED_CIPHERS:
+            return cipher
+    return CIPHER_AES_CBC
+
+
+def get_agreement(request, compression, cipher):
+    '''
+    This function returns the agreement to the client's request, with the compression method and the cipher
+    that were picked ('OK:<compression method>:<cipher>').
+    Clients that didn't offer ciphers get the older agreement ('OK' or 'OK:<compression method>').
+    '''
+    if len(request.split(':')) >= 4:
+        return f'OK:{compression or ""}:{cipher}'.encode()
+    return b'OK' if compression is None else b'OK:' + compression.encode()
+
+
+def new_decompressor(compression):
+    '''
+    This function returns a decompressor object of the given compression method.
+    '''
+    if compression == 'zlib':
+        return zlib.decompressobj()
+    return lzma.LZMADecompressor()
+
+
+def decompress_pieces(decompressor, data):
+    '''
+    This function decompresses the given data with the given (zlib or lzma) decompressor,
+    and yields the decompressed data in pieces of up to MAX_DECOMPRESSED_PIECE_SIZE,
+    so a small chunk of compressed data can't take a lot of memory.
+    '''
+    try:
+        yield decompressor.decompress(data, MAX_DECOMPRESSED_PIECE_SIZE)
+        if isinstance(decompressor, lzma.LZMADecompressor):
+            while not decompressor.needs_input and not decompressor.eof:
+                yield decompressor.decompress(b'', MAX_DECOMPRESSED_PIECE_SIZE)
+        else:
+            while decompressor.unconsumed_tail:
+                yield decompressor.decompress(decompressor.unconsumed_tail, MAX_DECOMPRESSED_PIECE_SIZE)
+    except (zlib.error, lzma.LZMAError, EOFError) as e:
+        raise ValueError('Invalid compressed data: %s' % (e))
+
+
+def end_decompression(decompressor):
+    '''
+    This function makes sure that the compressed data of a file ended exactly at the end of the file.
+    '''
+    if not decompressor.eof or decompressor.unused_data:
+        raise ValueError('The compressed data of a file is incomplete')
+
+
+class ArchiveWriter:
+    '''
+    Writes a website that arrives in the streaming archive format (see upload_website.py) to the disk,
+    while its data arrives - the files are written chunk by chunk, and never kept in memory.
+    The website folder itself is written to root_path, and its name in the archive is kept in website_name.
+    Compressed files are decompressed with the negotiated compression method.
+    '''
+
+    # What the writer is waiting for
+    RECORD_TYPE = 0
+    NAME_LENGTH = 1
+    NAME = 2
+    CHUNK_LENGTH = 3
+    CHUNK_DATA = 4
+    ENDED = 5
+
+    def __init__(self, root_path, compression=None):
+        self.root_path = root_path
+        self.compression = compression
+        self.website_name = None
+
+        self._state = self.RECORD_TYPE
+        self._field = bytearray()       # The (small) field that is being received
+        self._field_size = 1            # The size of the field that is being received
+        self._record_type = None
+        self._folders = []              # The paths of the folders that are being written
+        self._file = None               # The file that is being written
+        self._decompressor = None       # The decompressor of the file that is being written (if it's compressed)
+        self._remaining = 0             # Amount of bytes left in the current chunk
+
+    @property
+    def ended(self):
+        return self._state == self.ENDED
+
+    def feed(self, data):
+        '''
+        Writes the next piece of the archive (any bytes-like object).
+        '''
+        view = memoryview(data)
+        position = 0
+        while position < len(view):
+            if self._state == self.ENDED:
+                raise ValueError('Data after the end of the archive')
+
+            if self._state == self.CHUNK_DATA:
+                # Write the file's data as it is, without collecting it
+                amount = min(self._remaining, len(view) - position)
+                if self._decompressor is None:
+                    self._file.write(view[position:position + amount])
+                else:
+                    for data_piece in decompress_pieces(self._decompressor, view[position:position + amount]):
+                        self._file.write(data_piece)
+                position += amount
+                self._remaining -= amount
+                if self._remaining == 0:
+                    self._expect(self.CHUNK_LENGTH, 4)
+                continue
+
+            # Collect the bytes of the current field
+            amount = min(self._field_size - len(self._field), len(view) - position)
+            self._field += view[position:position + amount]
+            position += amount
+            if len(self._field) == self._field_size:
+                field = bytes(self._field)
+                self._field.clear()
+                self._handle_field(field)
+
+    def close(self):
+        '''
+        Closes the file that is being written (if the archive was cut in the middle of it).
+        '''
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _expect(self, state, field_size=0):
+        self._state = state
+        self._field_size = field_size
+
+    def _handle_field(self, field):
+        if self._state == self.RECORD_TYPE:
+            self._handle_record_type(field)
+        elif self._state == self.NAME_LENGTH:
+            self._expect(self.NAME, int.from_bytes(field, byteorder="big"))
+            if self._field_size == 0:
+                raise ValueError('Empty entry name')
+        elif self._state == self.NAME:
+            self._handle_name(field.decode())
+        elif self._state == self.CHUNK_LENGTH:
+            self._remaining = int.from_bytes(field, byteorder="big")
+            if self._remaining > 0:
+                self._expect(self.CHUNK_DATA)
+            else:
+                # An empty chunk ends the file
+                if self._decompressor is not None:
+                    end_decompression(self._decompressor)
+                    self._decompressor = None
+                self.close()
+                self._expect(self.RECORD_TYPE, 1)
+
+    def _handle_record_type(self, record_type):
+        if record_type == RECORD_COMPRESSED_FILE and self.compression is None:
+            raise ValueError('A compressed file, but no compression was negotiated')
+        if record_type in (RECORD_FOLDER, RECORD_FILE, RECORD_COMPRESSED_FILE):
+            if record_type != RECORD_FOLDER and not self._folders:
+                raise ValueError('A file outside of the website folder')
+            if record_type == RECORD_FOLDER and self.website_name is not None and not self._folders:
+                raise ValueError('The archive should have a single website folder')
+            self._record_type = record_type
+            self._expect(self.NAME_LENGTH, 2)
+        elif record_type == RECORD_FOLDER_END:
+            if not self._folders:
+                raise ValueError('Unexpected end of folder')
+            self._folders.pop()
+            self._expect(self.RECORD_TYPE, 1)
+        elif record_type == RECORD_END:
+            if self._folders or self.website_name is None:
+                raise ValueError('Unexpected end of the archive')
+            self._expect(self.ENDED)
+        else:
+            raise ValueError('Invalid record type: %r' % (record_type))
+
+    def _handle_name(self, name):
+        # Make sure that the name is a plain name, so nothing is written outside of the website folder
+        if not is_valid_entry_name(name):
+            raise ValueError('Invalid entry name: %r' % (name))
+
+        if self._record_type == RECORD_FOLDER:
+            if self.website_name is None:
+                # The website folder itself
+                self.website_name = name
+                folder_path = self.root_path
+            else:
+                folder_path = os.path.join(self._folders[-1], name)
+            os.mkdir(folder_path)
+            self._folders.append(folder_path)
+            self._expect(self.RECORD_TYPE, 1)
+        else:
+            self._file = open(os.path.join(self._folders[-1], name), "wb")
+            if self._record_type == RECORD_COMPRESSED_FILE:
+                self._decompressor = new_decompressor(self.compression)
+            self._expect(self.CHUNK_LENGTH, 4)
+
+
+class BlobWriter:
+    '''
+    Writes the files' contents (blobs) of a synced website to blobs_path while they arrive.
+    The blobs arrive in the order of blob_hashes, each one in chunks: length (4 bytes) + data,
+    and an empty chunk ends it. Every blob is saved under its hash, after its hash is verified.
+    If a compression method was negotiated, every blob starts with its record type (plain or compressed).
+    '''
+
+    def __init__(self, blobs_path, blob_hashes, compression=None):
+        self.blobs_path = blobs_path
+        self.compression = compression
+        self._blob_hashes = list(blob_hashes)
+        self._index = 0                 # The index of the blob that is being written
+        self._length_field = bytearray()
+        self._remaining = 0             # Amount of bytes left in the current chunk
+        self._needs_record_type = False # Whether the record type of the blob wasn't received yet
+        self._file = None
+        self._hash = None
+        self._decompressor = None
+        if self._blob_hashes:
+            self._start_blob()
+
+    @property
+    def ended(self):
+        return self._index == len(self._blob_hashes)
+
+    def feed(self, data):
+        '''
+        Writes the next piece of the blobs stream (any bytes-like object).
+        '''
+        view = memoryview(data)
+        position = 0
+        while position < len(view):
+            if self.ended:
+                raise ValueError('Data after the last blob')
+
+            if self._needs_record_type:
+                record_type = bytes(view[position:position + 1])
+                position += 1
+                if record_type == RECORD_COMPRESSED_FILE:
+                    self._decompressor = new_decompressor(self.compression)
+                elif record_type != RECORD_FILE:
+                    raise ValueError('Invalid record type: %r' % (record_type))
+                self._needs_record_type = False
+                continue
+
+            if self._remaining:
+                # Write and hash the blob's data as it is, without collecting it
+                amount = min(self._remaining, len(view) - position)
+                data_pieces = [view[position:position + amount]]
+                if self._decompressor is not None:
+                    data_pieces = decompress_pieces(self._decompressor, data_pieces[0])
+                for data_piece in data_pieces:
+                    self._file.write(data_piece)
+                    self._hash.update(data_piece)
+                position += amount
+                self._remaining -= amount
+                continue
+
+            # Collect the length of the next chunk
+            amount = min(4 - len(self._length_field), len(view) - position)
+            self._length_field += view[position:position + amount]
+            position += amount
+            if len(self._length_field) == 4:
+                self._remaining = int.from_bytes(self._length_field, byteorder="big")
+                self._length_field.clear()
+                if self._remaining == 0:
+                    # An empty chunk ends the blob
+                    self._end_blob()
+
+    def close(self):
+        '''
+        Closes the blob that is being written (if the stream was cut in the middle of it).
+        '''
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _start_blob(self):
+        self._file = open(os.path.join(self.blobs_path, self._blob_hashes[self._index]), "wb")
+        self._hash = hashlib.sha256()
+        self._needs_record_type = self.compression is not None
+
+    def _end_blob(self):
+        if self._decompressor is not None:
+            end_decompression(self._decompressor)
+            self._decompressor = None
+        self.close()
+        if self._hash.hexdigest() != self._blob_hashes[self._index]:
+            raise ValueError('The blob %s does not match its hash' % (self._blob_hashes[self._index]))
+        self._index += 1
+        if not self.ended:
+            self._start_blob()
+
+
+def decrypt_chunk_gcm(nonce_prefix, index, frame):
+    '''
+    This function decrypts (in place) and authenticates a single chunk of an AES-GCM stream, and returns its data.
+    The frame is: final flag (1 byte) + encrypted data + tag (16 bytes).
+    Raises ValueError if the chunk was changed, or isn't in its place in the stream.
+    '''
+    frame_view = memoryview(frame)
+    encrypted_data = frame_view[1:-GCM_TAG_SIZE]
+    aes_decryptor = AES.new(AES_ENCRYPTION_KEY, AES.MODE_GCM, nonce=nonce_prefix + index.to_bytes(4, byteorder="big"))
+    aes_decryptor.update(index.to_bytes(4, byteorder="big") + bytes(frame_view[:1]))
+    aes_decryptor.decrypt(encrypted_data, output=encrypted_data)
+    aes_decryptor.verify(frame_view[-GCM_TAG_SIZE:])
+    return encrypted_data
+
+
+def recv_encrypted_stream_gcm(sock, feed):
+    '''
+    This function receives an AES-GCM stream (see encrypt_stream_gcm in upload_website.py), decrypts its
+    chunks in parallel (by CRYPTO_WORKERS threads) and passes their data to the given feed function in order,
+    once every chunk is authenticated. At most CRYPTO_WORKERS * 2 chunks are kept in memory at any time.
+    '''
+    length_buffer = memoryview(bytearray(4))
+    recv_exact_into(sock, length_buffer)
+    if int.from_bytes(length_buffer, byteorder="big") != GCM_NONCE_PREFIX_SIZE:
+        raise ValueError('Invalid nonce prefix')
+    nonce_prefix = bytearray(GCM_NONCE_PREFIX_SIZE)
+    recv_exact_into(sock, memoryview(nonce_prefix))
+    nonce_prefix = bytes(nonce_prefix)
+
+    decrypted_chunks = deque()
+    index = 0
+    final_received = False
+    with ThreadPoolExecutor(max_workers=CRYPTO_WORKERS) as executor:
+        while True:
+            recv_exact_into(sock, length_buffer)
+            frame_length = int.from_bytes(length_buffer, byteorder="big")
+            if frame_length == 0:
+                break
+            if final_received:
+                raise ValueError('Data after the final chunk')
+            if frame_length < 1 + GCM_TAG_SIZE or frame_length > MAX_STREAM_FRAME_SIZE:
+                raise ValueError('Invalid frame length: %d' % (frame_length))
+
+            # Every frame gets its own buffer, since several frames are decrypted at the same time
+            frame = bytearray(frame_length)
+            recv_exact_into(sock, memoryview(frame))
+            # The final flag is authenticated with the chunk, so it's trusted once the chunk is verified
+            final_received = frame[0] == 1
+            decrypted_chunks.append(executor.submit(decrypt_chunk_gcm, nonce_prefix, index, frame))
+            index += 1
+
+            # Pass the decrypted chunks on in order, and don't let too many chunks wait
+            while len(decrypted_chunks) >= CRYPTO_WORKERS * 2:
+                feed(decrypted_chunks.popleft().result())
+
+        while decrypted_chunks:
+            feed(decrypted_chunks.popleft().result())
+    if not final_received:
+        raise ValueError('The stream ended before its final chunk')
+
+
+def recv_encrypted_stream(sock, feed, cipher=CIPHER_AES_CBC):
+    '''
+    This function receives an encrypted stream (see encrypt_stream in upload_website.py), decrypts it
+    frame by frame and passes the decrypted data to the given feed function while it arrives.
+    Every frame is received and decrypted in place, in one preallocated buffer.
+    The last block of every frame is held back until it's known whether it's the padded end of the stream.
+    With AES-GCM the stream is decrypted in parallel chunks instead (see recv_encrypted_stream_gcm).
     '''
-    This function converts the given json-formatted data to a folder and saves it.
+    if cipher == CIPHER_AES_GCM:
+        recv_encrypted_stream_gcm(sock, feed)
+        return
+
+    aes_decryptor = AES.new(AES_ENCRYPTION_KEY, AES.MODE_CBC, AES_IV)
+    frame_buffer = memoryview(bytearray(MAX_STREAM_FRAME_SIZE))
+    length_buffer = memoryview(bytearray(4))
+    last_block = b''
+
+    while True:
+        recv_exact_into(sock, length_buffer)
+        frame_length = int.from_bytes(length_buffer, byteorder="big")
+        if frame_length == 0:
+            break
+        if frame_length % AES_BLOCKSIZE != 0 or frame_length > MAX_STREAM_FRAME_SIZE:
+            raise ValueError('Invalid frame length: %d' % (frame_length))
+
+        frame = frame_buffer[:frame_length]
+        recv_exact_into(sock, frame)
+        aes_decryptor.decrypt(frame, output=frame)
+
+        feed(last_block)
+        feed(frame[:-AES_BLOCKSIZE])
+        last_block = bytes(frame[-AES_BLOCKSIZE:])
+
+    if not last_block:
+        raise ValueError('The stream is empty')
+    feed(unpad(last_block, AES_BLOCKSIZE))
+
+
+def recv_streaming_archive(sock, root_path, compression=None, cipher=CIPHER_AES_CBC):
+    '''
+    This function receives a website in the streaming archive format, and writes it to root_path
+    while it arrives. Returns the name of the website.
+    '''
+    archive_writer = ArchiveWriter(root_path, compression)
+    try:
+        recv_encrypted_stream(sock, archive_writer.feed, cipher)
+        if not archive_writer.ended:
+            raise ValueError('The archive ended unexpectedly')
+    finally:
+        archive_writer.close()
+    return archive_writer.website_name
+
+
+def recv_manifest(sock, cipher=CIPHER_AES_CBC):
+    '''
+    This function receives the (encrypted) manifest of a synced website, and returns it validated:
+    the website's name, its folders and its files - (relative path, sha256 hash, size) each.
+    The format is:
+        {
+            "name" : "the name of the website",
+            "folders" : ["a", "a/b", ...],
+            "files" : [["a/b/file name", "sha256 hash of the file", size], ...]
+        }
+    '''
+    manifest_data = bytearray()
+
+    def collect(data_piece):
+        manifest_data.extend(data_piece)
+        if len(manifest_data) > MAX_MANIFEST_SIZE:
+            raise ValueError('The manifest is too large')
+
+    recv_encrypted_stream(sock, collect, cipher)
+    manifest = json.loads(manifest_data)
+
+    # Make sure that every path is made of plain names, so nothing is written outside of the website folder
+    website_name = manifest['name']
+    if not is_valid_entry_name(website_name):
+        raise ValueError('Invalid website name: %r' % (website_name))
+    for relative_path in manifest['folders'] + [file_entry[0] for file_entry in manifest['files']]:
+        if not all(is_valid_entry_name(name) for name in relative_path.split('/')):
+            raise ValueError('Invalid path: %r' % (relative_path))
+    for _, file_hash, _ in manifest['files']:
+        if len(file_hash) != 64 or not all(c in '0123456789abcdef' for c in file_hash):
+            raise ValueError('Invalid hash: %r' % (file_hash))
+    return website_name, manifest['folders'], manifest['files']
+
+
+def get_hashes_file_path(website_name):
+    '''
+    This function returns the path of the file that keeps the hashes of a synced website's files.
+    '''
+    return websites_folder + HASHES_FILE_PREFIX + website_name + '.json'
+
+
+def load_file_hashes(website_name):
+    '''
+    This function returns the hashes of the files of a website, as they were saved by its last sync:
+    {relative path : [size, modification time (ns), sha256 hash]}, or an empty dictionary if there aren't any.
+    '''
+    try:
+        with open(get_hashes_file_path(website_name), 'r') as hashes_file:
+            return json.load(hashes_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def get_website_lock(website_name):
+    '''
+    This function returns the lock of a synced website (see website_locks).
+    '''
+    with website_locks_lock:
+        return website_locks.setdefault(website_name, threading.Lock())
+
+
+def save_file_hashes(website_name, file_hashes):
+    '''
+    This function saves the hashes of the files of a website, so the next sync only hashes the files that changed.
+    '''
+    # Replace the old hashes in a single step, so they're never read half written
+    hashes_file_path = get_hashes_file_path(website_name)
+    temporary_path = hashes_file_path + '.' + secrets.token_hex(8)
+    try:
+        with open(temporary_path, 'w') as hashes_file:
+            json.dump(file_hashes, hashes_file)
+        os.replace(temporary_path, hashes_file_path)
+    except OSError as e:
+        # The next sync will hash the files that it can't match (by their size and modification time)
+        print('Failed saving the hashes of %s: %s' % (website_name, e))
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+
+def hash_website_files(website_path, known_hashes={}):
+    '''
+    This function returns the sha256 hashes of the files of a saved website: {hash : path of a file}.
+    known_hashes - the hashes that were saved by the last sync (see load_file_hashes), a file whose size and
+                   modification time didn't change since then isn't read again.
+    '''
+    file_hashes = {}
+    for folder_path, _, file_names in os.walk(website_path):
+        for file_name in file_names:
+            file_path = os.path.join(folder_path, file_name)
+            relative_path = os.path.relpath(file_path, website_path).replace(os.sep, '/')
+            file_stat = os.stat(file_path)
+            known_hash = known_hashes.get(relative_path)
+            if known_hash is not None and known_hash[:2] == [file_stat.st_size, file_stat.st_mtime_ns]:
+                file_hashes[known_hash[2]] = file_path
+                continue
+
+            file_hash = hashlib.sha256()
+            with open(file_path, "rb") as website_file:
+                for chunk in iter(lambda: website_file.read(CHUNK_SIZE), b''):
+                    file_hash.update(chunk)
+            file_hashes[file_hash.hexdigest()] = file_path
+    return file_hashes
+
+
+def link_or_copy_file(source_path, file_path):
+    '''
+    This function hard-links a file into place, or copies it if it can't be linked
+    (like on a file system without hard links).
+    '''
+    try:
+        os.link(source_path, file_path)
+    except OSError:
+        shutil.copyfile(source_path, file_path)
+
+
+def build_synced_website(site_path, folders, files, existing_files, blobs_path):
+    '''
+    This function builds the new version of a synced website in site_path.
+    Unchanged files are linked from the current version (they're never written in place, only replaced
+    with a whole new version), and the rest are linked from the received blobs
+    (a file with the same contents may appear several times).
+    existing_files - the hashes of the current version's files (see hash_website_files), which must not change
+                     until the new version is built (see get_website_lock).
+    Returns the hashes of the new version's files, with the size and modification time of every file
+    (see load_file_hashes) - they're the hashes of the files that were linked or copied, which were hashed
+    (or verified, for the blobs) before. The files keep their size and modification time when the version
+    is moved into place.
+    '''
+    os.mkdir(site_path)
+    for relative_path in folders:
+        os.makedirs(os.path.join(site_path, relative_path), exist_ok=True)
+
+    file_hashes = {}
+    for relative_path, file_hash, _ in files:
+        file_path = os.path.join(site_path, relative_path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        if file_hash in existing_files:
+            link_or_copy_file(existing_files[file_hash], file_path)
+        elif os.path.exists(os.path.join(blobs_path, file_hash)):
+            link_or_copy_file(os.path.join(blobs_path, file_hash), file_path)
+        else:
+            # The file was in the current version when the missing files were asked for,
+            # and another sync replaced that version since
+            raise ValueError('The file %s changed during the sync' % (relative_path))
+        file_stat = os.stat(file_path)
+        file_hashes[relative_path] = [file_stat.st_size, file_stat.st_mtime_ns, file_hash]
+    return file_hashes
+
+
+def load_renameat2():
+    '''
+    This function returns libc's renameat2() (through ctypes), or None if it isn't available.
+    '''
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        renameat2 = libc.renameat2
+    except (OSError, AttributeError, TypeError):
+        return None
+    renameat2.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint]
+    renameat2.restype = ctypes.c_int
+    return renameat2
+
+
+renameat2 = load_renameat2()
+
+
+def rename_with_flags(first_path, second_path, flags):
+    '''
+    This function renames a path with renameat2() and the given flags.
+    Returns False if the OS or the file system doesn't support it.
+    '''
+    if renameat2 is None:
+        return False
+    if renameat2(AT_FDCWD, os.fsencode(first_path), AT_FDCWD, os.fsencode(second_path), flags) == 0:
+        return True
+    error_number = ctypes.get_errno()
+    if error_number in (errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+        return False
+    raise OSError(error_number, os.strerror(error_number), first_path, None, second_path)
+
+
+def exchange_paths(first_path, second_path):
+    '''
+    This function swaps two paths in a single step (renameat2 with RENAME_EXCHANGE).
+    Returns False if the OS or the file system can't exchange paths.
+    '''
+    return rename_with_flags(first_path, second_path, RENAME_EXCHANGE)
+
+
+def publish_website(site_path, website_path, old_path, file_hashes=None):
+    '''
+    This function moves the new version of a synced website into place.
+    The current version (if there's one) is swapped with the new version in a single step, so the website
+    never disappears, and it ends up in site_path. Where paths can't be swapped,
+    the current version is moved aside to old_path first.
+    file_hashes - the hashes of the new version's files (see build_synced_website), saved once it's in place
+                  (by the same sync that placed it, even if another sync of the website runs at the same time).
+    '''
+    with publish_lock:
+        if not move_website_into_place(site_path, website_path):
+            if not exchange_paths(site_path, website_path):
+                os.rename(website_path, old_path)
+                os.rename(site_path, website_path)
+            sync_folder(os.path.dirname(website_path))
+        if file_hashes is not None:
+            save_file_hashes(os.path.basename(website_path), file_hashes)
+
+
+def sync_folder(folder_path):
+    '''
+    This function makes sure that the entries of a folder (like a website that was moved into it) are on the disk.
+    '''
+    if not FSYNC_WEBSITES:
+        return
+    try:
+        folder_fd = os.open(folder_path or '.', os.O_RDONLY)
+    except OSError:
+        # Folders can't be opened on every platform (like Windows)
+        return
+    try:
+        os.fsync(folder_fd)
+    finally:
+        os.close(folder_fd)
+
+
+def move_website_into_place(staging_path, website_path):
+    '''
+    This function moves a received website from its staging folder to its place.
+    Returns False if the website's name is already taken.
+    '''
+    try:
+        # The name is checked and taken in a single step (renameat2 with RENAME_NOREPLACE)
+        if not rename_with_flags(staging_path, website_path, RENAME_NOREPLACE):
+            # Otherwise it's checked first, since os.rename() replaces an empty folder
+            if os.path.exists(website_path):
+                return False
+            os.rename(staging_path, website_path)
+    except OSError as e:
+        # A folder that was created in the meantime fails the rename (with ENOTEMPTY if it isn't empty)
+        if e.errno in (errno.EEXIST, errno.ENOTEMPTY):
+            return False
+        raise
+    sync_folder(os.path.dirname(website_path))
+    return True
+
+
+def move_website_or_rename(client_socket, client_addr, staging_path, website_name):
+    '''
+    This function moves a received website from its staging folder to its place,
+    and asks the client for a new name while its name is already taken.
+    Returns False if the client didn't give a new name.
+    '''
+    while not move_website_into_place(staging_path, websites_folder + website_name):
+        client_socket.send(b'RENAME')
+        new_name = client_socket.recv(CHUNK_SIZE).decode()
+        if not new_name.startswith('NEWNAME:'):
+            print('%s: No new name was given' % (str(client_addr)))
+            return False
+        website_name = os.path.basename(new_name.split(':', 1)[1])
+    return True
+
+
+def write_files(files):
+    '''
+    This function writes a batch of files - (path, data) each, and then syncs all of them to the disk.
+    '''
+    opened_files = []
+    try:
+        for file_path, file_data in files:
+            opened_files.append(open(file_path, "wb"))
+            opened_files[-1].write(file_data)
+        if FSYNC_WEBSITES:
+            for opened_file in opened_files:
+                opened_file.flush()
+                os.fsync(opened_file.fileno())
+    finally:
+        for opened_file in opened_files:
+            opened_file.close()
+
+
+def json_to_folder(folder_json, folder_path):
+    '''
+    This function converts the given json-formatted data to a folder and saves it in folder_path
+    (a staging folder - the name of the folder in the data is used when it's moved into place).
     The format is:
         {
             "type" : "folder",
@@ -55,33 +840,49 @@ def json_to_folder(folder_json, relative_path=''):
                 ...
             ] 
         }
+    The folders are created first, and then the files are written by WRITER_WORKERS threads,
+    in batches of up to WRITE_BATCH_FILES files (or WRITE_BATCH_SIZE bytes) that are synced to the disk together.
     '''
+    folder_paths = []
+    files = []
 
-    # Prepare the relative_path for a recursive call or a entry saving
-    relative_path += os.path.basename(folder_json['name']) + '/'
+    # Create the folders, and collect the files that should be written
+    folders_to_create = [(folder_json, folder_path)]
+    while folders_to_create:
+        current_json, current_path = folders_to_create.pop()
+        os.mkdir(current_path)
+        folder_paths.append(current_path)
 
-    # Create directory for the folder
-    print('%s: Creating...' % (relative_path))
-    try:
-        os.mkdir(relative_path)
-    except:
-        # The folder already exists, let the client know that he should rename it
-        return 'RENAME'
-
-    # Wait until the system creates the folder        
-    while not os.path.exists(relative_path):
-        pass
-    print('%s: Created!' % (relative_path))
-
-    # For each entry in the folder's entry-list
-    for entry in folder_json['entries']:
-        if entry['type'] == 'file':
-            # Write the data to the file
-            open(relative_path + entry['name'], "wb").write(entry['data'])
-        elif entry['type'] == 'folder':
-            # Convert the json to a folder recursively
-            json_to_folder(entry, relative_path)
-    return 'DONE'
+        # For each entry in the folder's entry-list
+        for entry in current_json['entries']:
+            # Make sure that the name is a plain name, so nothing is written outside of the website folder
+            if not is_valid_entry_name(entry['name']):
+                raise ValueError('Invalid entry name: %r' % (entry['name']))
+            entry_path = os.path.join(current_path, entry['name'])
+            if entry['type'] == 'file':
+                files.append((entry_path, entry['data']))
+            elif entry['type'] == 'folder':
+                folders_to_create.append((entry, entry_path))
+
+    # Split the files to batches, and write them in parallel
+    batches = [[]]
+    batch_size = 0
+    for file_path, file_data in files:
+        if len(batches[-1]) >= WRITE_BATCH_FILES or batch_size >= WRITE_BATCH_SIZE:
+            batches.append([])
+            batch_size = 0
+        batches[-1].append((file_path, file_data))
+        batch_size += len(file_data)
+
+    with ThreadPoolExecutor(max_workers=WRITER_WORKERS) as executor:
+        for written_batch in [executor.submit(write_files, batch) for batch in batches]:
+            # Raise the error of a batch that failed
+            written_batch.result()
+
+    # Make sure that the folders' entries are on the disk too
+    for current_path in folder_paths:
+        sync_folder(current_path)
+    print('%s: Wrote %d files in %d folders' % (folder_path, len(files), len(folder_paths)))
 
 
 def handle_client(client_socket, client_addr):
@@ -91,8 +892,16 @@ def handle_client(client_socket, client_addr):
 
     print('%s: Connected!' % (str(client_addr)))
 
-    # Get the serialized data *length* from the client
-    data_length = int(client_socket.recv(CHUNK_SIZE).decode())
+    # Get the serialized data *length* from the client,
+    # or a request to send a streaming archive (like 'STREAM:1')
+    request = client_socket.recv(CHUNK_SIZE).decode()
+    if request.startswith('STREAM:'):
+        handle_streaming_upload(client_socket, client_addr, request)
+        return None
+    if request.startswith('SYNC:'):
+        handle_sync_upload(client_socket, client_addr, request)
+        return None
+    data_length = int(request)
 
     # Agree or deny to receive the data
     if data_length > 0:
@@ -112,13 +921,131 @@ def handle_client(client_socket, client_addr):
     website_folder_json = pickle.loads(serialized_data)
 
     print('%s: Creating folder...' % (str(client_addr)))
-    
-    # Save the folder and make sure that it has an unique name
-    while json_to_folder(website_folder_json, websites_folder) == 'RENAME':
-        client_socket.send(b'RENAME')
-        new_name = client_socket.recv(CHUNK_SIZE).decode().split(':')[1]
-        website_folder_json['name'] = os.path.basename(new_name)
-    
+
+    # Write the website to a staging folder, so it's never seen half-written
+    staging_path = websites_folder + STAGING_FOLDER_PREFIX + secrets.token_hex(8)
+    try:
+        json_to_folder(website_folder_json, staging_path)
+
+        # Move the folder into place and make sure that it has an unique name
+        if not move_website_or_rename(client_socket, client_addr, staging_path,
+                                      os.path.basename(website_folder_json['name'])):
+            client_socket.close()
+            return None
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print('%s: Failed saving the website: %s' % (str(client_addr), e))
+        client_socket.close()
+        return None
+    finally:
+        # Remove whatever is left of the staging folder (nothing, once it was moved into place)
+        shutil.rmtree(staging_path, ignore_errors=True)
+
+    # End the client serving
+    client_socket.send(b'DONE')
+    print('Finished serving %s' % (str(client_addr)))
+
+
+def handle_streaming_upload(client_socket, client_addr, request):
+    '''
+    This function receives a website in the streaming archive format and saves it.
+    '''
+
+    # Agree or deny to receive the archive, by its version
+    version = request.split(':')[1]
+    if not version.isdigit() or int(version) not in STREAM_PROTOCOL_VERSIONS:
+        print('%s: DENIED (streaming version %s)' % (str(client_addr), version))
+        client_socket.send(b'DENIED')
+        return None
+    compression = negotiate_compression(request)
+    cipher = negotiate_cipher(request)
+    print('%s: OK (streaming version %s, compression: %s, cipher: %s)' % (str(client_addr), version, compression, cipher))
+    client_socket.send(get_agreement(request, compression, cipher))
+
+    # Write the website to a staging folder while it arrives,
+    # its name is checked once it's complete (the client answers RENAME only after sending everything)
+    print('%s: Recieving and writing the archive...' % (str(client_addr)))
+    staging_path = websites_folder + STAGING_FOLDER_PREFIX + secrets.token_hex(8)
+    try:
+        website_name = recv_streaming_archive(client_socket, staging_path, compression, cipher)
+
+        print('%s: Moving folder into place...' % (str(client_addr)))
+
+        # Move the folder into place and make sure that it has an unique name
+        if not move_website_or_rename(client_socket, client_addr, staging_path, website_name):
+            client_socket.close()
+            return None
+    except (OSError, ValueError) as e:
+        print('%s: Failed saving the archive: %s' % (str(client_addr), e))
+        client_socket.close()
+        return None
+    finally:
+        # Remove whatever is left of the staging folder (nothing, once it was moved into place)
+        shutil.rmtree(staging_path, ignore_errors=True)
+
+    # End the client serving
+    client_socket.send(b'DONE')
+    print('Finished serving %s' % (str(client_addr)))
+
+
+def handle_sync_upload(client_socket, client_addr, request):
+    '''
+    This function syncs a website with the client: the client sends a manifest of its files' hashes,
+    and only the files that the current version of the website doesn't have are received.
+    The new version is built in a staging folder, and then replaces the current version.
+    '''
+
+    # Agree or deny to sync, by the protocol's version
+    version = request.split(':')[1]
+    if not version.isdigit() or int(version) not in SYNC_PROTOCOL_VERSIONS:
+        print('%s: DENIED (sync version %s)' % (str(client_addr), version))
+        client_socket.send(b'DENIED')
+        return None
+    compression = negotiate_compression(request)
+    cipher = negotiate_cipher(request)
+    print('%s: OK (sync version %s, compression: %s, cipher: %s)' % (str(client_addr), version, compression, cipher))
+    client_socket.send(get_agreement(request, compression, cipher))
+
+    staging_path = websites_folder + STAGING_FOLDER_PREFIX + secrets.token_hex(8)
+    try:
+        website_name, folders, files = recv_manifest(client_socket, cipher)
+        website_path = websites_folder + website_name
+
+        # Answer with the hashes that are missing from the current version of the website
+        with get_website_lock(website_name):
+            existing_files = hash_website_files(website_path, load_file_hashes(website_name))
+        missing_hashes = sorted(set(file_hash for _, file_hash, _ in files) - existing_files.keys())
+        print('%s: %s: %d/%d files are missing' % (str(client_addr), website_name, len(missing_hashes), len(files)))
+        missing_data = json.dumps(missing_hashes).encode()
+        client_socket.sendall(len(missing_data).to_bytes(4, byteorder="big") + missing_data)
+
+        # Receive the missing files, then build the new version and swap it into place
+        blobs_path = os.path.join(staging_path, 'blobs')
+        os.makedirs(blobs_path)
+        blob_writer = BlobWriter(blobs_path, missing_hashes, compression)
+        try:
+            recv_encrypted_stream(client_socket, blob_writer.feed, cipher)
+            if not blob_writer.ended:
+                raise ValueError('The blobs stream ended unexpectedly')
+        finally:
+            blob_writer.close()
+
+        # Another sync may have replaced the current version while the files were received,
+        # so it's hashed again (only its changed files are read) - and nothing replaces it until the
+        # new version is built from it and swapped into place
+        print('%s: %s: Swapping the new version into place...' % (str(client_addr), website_name))
+        site_path = os.path.join(staging_path, 'site')
+        with get_website_lock(website_name):
+            existing_files = hash_website_files(website_path, load_file_hashes(website_name))
+            file_hashes = build_synced_website(site_path, folders, files, existing_files, blobs_path)
+            publish_website(site_path, website_path, os.path.join(staging_path, 'old'), file_hashes)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print('%s: Failed syncing the website: %s' % (str(client_addr), e))
+        client_socket.close()
+        return None
+    finally:
+        # Remove the blobs and the previous version of the website
+        shutil.rmtree(staging_path, ignore_errors=True)
+
     # End the client serving
     client_socket.send(b'DONE')
     print('Finished serving %s' % (str(client_addr)))
@@ -7,6 +7,20 @@ from Cryptodome.Cipher import AES
 from Cryptodome.Util.Padding import pad
 import threading
 import time
+import tempfile
+import shutil
+import hashlib
+import json
+import mimetypes
+import zlib
+import lzma
+import select
+import struct
+import ctypes
+import ctypes.util
+import secrets
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 AES_ENCRYPTION_KEY = b"N44vCTcb<W8sBXD@"
 AES_BLOCKSIZE = 16
@@ -17,9 +31,88 @@ IP_PATTERN = r'^((1[0-9]{2}|2[0-4][0-9]|25[0-5]|[0-9]{1,2})\.){3}(1[0-9]{2}|2[0-
 SERVER_PORT = 1337
 CHUNK_SIZE = 16384
 
+# Streaming uploads settings
+STREAM_UPLOADS = True           # Send the websites in the streaming archive format (instead of one pickled buffer)
+STREAM_PROTOCOL_VERSION = 1
+
+# The records of the streaming archive
+RECORD_FOLDER = b'D'            # Start of a folder: name length (2 bytes) + name, then its entries
+RECORD_FOLDER_END = b'U'        # End of the current folder
+RECORD_FILE = b'F'              # A file: name length (2 bytes) + name, then its data chunks -
+                                # each chunk is its length (4 bytes) + data, and an empty chunk ends the file
+RECORD_COMPRESSED_FILE = b'C'   # Like a file record, but its data is compressed (with the negotiated method)
+RECORD_END = b'E'               # End of the archive
+
+# Compression settings - the files are compressed (one by one) before they're encrypted,
+# with the first method that the server supports
+COMPRESSION_METHODS = ['zlib', 'lzma']          # Offered to the servers, ordered by preference (empty to disable)
+COMPRESSION_LEVELS = {'zlib' : 6, 'lzma' : 6}   # zlib level (1 - 9) / lzma preset (0 - 9)
+COMPRESSION_MIN_SIZE = 256                      # Smaller files aren't worth compressing
+# Content types that are already compressed (except the ones in COMPRESSIBLE_MEDIA_TYPES)
+INCOMPRESSIBLE_CONTENT_TYPES = ['image/', 'audio/', 'video/', 'font/woff', 'application/zip',
+                                'application/x-7z-compressed', 'application/vnd.rar', 'application/pdf']
+COMPRESSIBLE_MEDIA_TYPES = ['image/svg+xml', 'image/bmp', 'image/vnd.microsoft.icon']
+
+# Encryption settings of the streaming archive and the sync (the legacy format is always one AES-CBC buffer)
+CIPHER_AES_CBC = 'aes-cbc'      # One AES-CBC stream - serial, and can only be checked as a whole
+CIPHER_AES_GCM = 'aes-gcm'      # Independent AES-GCM chunks - encrypted in parallel, and authenticated one by one
+CIPHERS = [CIPHER_AES_GCM, CIPHER_AES_CBC]  # Offered to the servers, ordered by preference
+GCM_CHUNK_SIZE = 256 * 1024     # Amount of data in every AES-GCM chunk (in bytes)
+GCM_NONCE_PREFIX_SIZE = 8       # The nonce of a chunk is a random prefix (per stream) + the chunk's index (4 bytes)
+CRYPTO_WORKERS = os.cpu_count() or 1    # Amount of threads that encrypt chunks at the same time
+
+# Sync settings - in sync mode a website is updated in place on the servers (instead of being renamed
+# when its name is taken), and only the files that the server doesn't have yet are sent
+SYNC_MODE = False
+SYNC_PROTOCOL_VERSION = 1
+
+# Folder scanning settings
+SCAN_READ_WORKERS = 8           # Amount of threads that read files at the same time
+SCAN_READ_AHEAD = 16            # Max amount of batches that are scanned (and read) ahead of the one that's used
+READ_BATCH_ENTRIES = 32         # Max amount of entries in a batch (its files are read by a thread in one go)
+READ_BATCH_SIZE = 1024 * 1024   # A batch ends once its files reach this size (in bytes)
+READ_AHEAD_MAX_FILE_SIZE = 256 * 1024   # When streaming, bigger files are read in chunks while they're sent
+
+# Fan-out settings
+UPLOAD_PARALLELISM = 8          # Max amount of servers that a website is uploaded to at the same time
+UPLOAD_RETRIES = 3              # Times to retry an upload to a server that failed
+UPLOAD_RETRY_BACKOFF = 1        # Seconds to wait before the first retry (doubled on every retry)
+UPLOAD_TIMEOUT = 60             # Seconds to wait for a server (connecting, sending or receiving)
+PROGRESS_REPORT_SIZE = 4 * 1024 * 1024  # The progress of an upload is printed every time this many bytes are sent
+SPOOL_FOLDER = None             # Folder of the spool files of the encoded websites (None for the system's temp folder)
+SPOOL_FOLDER_PREFIX = 'upload-spool-'   # Every upload spools its encoded website into its own temporary folder
+
+# Websites folder watching settings
+USE_INOTIFY = True              # Watch the websites folder with inotify (Linux), instead of scanning it
+WATCH_POLL_INTERVAL = 1         # Seconds between scans of the websites folder (when inotify isn't used)
+QUIESCENCE_PERIOD = 2           # A new website is uploaded once its files haven't changed for this many seconds
+INOTIFY_READ_SIZE = 64 * 1024
+
+# inotify constants (see inotify(7))
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct('iIII')   # Watch descriptor, mask, cookie, name length (then the name)
+WEBSITES_FOLDER_MASK = IN_CREATE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM | IN_ONLYDIR
+WEBSITE_CHANGES_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_CREATE | IN_DELETE |
+                        IN_MOVED_FROM | IN_MOVED_TO | IN_ONLYDIR)
+
 websites = []
 server_ips = []
 
+# Only one upload at a time may ask the user for a new name
+input_lock = threading.Lock()
+
 def validate_args():
     '''
     This function validates the sys.argv arguments that the user gave to the program.
@@ -58,6 +151,95 @@ def validate_args():
     return True
 
 
+def scan_tree(folder_path):
+    '''
+    This function walks the given folder with os.scandir (the type of every entry is taken from the directory
+    listing, so there's no extra stat per entry), and yields its entries in a deterministic (sorted) order:
+        (RECORD_FOLDER, name, path, 0)
+            (RECORD_FILE, name, path, size)
+            (RECORD_FOLDER, name, path, 0) ... (RECORD_FOLDER_END, None, None, 0)
+            ...
+        (RECORD_FOLDER_END, None, None, 0)
+    '''
+    yield RECORD_FOLDER, os.path.basename(folder_path), folder_path, 0
+
+    with os.scandir(folder_path) as entries:
+        entries = sorted(entries, key=lambda entry: entry.name)
+    for entry in entries:
+        if entry.is_file():
+            yield RECORD_FILE, entry.name, entry.path, entry.stat().st_size
+        elif entry.is_dir():
+            yield from scan_tree(entry.path)
+    yield RECORD_FOLDER_END, None, None, 0
+
+
+def read_files(file_paths):
+    '''
+    This function returns the data of the given files (a batch), as a list.
+    '''
+    files_data = []
+    for file_path in file_paths:
+        with open(file_path, "rb") as website_file:
+            files_data.append(website_file.read())
+    return files_data
+
+
+def scan_website(folder_path, read_ahead_max_size=None):
+    '''
+    This function scans a website folder (see scan_tree), and yields its entries in order with the data of
+    their files: (entry type, name, path, size, data).
+    The entries are split into batches of up to READ_BATCH_ENTRIES entries (or READ_BATCH_SIZE bytes), and the files
+    of every batch are read by one of SCAN_READ_WORKERS threads, up to SCAN_READ_AHEAD batches ahead of the one
+    that's used (a thread per file would cost more than reading a small file).
+    Files that are bigger than read_ahead_max_size aren't read (their data is None), so they can be streamed.
+    The throughput of the scan is printed when it ends.
+    '''
+    start_time = time.perf_counter()
+    files_count = 0
+    total_size = 0
+    batches = deque()           # (entries, indexes of the read files, the data of these files) of every batch
+    batch_entries = []
+    read_indexes = []           # The indexes of the files of the current batch that are read
+    batch_size = 0
+
+    def read_batch(executor, entries, read_indexes):
+        # Start reading the files of a batch
+        return entries, read_indexes, executor.submit(read_files, [entries[index][2] for index in read_indexes])
+
+    def use_batch(entries, read_indexes, files_data):
+        # Yield the entries of a batch, with the data of their files
+        files_data = dict(zip(read_indexes, files_data.result()))
+        for index, (entry_type, name, path, size) in enumerate(entries):
+            yield entry_type, name, path, size, files_data.get(index)
+
+    with ThreadPoolExecutor(max_workers=SCAN_READ_WORKERS) as executor:
+        for entry_type, name, path, size in scan_tree(os.path.abspath(folder_path)):
+            if entry_type == RECORD_FILE:
+                files_count += 1
+                total_size += size
+                if read_ahead_max_size is None or size <= read_ahead_max_size:
+                    read_indexes.append(len(batch_entries))
+                    batch_size += size
+            batch_entries.append((entry_type, name, path, size))
+
+            # Start reading the files of the batch once it's full
+            if len(batch_entries) >= READ_BATCH_ENTRIES or batch_size >= READ_BATCH_SIZE:
+                batches.append(read_batch(executor, batch_entries, read_indexes))
+                batch_entries, read_indexes, batch_size = [], [], 0
+
+            # Use the batches in order, while the next ones are read
+            while len(batches) > SCAN_READ_AHEAD:
+                yield from use_batch(*batches.popleft())
+
+        batches.append(read_batch(executor, batch_entries, read_indexes))
+        while batches:
+            yield from use_batch(*batches.popleft())
+
+    elapsed_time = max(time.perf_counter() - start_time, 1e-6)
+    print(f'{folder_path}: Scanned {files_count} files ({total_size} bytes) in {elapsed_time:.2f}s '
+          f'({files_count / elapsed_time:.0f} files/s, {total_size / elapsed_time / (1024 * 1024):.1f} MB/s)')
+
+
 def folder_to_json(folder_path):
     '''
     This function converts the data in a given folder to json format.
@@ -80,51 +262,588 @@ def folder_to_json(folder_path):
             ] 
         }
     '''
-    
+
     print(folder_path)
 
-    # Make sure that the folder path is in valid format
-    folder_path = os.path.abspath(folder_path)
-    
-    # Initialize the folder dictionary
-    folder_json = {'type' : 'folder', 'name' : os.path.basename(folder_path)}
-    folder_json['entries'] = []
-    
-    # For each entry in the current folder
-    for entry in os.listdir(folder_path):
-        entry_full_path = folder_path + '/' + entry
-        
-        # If the entry is a file, save the file's name and data in dictionary
-        if os.path.isfile(entry_full_path):
-            file_json = {'type' : 'file', 'name': entry}
-            file_data = open(entry_full_path, "rb").read()
-            file_json['data'] = file_data
-            # Add the file dictionary to the entries of the current folder
-            folder_json['entries'].append(file_json)
-        
-        # If the entry is a folder, get the folder's dictionary recursively, and add it
-        elif os.path.isdir(entry_full_path):
-            folder_json['entries'].append(folder_to_json(entry_full_path))
+    # The dictionaries of the folders that are being filled, from the website folder to the current one
+    folder_stack = []
+
+    # For each entry in the folder (in order, with the data of the files already read)
+    for entry_type, name, _, _, file_data in scan_website(folder_path):
+        if entry_type == RECORD_FOLDER:
+            # Initialize the folder dictionary, and add it to its parent folder
+            folder_json = {'type' : 'folder', 'name' : name, 'entries' : []}
+            if folder_stack:
+                folder_stack[-1]['entries'].append(folder_json)
+            folder_stack.append(folder_json)
+        elif entry_type == RECORD_FILE:
+            # Save the file's name and data in dictionary, and add it to the entries of the current folder
+            folder_stack[-1]['entries'].append({'type' : 'file', 'name' : name, 'data' : file_data})
+        else:
+            folder_json = folder_stack.pop()
     return folder_json
 
 
-def send_data_in_chunks(sock, data, chunk_size):
+def encode_name_record(record_type, name):
     '''
-    This function sends the given data in chunks of size chunk_size using the given socket.
+    This function returns a record of the streaming archive that starts with a name (a folder or a file).
     '''
-    
-    # Encrypt the data
-    encrypted_data = encrypt_data(data)
-    data_length = len(encrypted_data)
-    
-    print('Data length: %d' % (data_length))
+    encoded_name = name.encode()
+    return record_type + len(encoded_name).to_bytes(2, byteorder="big") + encoded_name
+
+
+def is_compressible(file_path, file_size):
+    '''
+    This function returns True if the given file is worth compressing (it isn't tiny or already compressed).
+    '''
+    if file_size < COMPRESSION_MIN_SIZE:
+        return False
+    content_type, encoding = mimetypes.guess_type(file_path)
+    if encoding is not None:
+        # Like '.gz' or '.xz'
+        return False
+    if content_type is None or content_type in COMPRESSIBLE_MEDIA_TYPES:
+        return True
+    return not content_type.startswith(tuple(INCOMPRESSIBLE_CONTENT_TYPES))
+
+
+def new_compressor(compression):
+    '''
+    This function returns a compressor object of the given compression method.
+    '''
+    if compression == 'zlib':
+        return zlib.compressobj(COMPRESSION_LEVELS['zlib'])
+    if compression == 'lzma':
+        return lzma.LZMACompressor(preset=COMPRESSION_LEVELS['lzma'])
+    raise ValueError(f'Unknown compression method: {compression}')
+
+
+def read_file_chunks(file_path, file_data=None):
+    '''
+    This function yields the data of a file in chunks of CHUNK_SIZE.
+    The file is read while the chunks are used, unless its data was already read.
+    '''
+    if file_data is not None:
+        file_view = memoryview(file_data)
+        for i in range(0, len(file_view), CHUNK_SIZE):
+            yield file_view[i:i + CHUNK_SIZE]
+        return
+
+    with open(file_path, "rb") as entry_file:
+        while True:
+            chunk = entry_file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+def file_chunk_records(file_path, compressor=None, file_data=None):
+    '''
+    This function yields the data chunks of a file: length (4 bytes) + data each, and an empty chunk at the end.
+    The file is read in chunks of CHUNK_SIZE (unless its data was already read),
+    and compressed on the way if a compressor is given.
+    '''
+    for chunk in read_file_chunks(file_path, file_data):
+        if compressor is not None:
+            chunk = compressor.compress(chunk)
+            # The compressor may keep the data until it has enough of it (an empty chunk would end the file)
+            if not chunk:
+                continue
+        yield len(chunk).to_bytes(4, byteorder="big")
+        yield chunk
+    if compressor is not None:
+        chunk = compressor.flush()
+        if chunk:
+            yield len(chunk).to_bytes(4, byteorder="big")
+            yield chunk
+    yield (0).to_bytes(4, byteorder="big")
+
+
+def file_records(file_path, file_size, file_record, compression, file_data=None):
+    '''
+    This function yields the record type of a file (plain or compressed), then its data chunks.
+    A file is compressed if a compression method was negotiated and the file is compressible.
+    '''
+    if compression is not None and is_compressible(file_path, file_size):
+        yield file_record(RECORD_COMPRESSED_FILE)
+        yield from file_chunk_records(file_path, new_compressor(compression), file_data)
+    else:
+        yield file_record(RECORD_FILE)
+        yield from file_chunk_records(file_path, None, file_data)
+
+
+def walk_folder_records(folder_path, compression=None):
+    '''
+    This function walks the given folder lazily, and yields the records of the streaming archive:
+        D <folder name>
+            F <file name> <chunk> <chunk> ... <empty chunk>
+            C <file name> <compressed chunk> ... <empty chunk>
+            D <sub-folder name> ... U
+            ...
+        U
+    Small files are read ahead in parallel (see scan_website), and bigger files are read in chunks of
+    CHUNK_SIZE while they are sent, so only one of their chunks is in memory.
+    '''
+
+    # For each entry in the folder, in order
+    for entry_type, name, path, size, file_data in scan_website(folder_path, READ_AHEAD_MAX_FILE_SIZE):
+        if entry_type == RECORD_FILE:
+            # Send the file's name and then its data in chunks
+            yield from file_records(path, size, lambda record_type: encode_name_record(record_type, name),
+                                    compression, file_data)
+        elif entry_type == RECORD_FOLDER:
+            yield encode_name_record(RECORD_FOLDER, name)
+        else:
+            yield RECORD_FOLDER_END
+
+
+def archive_records(folder_path, compression=None):
+    '''
+    This function yields all the records of the streaming archive of the given folder.
+    '''
+    yield from walk_folder_records(folder_path, compression)
+    yield RECORD_END
+
+
+def build_manifest(folder_path):
+    '''
+    This function returns the manifest of a website for syncing it, and the paths of its files by their hashes.
+    The format is:
+        {
+            "name" : "the name of the website",
+            "folders" : ["a", "a/b", ...],
+            "files" : [["a/b/file name", "sha256 hash of the file", size], ...]
+        }
+    '''
+    folder_path = os.path.abspath(folder_path)
+    manifest = {'name' : os.path.basename(folder_path), 'folders' : [], 'files' : []}
+    file_paths = {}
+
+    for current_folder, folder_names, file_names in os.walk(folder_path):
+        folder_names.sort()
+        relative_folder = os.path.relpath(current_folder, folder_path).replace(os.sep, '/')
+        relative_prefix = '' if relative_folder == '.' else relative_folder + '/'
+        manifest['folders'].extend(relative_prefix + folder_name for folder_name in folder_names)
+
+        for file_name in sorted(file_names):
+            file_path = os.path.join(current_folder, file_name)
+            file_hash = hashlib.sha256()
+            with open(file_path, "rb") as website_file:
+                for chunk in iter(lambda: website_file.read(CHUNK_SIZE), b''):
+                    file_hash.update(chunk)
+            file_hash = file_hash.hexdigest()
+            manifest['files'].append([relative_prefix + file_name, file_hash, os.path.getsize(file_path)])
+            file_paths[file_hash] = file_path
+    return manifest, file_paths
+
+
+def blob_records(file_hashes, file_paths, compression=None):
+    '''
+    This function yields the contents of the files with the given hashes, one after the other:
+    each file in chunks of length (4 bytes) + data, and an empty chunk at its end.
+    If a compression method was negotiated, every file starts with its record type (plain or compressed).
+    '''
+    for file_hash in file_hashes:
+        file_path = file_paths[file_hash]
+        if compression is None:
+            yield from file_chunk_records(file_path)
+        else:
+            yield from file_records(file_path, os.path.getsize(file_path), lambda record_type: record_type, compression)
+
+
+def encrypt_stream(data_pieces, cipher=CIPHER_AES_CBC):
+    '''
+    This function encrypts the given data pieces as they come (as one AES-CBC stream, padded at its end),
+    and yields the encrypted data in frames: length (4 bytes) + encrypted data, and an empty frame at the end.
+    At most about CHUNK_SIZE bytes are waiting to be encrypted at any time.
+    With AES-GCM the stream is encrypted in parallel chunks instead (see encrypt_stream_gcm).
+    '''
+    if cipher == CIPHER_AES_GCM:
+        yield from encrypt_stream_gcm(data_pieces)
+        return
+
+    AES_encryptor = AES.new(AES_ENCRYPTION_KEY, AES.MODE_CBC, AES_IV)
+    pending_data = bytearray()
+
+    for data_piece in data_pieces:
+        pending_data += data_piece
+        if len(pending_data) >= CHUNK_SIZE:
+            # Encrypt whole blocks only, the rest waits for the next pieces
+            blocks_length = len(pending_data) - len(pending_data) % AES_BLOCKSIZE
+            encrypted_data = AES_encryptor.encrypt(pending_data[:blocks_length])
+            del pending_data[:blocks_length]
+            yield len(encrypted_data).to_bytes(4, byteorder="big") + encrypted_data
+
+    # Pad and encrypt the last piece, then end the stream
+    encrypted_data = AES_encryptor.encrypt(pad(bytes(pending_data), AES_BLOCKSIZE))
+    yield len(encrypted_data).to_bytes(4, byteorder="big") + encrypted_data
+    yield (0).to_bytes(4, byteorder="big")
+
+
+def encrypt_chunk_gcm(nonce_prefix, index, chunk, final=False):
+    '''
+    This function encrypts a single chunk of an AES-GCM stream, and returns its frame:
+    length (4 bytes) + final flag (1 byte) + encrypted data + tag (16 bytes).
+    The chunk's index and final flag are authenticated with it, so chunks can't be reordered, dropped or cut.
+    '''
+    final_flag = b'\x01' if final else b'\x00'
+    AES_encryptor = AES.new(AES_ENCRYPTION_KEY, AES.MODE_GCM, nonce=nonce_prefix + index.to_bytes(4, byteorder="big"))
+    AES_encryptor.update(index.to_bytes(4, byteorder="big") + final_flag)
+    encrypted_data, tag = AES_encryptor.encrypt_and_digest(chunk)
+    frame_length = 1 + len(encrypted_data) + len(tag)
+    return b''.join([frame_length.to_bytes(4, byteorder="big"), final_flag, encrypted_data, tag])
+
+
+def encrypt_stream_gcm(data_pieces):
+    '''
+    This function encrypts the given data pieces as they come, in independent AES-GCM chunks of GCM_CHUNK_SIZE
+    that are encrypted in parallel by CRYPTO_WORKERS threads, and yields the frames of the chunks in order:
+        <nonce prefix frame> <chunk frame> ... <final (empty) chunk frame> <empty frame>
+    At most CRYPTO_WORKERS * 2 chunks are being encrypted (or waiting to be sent) at any time.
+    '''
+    nonce_prefix = secrets.token_bytes(GCM_NONCE_PREFIX_SIZE)
+    yield len(nonce_prefix).to_bytes(4, byteorder="big") + nonce_prefix
+
+    pending_data = bytearray()
+    encrypted_chunks = deque()
+    index = 0
+    with ThreadPoolExecutor(max_workers=CRYPTO_WORKERS) as executor:
+        for data_piece in data_pieces:
+            pending_data += data_piece
+            while len(pending_data) >= GCM_CHUNK_SIZE:
+                chunk = bytes(pending_data[:GCM_CHUNK_SIZE])
+                del pending_data[:GCM_CHUNK_SIZE]
+                encrypted_chunks.append(executor.submit(encrypt_chunk_gcm, nonce_prefix, index, chunk))
+                index += 1
+
+                # Send the encrypted chunks in order, and don't let too many chunks wait
+                while len(encrypted_chunks) >= CRYPTO_WORKERS * 2:
+                    yield encrypted_chunks.popleft().result()
+
+        # Encrypt the rest of the data, then mark the end of the stream with an empty final chunk
+        if pending_data:
+            encrypted_chunks.append(executor.submit(encrypt_chunk_gcm, nonce_prefix, index, bytes(pending_data)))
+            index += 1
+        encrypted_chunks.append(executor.submit(encrypt_chunk_gcm, nonce_prefix, index, b'', True))
+        while encrypted_chunks:
+            yield encrypted_chunks.popleft().result()
+    yield (0).to_bytes(4, byteorder="big")
+
+
+class EncodingError(Exception):
+    '''
+    Raised when a website couldn't be encoded (like when one of its files can't be read).
+    It fails the upload to every server that needs the payload, and it isn't retried.
+    '''
+
+
+class WebsitePayload:
+    '''
+    A single encoded (and encrypted) payload of a website, of one compression method and cipher.
+    The website is encoded by a background thread into a spool file, and the servers are sent the payload from
+    the spool while it's still being filled: every server gets the frames as soon as they're encoded, at its
+    own pace (a slow server doesn't hold back the others), and a retry sends the payload again from the spool
+    instead of encoding the website again.
+    The whole encoded website stays in the spool until the upload ends - SPOOL_FOLDER can point the spools
+    at a disk if the system's temp folder is a tmpfs (the spools shouldn't take the machine's memory).
+    '''
+
+    def __init__(self, website_folder_path, spool_folder_path, compression=None, cipher=CIPHER_AES_CBC):
+        try:
+            spool_fd, self.path = tempfile.mkstemp(prefix=f'{compression or "none"}-{cipher}-', dir=spool_folder_path)
+        except OSError as e:
+            raise EncodingError(f'Failed creating the spool file: {e}') from e
+        self.size = 0                   # The amount of bytes in the spool so far
+        self.finished = False           # Whether the whole payload is in the spool
+        self.serialized_length = None   # The length of the serialized data (only in the legacy format)
+        self.error = None               # The exception that stopped the encoding
+        self._cancelled = False
+        self._condition = threading.Condition()
+        self._encoder = threading.Thread(target=self._encode,
+                                         args=(spool_fd, website_folder_path, compression, cipher), daemon=True)
+        self._encoder.start()
+
+    def wait_for_data(self, offset):
+        '''
+        Waits until the spool has data after the given offset, or until the whole payload is in it.
+        Returns the amount of bytes in the spool. Raises EncodingError if the encoding failed.
+        '''
+        with self._condition:
+            while self.size <= offset and not self.finished:
+                self._condition.wait()
+            if self.error is not None:
+                raise EncodingError(str(self.error) or type(self.error).__name__) from self.error
+            return self.size
+
+    def stop(self):
+        '''
+        Stops the encoding (if it's still running).
+        '''
+        self._cancelled = True
+        self._encoder.join()
+
+    def _encode(self, spool_fd, website_folder_path, compression, cipher):
+        try:
+            with os.fdopen(spool_fd, 'wb') as spool_file:
+                if STREAM_UPLOADS:
+                    # Walk the folder and encrypt it while it's being read, only the encrypted stream is kept
+                    for frame in encrypt_stream(archive_records(website_folder_path, compression), cipher):
+                        if self._cancelled:
+                            return
+                        self._append(spool_file, frame)
+                else:
+                    # Convert the given folder to dictionary (json format), and serialize it
+                    serialized_data = pickle.dumps(folder_to_json(website_folder_path))
+                    self.serialized_length = len(serialized_data)
+                    self._append(spool_file, encrypt_data(serialized_data))
+        except Exception as e:
+            self.error = e
+        finally:
+            with self._condition:
+                self.finished = True
+                self._condition.notify_all()
+
+    def _append(self, spool_file, data):
+        # The data must be in the file before the senders are told about it
+        spool_file.write(data)
+        spool_file.flush()
+        with self._condition:
+            self.size += len(data)
+            self._condition.notify_all()
+
+
+class WebsitePayloads:
+    '''
+    The encoded payloads of a website, by their compression method and cipher.
+    Every payload is encoded once - starting when the first server that needs it asks for it,
+    and it's shared between all the servers (usually all of them negotiate the same methods).
+    Payloads of different methods are encoded at the same time (each by its own thread).
+    The spool files are kept in a temporary folder of their own, which is created with the first payload.
+    '''
+
+    def __init__(self, website_folder_path):
+        self.website_folder_path = website_folder_path
+        self.spool_folder_path = None
+        self._payloads = {}     # {(compression method, cipher) : WebsitePayload}
+        self._lock = threading.Lock()
+
+    def get(self, compression=None, cipher=CIPHER_AES_CBC):
+        '''
+        Returns the payload of the given compression method and cipher (it may still be encoded).
+        Raises EncodingError if its spool can't be created.
+        '''
+        with self._lock:
+            if self.spool_folder_path is None:
+                try:
+                    self.spool_folder_path = tempfile.mkdtemp(prefix=SPOOL_FOLDER_PREFIX, dir=SPOOL_FOLDER)
+                except OSError as e:
+                    raise EncodingError(f'Failed creating the spool folder: {e}') from e
+            if (compression, cipher) not in self._payloads:
+                self._payloads[compression, cipher] = WebsitePayload(self.website_folder_path, self.spool_folder_path,
+                                                                     compression, cipher)
+            return self._payloads[compression, cipher]
+
+    def check_encoding(self):
+        '''
+        Raises EncodingError if the encoding of any of the payloads failed - the website can't be read,
+        so there's no point in connecting to the servers that are left.
+        '''
+        with self._lock:
+            for payload in self._payloads.values():
+                if payload.error is not None:
+                    raise EncodingError(str(payload.error) or type(payload.error).__name__) from payload.error
+
+    def remove_all(self):
+        '''
+        Stops the encoding of all the payloads, and removes their spool files.
+        '''
+        with self._lock:
+            try:
+                for payload in self._payloads.values():
+                    payload.stop()
+            finally:
+                self._payloads.clear()
+                if self.spool_folder_path is not None:
+                    shutil.rmtree(self.spool_folder_path, ignore_errors=True)
+                    self.spool_folder_path = None
+
+
+def get_handshake(request_type, version):
+    '''
+    This function returns a request to a server, with the compression methods and the ciphers that are
+    offered to it (like 'STREAM:1:zlib,lzma:aes-gcm,aes-cbc').
+    '''
+    return f'{request_type}:{version}:{",".join(COMPRESSION_METHODS)}:{",".join(CIPHERS)}'.encode()
+
+
+def parse_agreement(agreement):
+    '''
+    This function returns whether a server agreed to a request ('OK' or 'OK:<compression method>:<cipher>'),
+    the compression method that it picked (None for no compression) and the cipher that it picked
+    (servers that don't know about ciphers answer without one, and use AES-CBC).
+    '''
+    if agreement == b'OK':
+        return True, None, CIPHER_AES_CBC
+    if not agreement.startswith(b'OK:'):
+        return False, None, None
+
+    agreement_parts = agreement.decode().split(':')
+    compression = agreement_parts[1] or None
+    cipher = agreement_parts[2] if len(agreement_parts) > 2 else CIPHER_AES_CBC
+    if compression is not None and compression not in COMPRESSION_METHODS:
+        raise ConnectionError(f'The server picked an unknown compression method: {compression}')
+    if cipher not in CIPHERS + [CIPHER_AES_CBC]:
+        raise ConnectionError(f'The server picked an unknown cipher: {cipher}')
+    return True, compression, cipher
 
-    # Run through the data list and jump chunk_size elements every time
-    # Stop when you get to the last chunk, then send the rest of the bytes
-    for i in range(0, chunk_size * (data_length // chunk_size) + 1, chunk_size):
-        data_to_send = encrypted_data[i:i + chunk_size]
-        sock.send(data_to_send)
-        print(f"Sent: {len(data_to_send)}")
+
+def send_website(server_ip, payloads, website_name):
+    '''
+    This function uploads an encoded website to a single server.
+    Returns True if the server saved the website, or False if it denied it.
+    Raises OSError if the connection to the server failed, or EncodingError if the website couldn't be encoded.
+    '''
+    payloads.check_encoding()
+    with socket.create_connection((server_ip, SERVER_PORT), timeout=UPLOAD_TIMEOUT) as connection_socket:
+        if STREAM_UPLOADS:
+            # Ask the server to receive a streaming archive (its length isn't known in advance),
+            # and let it pick the compression
+            connection_socket.send(get_handshake('STREAM', STREAM_PROTOCOL_VERSION))
+            agreed, compression, cipher = parse_agreement(connection_socket.recv(CHUNK_SIZE))
+            if not agreed:
+                return False
+            payload = payloads.get(compression, cipher)
+        else:
+            # Send the serialized data *length* to the server (it's known once the payload starts)
+            payload = payloads.get()
+            payload.wait_for_data(0)
+            connection_socket.send(str(payload.serialized_length).encode())
+
+            # Recieve an agreement to send the data
+            agreement = connection_socket.recv(CHUNK_SIZE)
+            if agreement != b'OK':
+                return False
+
+        # Send the payload straight from the spool (sendfile) while it's being encoded,
+        # reporting the progress on the way
+        with open(payload.path, 'rb') as payload_file:
+            sent_size = 0
+            reported_size = 0
+            while True:
+                available_size = payload.wait_for_data(sent_size)
+                if sent_size == available_size:
+                    # The whole payload was sent
+                    break
+                sent_size += connection_socket.sendfile(payload_file, sent_size,
+                                                        min(PROGRESS_REPORT_SIZE, available_size - sent_size))
+                if sent_size - reported_size >= PROGRESS_REPORT_SIZE:
+                    reported_size = sent_size
+                    if payload.finished:
+                        print(f'{server_ip}: Sent {sent_size}/{payload.size} bytes ({sent_size * 100 // payload.size}%)')
+                    else:
+                        print(f'{server_ip}: Sent {sent_size} bytes (the website is still being encoded)')
+            print(f'{server_ip}: Sent {sent_size}/{payload.size} bytes (100%)')
+
+        # Rename the folder while the name is already taken
+        while True:
+            reply = connection_socket.recv(CHUNK_SIZE)
+            if reply == b'DONE':
+                return True
+            if reply != b'RENAME':
+                raise ConnectionError(f'Unexpected reply: {reply!r}')
+
+            with input_lock:
+                print(f'{server_ip}: Website name "{website_name}" already taken.')
+                new_name = input('Enter new name: ')
+            website_name = os.path.basename(new_name)
+            connection_socket.send(b'NEWNAME:' + new_name.encode())
+
+
+def recv_exact(sock, size):
+    '''
+    This function receives exactly size bytes from the given socket.
+    '''
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(min(size - len(data), CHUNK_SIZE))
+        if not chunk:
+            raise ConnectionError('The connection closed in the middle of the data')
+        data += chunk
+    return bytes(data)
+
+
+def sync_website(server_ip, manifest, file_paths):
+    '''
+    This function syncs a website to a single server: the server gets the manifest of the website,
+    answers with the hashes of the files that it doesn't have, and only these files are sent.
+    Returns True if the server saved the website, or False if it denied it.
+    Raises OSError if the connection to the server failed.
+    '''
+    with socket.create_connection((server_ip, SERVER_PORT), timeout=UPLOAD_TIMEOUT) as connection_socket:
+        connection_socket.send(get_handshake('SYNC', SYNC_PROTOCOL_VERSION))
+
+        # Recieve an agreement to sync, and the compression and cipher that the server picked
+        agreed, compression, cipher = parse_agreement(connection_socket.recv(CHUNK_SIZE))
+        if not agreed:
+            return False
+
+        # Send the manifest (in pieces, so it's split to frames)
+        manifest_data = json.dumps(manifest).encode()
+        manifest_pieces = (manifest_data[i:i + CHUNK_SIZE] for i in range(0, len(manifest_data), CHUNK_SIZE))
+        for frame in encrypt_stream(manifest_pieces, cipher):
+            connection_socket.sendall(frame)
+
+        # Recieve the hashes of the files that the server is missing
+        missing_length = int.from_bytes(recv_exact(connection_socket, 4), byteorder="big")
+        missing_hashes = json.loads(recv_exact(connection_socket, missing_length))
+        if not all(file_hash in file_paths for file_hash in missing_hashes):
+            raise ConnectionError('The server asked for unknown files')
+        file_sizes = {file_hash : size for _, file_hash, size in manifest['files']}
+        print(f'{server_ip}: Sending {len(missing_hashes)}/{len(file_paths)} files '
+              f'({sum(file_sizes[file_hash] for file_hash in missing_hashes)} bytes)')
+
+        # Send only the missing files
+        for frame in encrypt_stream(blob_records(missing_hashes, file_paths, compression), cipher):
+            connection_socket.sendall(frame)
+
+        reply = connection_socket.recv(CHUNK_SIZE)
+        if reply != b'DONE':
+            raise ConnectionError(f'Unexpected reply: {reply!r}')
+        return True
+
+
+def upload_to_server(server_ip, send_function, *args):
+    '''
+    This function uploads a website to a single server with the given send function (send_website or
+    sync_website), and retries (with a growing delay) if the connection fails.
+    Returns whether it succeeded, the amount of attempts, the time it took and the reason of the failure.
+    Other failures (like a website that couldn't be encoded) fail the upload right away, without retrying.
+    '''
+    start_time = time.monotonic()
+    reason = ''
+    for attempt in range(1, UPLOAD_RETRIES + 2):
+        try:
+            if send_function(server_ip, *args):
+                print(f'{server_ip}: Done.')
+                return True, attempt, time.monotonic() - start_time, ''
+            # A server that denied the website won't change its mind
+            print(f'{server_ip}: Denied.')
+            return False, attempt, time.monotonic() - start_time, 'denied'
+        except EncodingError as e:
+            reason = f'encoding failed: {e}'
+            print(f'{server_ip}: {reason}')
+            return False, attempt, time.monotonic() - start_time, reason
+        except OSError as e:
+            reason = str(e) or type(e).__name__
+            print(f'{server_ip}: Attempt {attempt} failed: {reason}')
+            if attempt <= UPLOAD_RETRIES:
+                time.sleep(UPLOAD_RETRY_BACKOFF * 2 ** (attempt - 1))
+        except Exception as e:
+            # An unexpected error fails only this server (the others still get the website)
+            reason = f'{type(e).__name__}: {e}'
+            print(f'{server_ip}: Attempt {attempt} failed: {reason}')
+            return False, attempt, time.monotonic() - start_time, reason
+    return False, UPLOAD_RETRIES + 1, time.monotonic() - start_time, reason
 
 
 def encrypt_data(data):
@@ -145,40 +864,254 @@ def encrypt_data(data):
     return AES_encryptor.encrypt(pad(data, AES_BLOCKSIZE))
 
 
+def upload_to_all_servers(send_function, *args):
+    '''
+    This function uploads a website to all the servers with the given send function, UPLOAD_PARALLELISM
+    servers at a time. Returns the result of every server (see upload_to_server).
+    '''
+    with ThreadPoolExecutor(max_workers=max(min(UPLOAD_PARALLELISM, len(server_ips)), 1)) as executor:
+        uploads = [(server_ip, executor.submit(upload_to_server, server_ip, send_function, *args))
+                   for server_ip in server_ips]
+        return [(server_ip, upload.result()) for server_ip, upload in uploads]
+
+
 def upload_website(website_folder_path):
-    # Convert the given folder to dictionary (json format)
-    website_folder_json = folder_to_json(website_folder_path)
-    print('passed')
-    # Serialize the json for sending
-    serialized_data = pickle.dumps(website_folder_json)
-    print(server_ips)
-    for server_ip in server_ips:
-        # Initiate connection to endpoint server
-        connection_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        connection_socket.connect((server_ip, SERVER_PORT))
-
-        # Send the serialized data *length* to the server
-        connection_socket.send(str(len(serialized_data)).encode())
-
-        # Recieve an agreement to send the data
-        agreement = connection_socket.recv(CHUNK_SIZE)
-        
-        if agreement == b'OK':
-            # Send the folder data in chunks
-            send_data_in_chunks(connection_socket, serialized_data, CHUNK_SIZE)
-            
-            # Rename the folder while the name is already taken
-            while connection_socket.recv(CHUNK_SIZE) == b'RENAME':
-                print('Website name "%s" already taken.' % (os.path.basename(website_folder_json['name'])))
-                new_name = input('Enter new name: ')
-                website_folder_json['name'] = os.path.join(os.path.dirname(website_folder_json['name']), new_name)
-                connection_socket.send(b'NEWNAME:' + new_name.encode())
-            print('Done.')
+    '''
+    This function uploads a website to all the servers, UPLOAD_PARALLELISM servers at a time.
+    The website is encoded (and encrypted) once per compression method, and the same payload is sent to
+    every server that picked that method.
+    In sync mode the website is hashed once, and every server gets only the files that it's missing.
+    '''
+    website_name = os.path.basename(os.path.abspath(website_folder_path))
+    if SYNC_MODE:
+        # Hash the website once, every server asks for the files that it's missing
+        manifest, file_paths = build_manifest(website_folder_path)
+        print(f'{website_name}: Syncing {len(manifest["files"])} files to {len(server_ips)} server(s)')
+        results = upload_to_all_servers(sync_website, manifest, file_paths)
+    else:
+        payloads = WebsitePayloads(website_folder_path)
+        try:
+            print(f'{website_name}: Uploading to {len(server_ips)} server(s)')
+            results = upload_to_all_servers(send_website, payloads, website_name)
+        finally:
+            payloads.remove_all()
+
+    # Print which servers got the website
+    print(f'\n{website_name}: Upload summary')
+    for server_ip, (succeeded, attempts, elapsed_time, reason) in results:
+        print(f'\t{server_ip}\t{"OK" if succeeded else "FAILED"}\t'
+              f'{attempts} attempt(s)\t{elapsed_time:.1f}s\t{reason}')
+    succeeded_count = sum(1 for _, result in results if result[0])
+    print(f'\t{succeeded_count}/{len(results)} servers succeeded\n')
+
+
+class Inotify:
+    '''
+    A minimal wrapper of Linux's inotify (through ctypes).
+    Raises OSError if inotify isn't available.
+    '''
+
+    def __init__(self):
+        try:
+            self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            inotify_init1 = self._libc.inotify_init1
+        except (OSError, AttributeError, TypeError):
+            raise OSError('inotify is not available')
+        self.fd = inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error_number = ctypes.get_errno()
+            raise OSError(error_number, os.strerror(error_number))
+
+    def add_watch(self, path, mask):
+        '''
+        Starts watching the given path, and returns the watch descriptor.
+        '''
+        watch_descriptor = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if watch_descriptor < 0:
+            error_number = ctypes.get_errno()
+            raise OSError(error_number, os.strerror(error_number), path)
+        return watch_descriptor
+
+    def remove_watch(self, watch_descriptor):
+        '''
+        Stops watching (an IN_IGNORED event of the watch follows).
+        '''
+        self._libc.inotify_rm_watch(self.fd, watch_descriptor)
+
+    def read_events(self, timeout=None):
+        '''
+        Waits up to timeout seconds (forever if it's None) for events,
+        and returns them as a list of (watch descriptor, mask, name).
+        '''
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, INOTIFY_READ_SIZE)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            watch_descriptor, mask, _, name_length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + name_length].rstrip(b'\0'))
+            offset += name_length
+            events.append((watch_descriptor, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def list_website_folders(websites_folder_path):
+    '''
+    This function returns the names of the folders in the websites folder, as a set.
+    '''
+    with os.scandir(websites_folder_path) as entries:
+        return {entry.name for entry in entries if entry.is_dir()}
+
+
+def get_folder_signature(folder_path):
+    '''
+    This function returns a signature of the contents of a folder (its entries, sizes and modification times),
+    that changes whenever a file in it is added, removed or written.
+    '''
+    signature = []
+    for current_folder, folder_names, file_names in os.walk(folder_path):
+        for entry_name in folder_names + file_names:
+            try:
+                entry_stat = os.stat(os.path.join(current_folder, entry_name))
+            except OSError:
+                continue
+            signature.append((current_folder, entry_name, entry_stat.st_size, entry_stat.st_mtime_ns))
+    return sorted(signature)
+
+
+def poll_new_websites(websites_folder_path):
+    '''
+    This function scans the websites folder every WATCH_POLL_INTERVAL seconds, and yields the name of every
+    new website folder once its files haven't changed for QUIESCENCE_PERIOD seconds.
+    '''
+    # The websites that are already in the websites folder aren't uploaded
+    known_websites = list_website_folders(websites_folder_path)
+    pending_websites = {}       # {name : (signature, time of the last change)}
+
+    while True:
+        time.sleep(WATCH_POLL_INTERVAL)
+        current_websites = list_website_folders(websites_folder_path)
+        now = time.monotonic()
+
+        # Forget removed websites (so they're uploaded again if they come back)
+        known_websites &= current_websites
+        for new_website in current_websites - known_websites - pending_websites.keys():
+            pending_websites[new_website] = (None, now)
+
+        for website, (last_signature, last_change_time) in list(pending_websites.items()):
+            if website not in current_websites:
+                del pending_websites[website]
+                continue
+            signature = get_folder_signature(os.path.join(websites_folder_path, website))
+            if signature != last_signature:
+                pending_websites[website] = (signature, now)
+            elif now - last_change_time >= QUIESCENCE_PERIOD:
+                del pending_websites[website]
+                known_websites.add(website)
+                yield website
+
+
+def inotify_new_websites(websites_folder_path, inotify):
+    '''
+    This function watches the websites folder (and the folders inside new websites) with inotify, and yields
+    the name of every new website folder once its files haven't changed for QUIESCENCE_PERIOD seconds.
+    It sleeps while nothing happens.
+    '''
+    websites_folder_watch = inotify.add_watch(websites_folder_path, WEBSITES_FOLDER_MASK)
+    # The websites that are already in the websites folder aren't uploaded
+    known_websites = list_website_folders(websites_folder_path)
+    pending_websites = {}       # {name : time of the last change}
+    watches = {}                # {watch descriptor : (website name, folder path)}
+
+    def watch_folder(website, folder_path):
+        # Watch a folder of a new website and all the folders inside it
+        for current_folder, _, _ in os.walk(folder_path):
+            try:
+                watches[inotify.add_watch(current_folder, WEBSITE_CHANGES_MASK)] = (website, current_folder)
+            except OSError:
+                # The folder was removed in the meantime
+                pass
+
+    def add_pending_website(website):
+        pending_websites[website] = time.monotonic()
+        watch_folder(website, os.path.join(websites_folder_path, website))
+
+    while True:
+        # Sleep until something changes, or until the next pending website may be ready
+        timeout = None
+        if pending_websites:
+            timeout = max(min(pending_websites.values()) + QUIESCENCE_PERIOD - time.monotonic(), 0)
+        events = inotify.read_events(timeout)
+        now = time.monotonic()
+
+        for watch_descriptor, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, so look at the folder itself
+                current_websites = list_website_folders(websites_folder_path)
+                known_websites &= current_websites
+                for new_website in current_websites - known_websites - pending_websites.keys():
+                    add_pending_website(new_website)
+                for website in pending_websites:
+                    pending_websites[website] = now
+
+            elif watch_descriptor == websites_folder_watch:
+                if mask & (IN_CREATE | IN_MOVED_TO) and mask & IN_ISDIR:
+                    if name not in known_websites and name not in pending_websites:
+                        add_pending_website(name)
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    # Forget removed websites (so they're uploaded again if they come back)
+                    known_websites.discard(name)
+                    pending_websites.pop(name, None)
+
+            elif watch_descriptor in watches:
+                website, folder_path = watches[watch_descriptor]
+                if mask & IN_IGNORED:
+                    del watches[watch_descriptor]
+                elif website in pending_websites:
+                    pending_websites[website] = now
+                    if mask & (IN_CREATE | IN_MOVED_TO) and mask & IN_ISDIR:
+                        watch_folder(website, os.path.join(folder_path, name))
+
+        for website, last_change_time in list(pending_websites.items()):
+            if now - last_change_time >= QUIESCENCE_PERIOD:
+                del pending_websites[website]
+                known_websites.add(website)
+                # Stop watching the website's folders
+                for watch_descriptor, (watched_website, _) in list(watches.items()):
+                    if watched_website == website:
+                        inotify.remove_watch(watch_descriptor)
+                        del watches[watch_descriptor]
+                yield website
+
+
+def watch_new_websites(websites_folder_path):
+    '''
+    This function yields the name of every new website folder in the websites folder,
+    once its files haven't changed for QUIESCENCE_PERIOD seconds (so half-copied websites aren't uploaded).
+    It uses inotify when it's available, and scans the folder otherwise.
+    '''
+    if USE_INOTIFY:
+        try:
+            inotify = Inotify()
+        except OSError as e:
+            print(f'inotify is not available ({e}), scanning the websites folder instead.')
         else:
-            print('Failed.')
-        
-        # End the connection with the server
-        connection_socket.close()
+            try:
+                yield from inotify_new_websites(websites_folder_path, inotify)
+            finally:
+                inotify.close()
+            return
+    yield from poll_new_websites(websites_folder_path)
 
 
 def main():
@@ -191,31 +1124,12 @@ def main():
     server_ips = sys.argv[2:]
     websites_folder_path = sys.argv[1]
 
-    # Check which websites are already in the websites folder
-    websites = os.listdir(websites_folder_path)
+    # Wait for the user to add a folder to the websites folder,
+    # and upload every new website to the target(s) once it's fully copied
+    for new_website in watch_new_websites(websites_folder_path):
+        print(f'New website: {new_website}')
+        threading.Thread(target=upload_website, args=(os.path.join(websites_folder_path, new_website),)).start()
 
-    # Wait for the user to add a folder to the websites folder
-    while True:
-        # Check if there's a change in the websites folder
-        current_websites = os.listdir(websites_folder_path)
-        if current_websites != websites:
-            new_websites = []
-            # Add all the new websites to the list
-            for website in current_websites:
-                if website not in websites:
-                    new_websites.append(website)
-            
-            # For each new website
-            print(new_websites)
-            for new_website in new_websites:
-                # Upload the new website to the target(s)
-                threading.Thread(target=upload_website, args=(f"{websites_folder_path}{new_website}",)).start()
-                # Add the new website to the list of websites
-                websites.append(new_website)
-        
-        # Sleep for 1 second
-        time.sleep(1)
-        
 
 
 if __name__ == '__main__':
@@ -0,0 +1,250 @@
+"""
+A load-test and benchmark harness for http_server.py.
+
+Starts the server on a loopback port against a copy of the shipped webroot
+(plus a few generated files of bigger sizes), drives it with concurrent clients,
+and prints the results as JSON: throughput, latency percentiles and bytes per second.
+
+USAGE
+    python benchmark.py [--concurrency 16] [--duration 10] [--no-keep-alive]
+                        [--output results.json] [--baseline baseline.json]
+
+A stored result can be used as a baseline, so every performance change
+to the server can be compared against it.
+"""
+
+
+import argparse
+import http.client
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'http_server.py')
+WEBROOT_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'webroot')
+SERVER_START_TIMEOUT = 10               # Seconds to wait for the server to listen
+GENERATED_FILE_SIZES = [64 * 1024, 1024 * 1024, 8 * 1024 * 1024]  # Sizes of the generated bench files
+
+
+def get_free_port():
+    """
+    Returns a free TCP port on the loopback interface.
+    """
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def prepare_webroot(work_folder: str, generated_sizes: list):
+    """
+    Copies the shipped webroot into the work folder, and adds generated files of the given sizes.
+    Returns the list of URL paths of all the files (the request mix).
+    """
+    webroot_copy = os.path.join(work_folder, 'webroot')
+    shutil.copytree(WEBROOT_FOLDER, webroot_copy)
+
+    # Generate bigger files (random data, so compression won't shrink them)
+    generated_folder = os.path.join(webroot_copy, 'bench')
+    os.mkdir(generated_folder)
+    for size in generated_sizes:
+        with open(os.path.join(generated_folder, f'file_{size}.bin.jpg'), 'wb') as f:
+            f.write(os.urandom(size))
+
+    url_paths = []
+    for folder_path, _, file_names in os.walk(webroot_copy):
+        for file_name in file_names:
+            file_path = os.path.join(folder_path, file_name)
+            url_paths.append('/' + os.path.relpath(file_path, webroot_copy).replace(os.sep, '/'))
+    return sorted(url_paths)
+
+
+def start_server(work_folder: str, port: int):
+    """
+    Starts http_server.py in the work folder (it serves the 'webroot' folder of its working directory),
+    and waits until it accepts connections.
+    """
+    server_process = subprocess.Popen([sys.executable, SERVER_SCRIPT, str(port)], cwd=work_folder,
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if server_process.poll() is not None:
+            raise RuntimeError(f'The server exited with code {server_process.returncode}')
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return server_process
+        except OSError:
+            time.sleep(0.1)
+
+    server_process.kill()
+    raise RuntimeError('The server did not start listening in time')
+
+
+def stop_server(server_process: subprocess.Popen):
+    """
+    Asks the server to shut down gracefully, and kills it if it doesn't.
+    """
+    server_process.terminate()
+    try:
+        server_process.wait(timeout=SERVER_START_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        server_process.kill()
+        server_process.wait()
+
+
+def run_client(port: int, url_paths: list, keep_alive: bool, deadline: float, results: dict, lock: threading.Lock):
+    """
+    Sends requests for random files of the mix until the deadline, and records their latencies.
+    """
+    latencies = []
+    bytes_received = 0
+    errors = 0
+    status_counts = {}
+    rng = random.Random()
+    connection = None
+
+    while time.monotonic() < deadline:
+        url_path = rng.choice(url_paths)
+        start_time = time.perf_counter()
+        try:
+            if connection is None:
+                connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+            headers = {} if keep_alive else {'Connection': 'close'}
+            connection.request('GET', url_path, headers=headers)
+            response = connection.getresponse()
+            body = response.read()
+            latencies.append(time.perf_counter() - start_time)
+            bytes_received += len(body)
+            status_counts[response.status] = status_counts.get(response.status, 0) + 1
+
+            if not keep_alive or response.will_close:
+                connection.close()
+                connection = None
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            if connection is not None:
+                connection.close()
+            connection = None
+
+    if connection is not None:
+        connection.close()
+
+    with lock:
+        results['latencies'].extend(latencies)
+        results['bytes'] += bytes_received
+        results['errors'] += errors
+        for status, count in status_counts.items():
+            results['status_counts'][status] = results['status_counts'].get(status, 0) + count
+
+
+def percentile(sorted_values: list, fraction: float):
+    """
+    Returns the given percentile (0 - 1) of a sorted list (nearest-rank).
+    """
+    if not sorted_values:
+        return 0.0
+    index = min(int(fraction * len(sorted_values)), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def run_benchmark(concurrency: int, duration: float, keep_alive: bool, generated_sizes: list):
+    """
+    Runs a whole benchmark (server setup, load and teardown) and returns the results as a dictionary.
+    """
+    with tempfile.TemporaryDirectory(prefix='http_server_bench_') as work_folder:
+        url_paths = prepare_webroot(work_folder, generated_sizes)
+        port = get_free_port()
+        server_process = start_server(work_folder, port)
+
+        results = {'latencies': [], 'bytes': 0, 'errors': 0, 'status_counts': {}}
+        lock = threading.Lock()
+        try:
+            start_time = time.perf_counter()
+            deadline = time.monotonic() + duration
+            clients = [threading.Thread(target=run_client,
+                                        args=(port, url_paths, keep_alive, deadline, results, lock))
+                       for _ in range(concurrency)]
+            for client in clients:
+                client.start()
+            for client in clients:
+                client.join()
+            elapsed = time.perf_counter() - start_time
+        finally:
+            stop_server(server_process)
+
+    latencies = sorted(results['latencies'])
+    requests = len(latencies)
+    return {
+        'config': {
+            'concurrency': concurrency,
+            'duration_s': duration,
+            'keep_alive': keep_alive,
+            'files': len(url_paths),
+            'generated_file_sizes': generated_sizes,
+        },
+        'requests': requests,
+        'errors': results['errors'],
+        'status_counts': {str(status): count for status, count in sorted(results['status_counts'].items())},
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(requests / elapsed, 2),
+        'bytes_per_second': round(results['bytes'] / elapsed, 2),
+        'latency_ms': {
+            'mean': round(sum(latencies) / requests * 1000, 3) if requests else 0.0,
+            'p50': round(percentile(latencies, 0.50) * 1000, 3),
+            'p95': round(percentile(latencies, 0.95) * 1000, 3),
+            'p99': round(percentile(latencies, 0.99) * 1000, 3),
+            'max': round(latencies[-1] * 1000, 3) if latencies else 0.0,
+        },
+    }
+
+
+def compare_to_baseline(results: dict, baseline: dict):
+    """
+    Returns the relative change (in percents) of the main metrics compared to a baseline result.
+    """
+    def change(new_value, old_value):
+        return round((new_value - old_value) / old_value * 100, 2) if old_value else None
+
+    return {
+        'throughput_rps': change(results['throughput_rps'], baseline['throughput_rps']),
+        'bytes_per_second': change(results['bytes_per_second'], baseline['bytes_per_second']),
+        'latency_p50': change(results['latency_ms']['p50'], baseline['latency_ms']['p50']),
+        'latency_p95': change(results['latency_ms']['p95'], baseline['latency_ms']['p95']),
+        'latency_p99': change(results['latency_ms']['p99'], baseline['latency_ms']['p99']),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load-test and benchmark http_server.py')
+    parser.add_argument('--concurrency', type=int, default=16, help='amount of concurrent clients')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to run the load')
+    parser.add_argument('--no-keep-alive', action='store_true', help='open a new connection for every request')
+    parser.add_argument('--sizes', type=int, nargs='*', default=GENERATED_FILE_SIZES,
+                        help='sizes (in bytes) of the generated files added to the request mix')
+    parser.add_argument('--output', help='also write the results to this JSON file')
+    parser.add_argument('--baseline', help='a stored results JSON file to compare against')
+    args = parser.parse_args()
+
+    results = run_benchmark(args.concurrency, args.duration, not args.no_keep_alive, args.sizes)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            results['change_from_baseline_percent'] = compare_to_baseline(results, json.load(f))
+
+    output = json.dumps(results, indent=4)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,177 +1,1314 @@
 import socket
-import re
 import logging
+import logging.handlers
+import queue
+import random
 import os
 import sys
 import mimetypes
 import traceback
+import threading
+import signal
+import multiprocessing
+import time
+import secrets
+import bisect
+import email.utils
+import gzip
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# The HTTP parser is shared with the proxy agent, it's in the 'Web Server' folder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from http_parser import HttpRequestParser, HttpParseError
 
 
 # Setup basic variables.
-webroot_path = os.getcwd() + '\webroot\\'   # Website folder path
+webroot_path = os.path.join(os.getcwd(), 'webroot', '')  # Website folder path (ends with a separator)
 default_url = webroot_path + 'index.html'   # Default index.html path
 http_version = 'HTTP/1.1'                   # Http version used
 logger = None                               # Logger object (created in main)
+log_listener = None                         # Writes the queued log records (if LOG_QUEUE_ENABLED)
+
+# Logging settings.
+LOG_LEVEL = logging.INFO                    # logging.DEBUG logs the details of every request
+LOG_QUEUE_ENABLED = True                    # Format and write the logs in a background thread
+LOG_BATCH_SIZE = 256                        # Amount of records written to the log file at once
+LOG_FLUSH_INTERVAL = 1                      # Max seconds a record waits before it's written
+ACCESS_LOG_SAMPLE_RATE = 1.0                # Part of the successful (< 400) requests that are logged
+# The line logged for every request (fields: client, method, resource, status, bytes, duration_ms)
+ACCESS_LOG_FORMAT = '%(client)s "%(method)s %(resource)s" %(status)s %(bytes)d %(duration_ms).1fms'
+
+# Serving engine settings.
+SERVER_PORT = 80                            # The port that the server listens on
+LISTEN_BACKLOG = 128                        # Max amount of pending connections in the OS queue
+WORKER_PROCESSES = os.cpu_count() or 1      # Amount of processes that accept clients
+WORKER_THREADS = 32                         # Amount of threads that serve clients (per process)
+MAX_PENDING_CLIENTS = 64                    # Max accepted clients waiting for a free thread
+ACCEPT_TIMEOUT = 0.5                        # Seconds between shutdown checks in the accept loop
+CLIENT_TIMEOUT = 10                         # Seconds to wait for a client before dropping it
+KEEP_ALIVE_TIMEOUT = 5                      # Seconds an idle keep-alive connection stays open
+MAX_KEEP_ALIVE_REQUESTS = 100               # Max amount of requests served on one connection
+MAX_REQUEST_HEAD_SIZE = 8192                # Max size of a request line + headers (in bytes)
+MAX_REQUEST_BODY_SIZE = 1024 * 1024         # Max size of a request body (in bytes)
+MAX_REQUEST_HEADERS = 100                   # Max amount of header lines in a request
+RECV_SIZE = 4096                            # Amount of bytes read from a client socket at once
+
+# Static file cache settings.
+CACHE_ENABLED = True                        # Whether or not file responses are cached in memory
+CACHE_MAX_BYTES = 64 * 1024 * 1024          # Max total size of the cached file bodies
+CACHE_MAX_ENTRY_SIZE = 1024 * 1024          # Files bigger than this are never cached
+CACHE_REVALIDATE_INTERVAL = 1               # Seconds between checks (stat) of a cached file
+
+# Large file streaming settings.
+STREAM_MIN_FILE_SIZE = 256 * 1024           # Files of this size or bigger are streamed from the disk
+SEND_CHUNK_SIZE = 64 * 1024                 # Chunk size used when sendfile() isn't available
+
+# Range requests settings.
+MAX_RANGES = 16                             # Requests with more ranges get the whole file
+MULTIPART_BOUNDARY = secrets.token_hex(16)  # Separates the parts of multi-range responses
+
+# Content encoding (compression) settings.
+COMPRESSION_ENABLED = True                  # Whether or not responses are compressed
+COMPRESSION_LEVEL = 6                       # gzip / deflate compression level (1 - 9)
+COMPRESSION_MIN_SIZE = 256                  # Smaller files aren't worth compressing
+COMPRESSED_CACHE_MAX_BYTES = 16 * 1024 * 1024  # Max total size of the cached compressed bodies
+SUPPORTED_ENCODINGS = ['gzip', 'deflate']   # Ordered by preference
+# Content types that are worth compressing (images like jpg/png are already compressed)
+COMPRESSIBLE_CONTENT_TYPES = ['text/', 'application/javascript', 'application/json',
+                              'application/xml', 'image/svg+xml']
+
+# Resource index settings.
+RESOURCE_INDEX_ENABLED = False              # Index the webroot at startup instead of checking the disk per request
+RESOURCE_INDEX_REFRESH_INTERVAL = 5         # Seconds between rescans of the webroot folder
+
+# Metrics settings.
+METRICS_ENABLED = False                     # Measure every request and serve the metrics endpoint
+METRICS_PATH = '/__metrics'                 # The URL path of the (Prometheus text format) metrics
+METRICS_ALLOWED_CLIENTS = ['127.0.0.1', '::1']  # Only these clients can read the metrics
+# Upper bounds (in seconds) of the latency histograms' buckets
+METRICS_LATENCY_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                           0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+shutdown_event = threading.Event()          # Set when the server should stop accepting clients
+
+
+class FileResponse:
+    """
+    The prebuilt parts of a 200 response for a static file.
+    headers - the entity headers of the response (Content-Length, Content-Type, validators) in bytes.
+    body - the data of the file, or None if the file is big and should be streamed from the disk.
+    length - the length of the response body.
+    path - the file that the body is read from (the requested file or its pre-compressed .gz sibling).
+    encoding - the content encoding of the body (like 'gzip'), or None if the body isn't compressed.
+    mtime_ns, size - the requested file's metadata when it was read, used to revalidate the response.
+    """
+    __slots__ = ('headers', 'body', 'length', 'content_type', 'path', 'encoding', 'etag',
+                 'last_modified', 'mtime_ns', 'size', 'checked_at')
+
+    def __init__(self, headers: bytes, body: bytes, length: int, content_type: str, path: str,
+                 mtime_ns: int, size: int, encoding: str = None):
+        self.headers = headers
+        self.body = body
+        self.length = length
+        self.content_type = content_type
+        self.path = path
+        self.encoding = encoding
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.checked_at = time.monotonic()  # The last time the file was checked for changes
+
+        # Validators of the file's version, used by conditional requests.
+        # Every encoding of the file is a different representation, so it has its own ETag.
+        encoding_suffix = f'-{encoding}' if encoding else ''
+        self.etag = f'"{mtime_ns:x}-{size:x}{encoding_suffix}"'
+        self.last_modified = email.utils.formatdate(mtime_ns / 1e9, usegmt=True)
+
+    def validator_headers(self):
+        """
+        Returns the headers that identify the version of the file (sent with 200, 206 and 304).
+        """
+        return f'ETag: {self.etag}\r\nLast-Modified: {self.last_modified}'
+
+    def build_headers(self):
+        """
+        Builds the entity headers of the 200 response of the file.
+        """
+        headers = f'Content-Length: {self.length}\r\nContent-Type: {self.content_type}\r\n'
+        if self.encoding:
+            headers += f'Content-Encoding: {self.encoding}\r\n'
+        if is_compressible(self.content_type):
+            # Caches must keep a separate copy for every encoding
+            headers += 'Vary: Accept-Encoding\r\n'
+        headers += f'Accept-Ranges: bytes\r\n{self.validator_headers()}'
+        self.headers = headers.encode()
+
+
+class FileResponseCache:
+    """
+    A thread-safe LRU cache of static file responses, keyed by the resolved file path
+    and the content encoding of the response.
+    The total size of the cached bodies is bounded by max_bytes. A cached entry is
+    revalidated against the file's mtime and size at most once every revalidate_interval
+    seconds, so hot files are served without any disk syscalls.
+    """
+
+    def __init__(self, max_bytes: int, max_entry_size: int, revalidate_interval: float):
+        self.max_bytes = max_bytes
+        self.max_entry_size = max_entry_size
+        self.revalidate_interval = revalidate_interval
+        self.current_bytes = 0
+
+        # Counters of the cache usage
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+        # Ordered from the least recently used to the most recently used
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path: str, encoding: str = None):
+        """
+        Returns the cached response of the given path (in the given encoding),
+        or None if it's missing or outdated.
+        """
+        key = (path, encoding)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+        # Check if the file changed since it was cached (without holding the lock)
+        now = time.monotonic()
+        if now - entry.checked_at >= self.revalidate_interval:
+            try:
+                file_stat = os.stat(path)
+                is_outdated = file_stat.st_mtime_ns != entry.mtime_ns or file_stat.st_size != entry.size
+            except OSError:
+                # The file was deleted
+                is_outdated = True
+
+            if is_outdated:
+                with self._lock:
+                    self._remove(key, entry)
+                    self.invalidations += 1
+                    self.misses += 1
+                return None
+            entry.checked_at = now
+
+        with self._lock:
+            # Mark the entry as the most recently used one (if it wasn't removed meanwhile)
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            self.hits += 1
+        return entry
+
+    def put(self, path: str, entry: FileResponse):
+        """
+        Caches the given response (under its path and encoding), and evicts the least recently used entries
+        until the cache fits in its byte budget.
+        """
+        # Streamed responses (without a body) are never cached
+        if entry.body is None:
+            return
+
+        entry_size = len(entry.body)
+        if entry_size > self.max_entry_size or entry_size > self.max_bytes:
+            return
+
+        key = (path, entry.encoding)
+        with self._lock:
+            # Replace the old entry of the path (if there is one)
+            old_entry = self._entries.get(key)
+            if old_entry is not None:
+                self._remove(key, old_entry)
+
+            self._entries[key] = entry
+            self.current_bytes += entry_size
+
+            # Evict the least recently used entries
+            while self.current_bytes > self.max_bytes:
+                evicted_key, evicted_entry = next(iter(self._entries.items()))
+                self._remove(evicted_key, evicted_entry)
+                self.evictions += 1
+
+    def stats(self):
+        """
+        Returns a dictionary with the usage counters of the cache.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'invalidations': self.invalidations, 'entries': len(self._entries),
+                    'bytes': self.current_bytes}
+
+    def _remove(self, key: tuple, entry: FileResponse):
+        # Must be called while holding the lock
+        if self._entries.get(key) is entry:
+            del self._entries[key]
+            self.current_bytes -= len(entry.body)
+
+
+# Cache of the static file responses (every worker process has its own cache)
+file_response_cache = FileResponseCache(
+    CACHE_MAX_BYTES, CACHE_MAX_ENTRY_SIZE, CACHE_REVALIDATE_INTERVAL)
+
+# Cache of the compressed variants of the responses, so every file is compressed only once
+compressed_response_cache = FileResponseCache(
+    COMPRESSED_CACHE_MAX_BYTES, CACHE_MAX_ENTRY_SIZE, CACHE_REVALIDATE_INTERVAL)
+
+
+class ResourceIndex:
+    """
+    An in-memory index of the files in the webroot folder, so that requests are resolved
+    (and 404s are rejected) with dictionary lookups instead of filesystem syscalls.
+    urls - maps a URL path (like '/images/logo.jpg') to the path of the file.
+    files - maps the path of a file to its metadata: a FileResponse without a body,
+            with the content type, size and prebuilt headers of the file.
+    The index is rebuilt by a background thread every refresh_interval seconds.
+    """
+
+    def __init__(self, root_path: str, refresh_interval: float):
+        self.root_path = root_path
+        self.refresh_interval = refresh_interval
+        self.urls = {}
+        self.files = {}
+        self._watcher = None
+
+    def build(self):
+        """
+        Walks the webroot folder and replaces the index with a new one.
+        Files that didn't change keep their old metadata (and ETag).
+        """
+        urls = {}
+        files = {}
+        for folder_path, _, file_names in os.walk(self.root_path):
+            for file_name in file_names:
+                file_path = os.path.join(folder_path, file_name)
+                try:
+                    file_stat = os.stat(file_path)
+                except OSError:
+                    # The file was deleted during the walk
+                    continue
+
+                # Reuse the old metadata if the file didn't change
+                file_response = self.files.get(file_path)
+                if file_response is None or file_response.mtime_ns != file_stat.st_mtime_ns \
+                        or file_response.size != file_stat.st_size:
+                    file_response = build_file_metadata(file_path, file_stat)
+
+                # Example: '<webroot>/images/logo.jpg' => '/images/logo.jpg'
+                url_path = '/' + os.path.relpath(file_path, self.root_path).replace(os.sep, '/')
+                urls[url_path] = file_path
+                files[file_path] = file_response
+
+        # The default page
+        if default_url in files:
+            urls['/'] = default_url
+
+        # Replace both of the dictionaries at once (readers never lock the index)
+        self.urls, self.files = urls, files
+        logger.info(f'Indexed {len(files)} files in {self.root_path}')
+
+    def start_watching(self):
+        """
+        Starts a background thread that rebuilds the index until the server shuts down.
+        """
+        def watch():
+            while not shutdown_event.wait(self.refresh_interval):
+                try:
+                    self.build()
+                except OSError as e:
+                    logger.warning(f'Failed to refresh the resource index: {e}')
+
+        self._watcher = threading.Thread(target=watch, name='resource-index-watcher', daemon=True)
+        self._watcher.start()
+
+
+# Index of the files in the webroot (used only if RESOURCE_INDEX_ENABLED)
+resource_index = ResourceIndex(webroot_path, RESOURCE_INDEX_REFRESH_INTERVAL)
+
+
+class ServerMetrics:
+    """
+    The metrics of the requests served by all the worker processes: latency histograms of every stage
+    of a request, bytes sent, the amount of responses of every status code and the usage of the caches.
+    The stages are:
+        accept_to_first_byte - from accepting the connection to sending the first response byte
+                               (measured on the first request of every connection)
+        parse - the time spent parsing the request (without waiting for the client's data)
+        disk - the time spent finding and reading the file (cache lookups, stat, reads, compression)
+        send - the time spent sending the response
+        total - from the end of the parsing to the end of the sending
+    The worker processes share the listening socket, so a scrape reaches any one of them.
+    That's why the counters are kept in shared memory: every process counts its requests into its own
+    slot (without locking the other processes), and render() sums the slots of all the processes.
+    A scrape may see a request that is only partly counted, but the totals never go back.
+    """
+    STAGES = ['accept_to_first_byte', 'parse', 'disk', 'send', 'total']
+    MIN_STATUS_CODE = 100
+    MAX_STATUS_CODE = 599
+    CACHE_COUNTERS = ['hits', 'misses', 'evictions', 'invalidations', 'entries', 'bytes']
+
+    def __init__(self, buckets: list, process_count: int):
+        self.buckets = buckets
+
+        # The layout of the slot of a process:
+        # every stage's histogram (the counts of the buckets and +Inf, the sum and the count),
+        # a counter of every status code, the bytes sent and the counters of both of the file caches
+        self.histogram_size = len(buckets) + 3
+        self.status_offset = len(self.STAGES) * self.histogram_size
+        self.bytes_offset = self.status_offset + self.MAX_STATUS_CODE - self.MIN_STATUS_CODE + 1
+        self.cache_offset = self.bytes_offset + 1
+        self.slot_size = self.cache_offset + 2 * len(self.CACHE_COUNTERS)
+
+        self.process_count = process_count
+        self.values = multiprocessing.RawArray('d', process_count * self.slot_size)
+        self.slot_offset = 0
+        self._lock = threading.Lock()
+
+    def attach(self, values, process_index: int):
+        """
+        Makes a worker process count into its own slot of the values that are shared by all the processes.
+        """
+        self.values = values
+        self.slot_offset = process_index * self.slot_size
+
+    def observe_request(self, request_metrics: dict):
+        """
+        Adds the measurements of a single request (filled while it was served).
+        """
+        values = self.values
+        with self._lock:
+            for stage_index, stage in enumerate(self.STAGES):
+                if stage in request_metrics:
+                    value = request_metrics[stage]
+                    histogram_offset = self.slot_offset + stage_index * self.histogram_size
+                    values[histogram_offset + bisect.bisect_left(self.buckets, value)] += 1
+                    values[histogram_offset + self.histogram_size - 2] += value
+                    values[histogram_offset + self.histogram_size - 1] += 1
+
+            status_code = int(request_metrics.get('status', 0))
+            if self.MIN_STATUS_CODE <= status_code <= self.MAX_STATUS_CODE:
+                values[self.slot_offset + self.status_offset + status_code - self.MIN_STATUS_CODE] += 1
+            values[self.slot_offset + self.bytes_offset] += request_metrics.get('bytes', 0)
+
+            # The caches belong to this process, so their counters are copied to be seen by the others
+            cache_offset = self.slot_offset + self.cache_offset
+            for cache in (file_response_cache, compressed_response_cache):
+                cache_stats = cache.stats()
+                for counter_name in self.CACHE_COUNTERS:
+                    values[cache_offset] = cache_stats[counter_name]
+                    cache_offset += 1
+
+    def total(self, offset: int):
+        """
+        Returns the sum of the value at the given offset (in a slot) over all of the processes.
+        """
+        return sum(self.values[process_index * self.slot_size + offset]
+                   for process_index in range(self.process_count))
+
+    def render(self):
+        """
+        Returns the metrics of all the processes in the Prometheus text exposition format.
+        """
+        lines = ['# HELP http_server_stage_duration_seconds Time spent in every stage of a request.',
+                 '# TYPE http_server_stage_duration_seconds histogram']
+        for stage_index, stage in enumerate(self.STAGES):
+            histogram_offset = stage_index * self.histogram_size
+            cumulative_count = 0
+            for bucket_index, upper_bound in enumerate(self.buckets + ['+Inf']):
+                cumulative_count += int(self.total(histogram_offset + bucket_index))
+                lines.append(f'http_server_stage_duration_seconds_bucket{{stage="{stage}",le="{upper_bound}"}} '
+                             f'{cumulative_count}')
+            lines.append(f'http_server_stage_duration_seconds_sum{{stage="{stage}"}} '
+                         f'{self.total(histogram_offset + self.histogram_size - 2)}')
+            lines.append(f'http_server_stage_duration_seconds_count{{stage="{stage}"}} '
+                         f'{int(self.total(histogram_offset + self.histogram_size - 1))}')
+
+        lines.append('# HELP http_server_responses_total Responses sent, by status code.')
+        lines.append('# TYPE http_server_responses_total counter')
+        for status_code in range(self.MIN_STATUS_CODE, self.MAX_STATUS_CODE + 1):
+            count = int(self.total(self.status_offset + status_code - self.MIN_STATUS_CODE))
+            if count:
+                lines.append(f'http_server_responses_total{{status="{status_code}"}} {count}')
 
+        lines.append('# HELP http_server_sent_bytes_total Bytes sent to the clients.')
+        lines.append('# TYPE http_server_sent_bytes_total counter')
+        lines.append(f'http_server_sent_bytes_total {int(self.total(self.bytes_offset))}')
 
-def setup_logging(log_file_name: str):
+        # The usage of the file caches (the sum of the caches of all the processes)
+        cache_offset = self.cache_offset
+        for cache_name in ['file', 'compressed']:
+            for counter_name in self.CACHE_COUNTERS:
+                lines.append(f'http_server_cache_{counter_name}{{cache="{cache_name}"}} '
+                             f'{int(self.total(cache_offset))}')
+                cache_offset += 1
+
+        lines.append(f'http_server_processes {self.process_count}')
+        return '\n'.join(lines) + '\n'
+
+
+# The metrics of all the worker processes (the worker processes attach to the parent's shared values)
+server_metrics = ServerMetrics(METRICS_LATENCY_BUCKETS, WORKER_PROCESSES)
+
+
+class BatchingFileHandler(logging.FileHandler):
+    """
+    A file handler that writes to the log file once every batch_size records
+    (or when it's asked to), instead of after every single record.
+    All the worker processes append to the same log file, so the pending records are
+    written with a single write() on the file (that is opened with O_APPEND).
+    That way every write ends on a whole record, and the records of different processes never interleave.
+    """
+
+    def __init__(self, filename: str, mode: str, batch_size: int):
+        super().__init__(filename=filename, mode=mode)
+        self.batch_size = batch_size
+        self._pending_records = []
+
+    def emit(self, record):
+        try:
+            self._pending_records.append(self.format(record) + self.terminator)
+            if len(self._pending_records) >= self.batch_size:
+                self.flush()
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        with self.lock:
+            if not self._pending_records or self.stream is None:
+                return
+            data = ''.join(self._pending_records).encode(self.stream.encoding, 'backslashreplace')
+            self._pending_records = []
+
+            # Bypass the buffer of the stream, which would split the records at its size (8 KB).
+            # os.write() only writes a part of the data if the disk is full.
+            file_descriptor = self.stream.fileno()
+            data_view = memoryview(data)
+            while data_view:
+                data_view = data_view[os.write(file_descriptor, data_view):]
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    A queue handler that leaves the formatting of the records to the listener's thread.
+    (The queue is in-process, so the records don't have to be picklable.)
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class BatchingQueueListener(logging.handlers.QueueListener):
+    """
+    A queue listener that flushes its handlers whenever the queue is idle for flush_interval seconds,
+    so that batched records are never delayed for long.
+    """
+
+    def __init__(self, log_queue, *handlers, flush_interval: float):
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+        self.flush_interval = flush_interval
+
+    def dequeue(self, block):
+        while True:
+            try:
+                return self.queue.get(block, timeout=self.flush_interval)
+            except queue.Empty:
+                for handler in self.handlers:
+                    handler.flush()
+
+
+def setup_logging(log_file_name: str, file_mode: str = 'w'):
     """
     Creates and returns a logger that can be used to
     log data to a file and to the console of the program.
+    file_mode - 'w' truncates the log file, 'a' appends to it (used by worker processes).
+    If LOG_QUEUE_ENABLED, the serving threads only put the records in a queue,
+    and a background thread formats them and writes them in batches.
     """
+    global log_listener
 
     # Set a logger & log formatter
     logger = logging.getLogger(__name__)
-    logger.level = logging.DEBUG
+    logger.level = LOG_LEVEL
     file_log_formatter = logging.Formatter(
         '%(asctime)s  %(levelname)s: %(message)s')
     console_log_formatter = logging.Formatter('%(asctime)s %(message)s')
 
-    # Setup logging to a log file
-    file_log_handler = logging.FileHandler(filename=log_file_name, mode='w')
-    logger.addHandler(file_log_handler)
-    logger.info(
-        f'''my_http_server_log_file:
-        Website path: {webroot_path}
-        Default URL: {default_url}
-    ''')
+    # Remove the handlers of a previous setup (worker processes inherit the parent's logger)
+    logger.handlers.clear()
+
+    # Setup logging to a log file.
+    # The file is always opened for appending, since the worker processes write to it as well.
+    # Without the queue every record is written on its own (still in a single write).
+    if file_mode == 'w':
+        open(log_file_name, 'w').close()
+    batch_size = LOG_BATCH_SIZE if LOG_QUEUE_ENABLED else 1
+    file_log_handler = BatchingFileHandler(log_file_name, 'a', batch_size)
     file_log_handler.setFormatter(file_log_formatter)
-    logger.addHandler(file_log_handler)
 
     # Setup logging to the console
     console_log_handler = logging.StreamHandler()
     console_log_handler.setFormatter(console_log_formatter)
-    logger.addHandler(console_log_handler)
+
+    if LOG_QUEUE_ENABLED:
+        log_queue = queue.SimpleQueue()
+        log_listener = BatchingQueueListener(log_queue, file_log_handler, console_log_handler,
+                                             flush_interval=LOG_FLUSH_INTERVAL)
+        log_listener.start()
+        logger.addHandler(DeferredQueueHandler(log_queue))
+    else:
+        log_listener = None
+        logger.addHandler(file_log_handler)
+        logger.addHandler(console_log_handler)
+
+    logger.info(
+        f'''my_http_server_log_file:
+        Website path: {webroot_path}
+        Default URL: {default_url}
+    ''')
 
     return logger
 
 
-def validate_http_request(client_socket: socket.socket):
-    """  
-    Determines weather or not the HTTP request is valid.
-    If valid, it returns the sent method and resource string.
+def stop_logging():
+    """
+    Writes the records that are still queued and stops the logging thread.
+    """
+    if log_listener is not None:
+        log_listener.stop()
+        for handler in log_listener.handlers:
+            handler.flush()
+
+
+def log_access(client_address, method: str, resource: str, status_code, bytes_sent: int, start_time: float):
+    """
+    Logs a single access line for a request (see ACCESS_LOG_FORMAT).
+    Only ACCESS_LOG_SAMPLE_RATE of the successful requests are logged, errors are always logged.
+    """
+    if int(status_code) < 400 and ACCESS_LOG_SAMPLE_RATE < 1 and random.random() >= ACCESS_LOG_SAMPLE_RATE:
+        return
+    if not logger.isEnabledFor(logging.INFO):
+        return
+
+    # The message is formatted by the logging thread
+    logger.info(ACCESS_LOG_FORMAT, {
+        'client': client_address[0] if client_address else '-',
+        'method': method,
+        'resource': resource.split(webroot_path)[-1],
+        'status': status_code,
+        'bytes': bytes_sent,
+        'duration_ms': (time.perf_counter() - start_time) * 1000})
 
-    Valid request   => (True, method, resource)
-    Invalid request => (False, method, resource) 
+
+def receive_request(client_socket: socket.socket, parser: HttpRequestParser, recv_buffer: memoryview,
+                    request_metrics: dict = None):
+    """
+    Receives data from the client until the parser has a whole request, and returns it.
+    The data after the request stays in the parser for the next (pipelined) request.
+    recv_buffer - a preallocated buffer that the data is received into.
+    request_metrics - if given, the time spent in the parser is saved in it (as 'parse').
+    Returns None if the client closed the connection.
     """
+    is_measured = request_metrics is not None
+    parse_start_time = time.perf_counter() if is_measured else 0
+    request = parser.next_request()
+    parse_time = time.perf_counter() - parse_start_time if is_measured else 0
 
-    # A (partial) list of valid http protocol request methods.
-    valid_request_methods = ['GET', 'HEAD', 'POST', 'PUT',
-                             'DELETE', 'TRACE', 'OPTIONS', 'CONNECT', 'PATCH']
+    while request is None:
+        received = client_socket.recv_into(recv_buffer)
+        if not received:
+            # The client closed the connection
+            return None
 
-    # Recieve request data from the client
-    request = client_socket.recv(1024)
+        if is_measured:
+            parse_start_time = time.perf_counter()
+        parser.feed(recv_buffer[:received])
+        request = parser.next_request()
+        if is_measured:
+            parse_time += time.perf_counter() - parse_start_time
 
-    # Using regex to determine weather or not the request is valid
-    # if re.match() returns a match object, the request is valid
-    request = re.match(rb'(.+) (.+) HTTP/1.1\r\n(.*:.*)\r\n*', request)
+    if is_measured:
+        request_metrics['parse'] = parse_time
+    return request
+
+
+def send_error_response(client_socket: socket.socket, status_code: int, phrase: str):
+    """
+    Sends a short error response to the client, and lets it know that the connection is closed.
+    """
+    body = f'<h1>Error {status_code} {phrase}.</h1>'.encode()
+    client_socket.sendall(f'{http_version} {status_code} {phrase}\r\nContent-Length: {len(body)}\r\n'
+                          f'Connection: close\r\n\r\n'.encode() + body)
+    logger.info(f'{http_version} {status_code} {phrase}')
+
+
+def validate_http_request(client_socket: socket.socket, parser: HttpRequestParser, recv_buffer: memoryview,
+                          request_metrics: dict = None):
+    """  
+    Determines weather or not the HTTP request is valid.
+    If valid, it returns the sent method, resource string and the parsed request.
+    parser - the connection's request parser (holds the data that wasn't handled yet).
+    recv_buffer - a preallocated buffer that the data is received into.
+    request_metrics - if given, the parsing time is measured into it.
+
+    Valid request   => (True, method, resource, request)
+    Invalid request => (False, method, resource, request) 
+    """
     method = 'GET'
     resource = default_url
 
-    # if re.match() returns None, the request is not a valid http request
+    # Recieve and parse the request from the client
+    try:
+        request = receive_request(client_socket, parser, recv_buffer, request_metrics)
+    except HttpParseError as e:
+        # Let the client know why the request was refused
+        logger.warning(f'Invalid request: {e}')
+        send_error_response(client_socket, e.status_code, e.phrase)
+        return False, '', '', None
+
+    # The client closed the connection
     if request is None:
-        return False, '', ''
+        return False, '', '', None
 
     # Get the request method and path from the request
-    request_method = request.group(1).decode()
-    request_path = request.group(2).decode()
+    request_method = request.method
+    request_path = request.target
 
-    logger.info(request_method + ' ' + request_path)
+    logger.debug('%s %s', request_method, request_path)
+
+    # The query string isn't a part of the file's path
+    request_path = request_path.split('?', 1)[0]
+
+    # The method applies to '/' as well (a HEAD response must not have a body)
+    # (the parser already made sure that the request method is a valid HTTP method)
+    method = request_method
 
     try:
-        # Check if the request method is a valid HTTP method
-        if request_method in valid_request_methods:
-            # There's no need to add anything to the resource path
-            # if the client tries to reach '/'
-            if request_path != '/':
-                method = request_method
-                resource = webroot_path + request_path
-
-                # Cut the last '/' if it exists
-                if resource[-1] == '/':
-                    resource = resource[:-1]
-
-                # Replace '/' with '\\' for windows compatibility.
-                resource = resource.replace('/', '\\')
-        else:
-            return False, '', ''
+        # There's no need to add anything to the resource path
+        # if the client tries to reach '/'
+        if request_path != '/':
+            # Cut the last '/' if it exists
+            if request_path[-1] == '/':
+                request_path = request_path[:-1]
+
+            # Find the file in the index, without building its path
+            indexed_resource = resource_index.urls.get(request_path) if RESOURCE_INDEX_ENABLED else None
+            if indexed_resource is not None:
+                resource = indexed_resource
+            else:
+                # Replace '/' with the OS's separator ('\\' on windows) for compatibility.
+                resource = webroot_path + request_path.lstrip('/').replace('/', os.sep)
 
-        return True, method, resource
+        return True, method, resource, request
 
     except (IndexError, AttributeError, TypeError) as e:
-        logger.critical(f'{e.message}\n\tResource: {resource}')
+        logger.critical(f'{e}\n\tResource: {resource}\n{traceback.format_exc()}')
+        send_error_response(client_socket, 500, 'Internal Server Error')
+        return False, '', '', None
 
 
-def handle_client_request(client_socket, method, resource):
+def send_buffers(client_socket: socket.socket, buffers):
     """
-    Serves the given resource to the client if the resource is available.
-    resource - the web page, file or other resource requested by the client.
+    Sends all the given buffers to the client, without joining them into a new buffer.
+    Uses a single sendmsg() (scatter-gather) when the OS supports it,
+    and keeps sending until every byte was written.
+    """
+    if not hasattr(client_socket, 'sendmsg'):
+        for buffer in buffers:
+            client_socket.sendall(buffer)
+        return
+
+    buffers = [memoryview(buffer) for buffer in buffers if buffer]
+    while buffers:
+        sent = client_socket.sendmsg(buffers)
+
+        # Skip the buffers that were fully sent, and cut the partially sent buffer
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers[0])
+            buffers.pop(0)
+        if buffers:
+            buffers[0] = buffers[0][sent:]
+
+
+def send_file(client_socket: socket.socket, file_path: str, offset: int, count: int):
+    """
+    Streams count bytes of the given file (starting at offset) to the client,
+    so that the memory usage stays flat regardless of the file's size.
+    Uses the zero-copy sendfile() when the OS supports it, and falls back to
+    sending fixed-size chunks. Returns the amount of bytes that were sent.
+    """
+    with open(file_path, 'rb') as f:
+        if hasattr(os, 'sendfile'):
+            return client_socket.sendfile(f, offset, count)
+
+        # Read each chunk into the same buffer, and send it until it's fully written
+        f.seek(offset)
+        chunk = bytearray(SEND_CHUNK_SIZE)
+        chunk_view = memoryview(chunk)
+        total_sent = 0
+        while total_sent < count:
+            chunk_length = f.readinto(chunk_view[:min(SEND_CHUNK_SIZE, count - total_sent)])
+            if not chunk_length:
+                break  # The file got shorter
+            client_socket.sendall(chunk_view[:chunk_length])
+            total_sent += chunk_length
+        return total_sent
+
+
+def build_file_metadata(resource: str, file_stat: os.stat_result):
+    """
+    Builds the 200 response of the given file without reading it (the body is None).
+    Files of unknown content types are served with an empty body.
     """
     # Get the resource type from the requested resource
     # Example for resource 'image13.jpg', the resource_type will be 'jpg'
     # rfind returns the index of the last appriance of the given substring
     resource_type = resource[resource.rfind('.') + 1:]
 
-    # Check if the resource is safe (no "/.." in it), and the requested file (resource) exists
+    # Get the content type using a simple library
+    # that gives the content type for each extension file
+    content_type = mimetypes.guess_type(f'file.{resource_type}')[0]
+    content_type_is_known = content_type is not None
+
+    # Make sure that the library gave us a content type
+    content_length = file_stat.st_size if content_type_is_known else 0
+    body = None if content_type_is_known else b''
+
+    file_response = FileResponse(None, body, content_length, content_type, resource,
+                                 file_stat.st_mtime_ns, file_stat.st_size)
+
+    # Concatenate the headers
+    file_response.build_headers()
+    return file_response
+
+
+def load_file_response(resource: str, file_metadata: FileResponse = None):
+    """
+    Reads the given file and builds the headers and body of its 200 response.
+    Big files are not read, their body is streamed from the disk when the response is sent.
+    file_metadata - the file's metadata (from the resource index), saves building the headers of the file.
+                    It's used only if it matches the opened file (the index may be a few seconds old).
+    """
+    with open(resource, 'rb') as f:
+        # Get the length and the modification time of the file that is actually served
+        file_stat = os.fstat(f.fileno())
+        if file_metadata is None or file_metadata.mtime_ns != file_stat.st_mtime_ns \
+                or file_metadata.size != file_stat.st_size:
+            file_metadata = build_file_metadata(resource, file_stat)
+
+        # Big files (and empty bodies) don't need to be read
+        if file_metadata.body is not None or file_metadata.length >= STREAM_MIN_FILE_SIZE:
+            return file_metadata
+
+        body = f.read()
+
+    file_response = FileResponse(file_metadata.headers, body, len(body), file_metadata.content_type,
+                                 resource, file_metadata.mtime_ns, file_metadata.size)
+    if len(body) != file_metadata.length:
+        # The file was changed between the fstat() and the read, the headers must match the body
+        file_response.build_headers()
+    return file_response
+
+
+def is_compressible(content_type: str):
+    """
+    Returns True if responses of the given content type are worth compressing.
+    """
+    return content_type is not None and content_type.startswith(tuple(COMPRESSIBLE_CONTENT_TYPES))
+
+
+def choose_content_encoding(accept_encoding: str):
+    """
+    Picks the best supported encoding from an Accept-Encoding header,
+    or returns None if the response should not be compressed.
+    Example: 'gzip;q=0.5, deflate' => 'deflate'
+    """
+    # Get the quality value of every encoding the client accepts
+    qualities = {}
+    for item in accept_encoding.split(','):
+        name, _, parameters = item.partition(';')
+        quality = 1.0
+        parameters = parameters.strip()
+        if parameters.startswith('q='):
+            try:
+                quality = float(parameters[2:])
+            except ValueError:
+                quality = 0.0
+        qualities[name.strip().lower()] = quality
+
+    # Pick the encoding with the highest quality (the first supported one wins a tie)
+    best_encoding = None
+    best_quality = 0.0
+    for encoding in SUPPORTED_ENCODINGS:
+        quality = qualities.get(encoding, qualities.get('*', 0.0))
+        if quality > best_quality:
+            best_encoding = encoding
+            best_quality = quality
+    return best_encoding
+
+
+def get_compressed_response(resource: str, file_response: FileResponse, encoding: str):
+    """
+    Returns the response of the given file in the given encoding, or None if it can't be compressed.
+    A pre-compressed '.gz' sibling of the file is used when it exists (and isn't older than the file),
+    otherwise the file is compressed once and kept in the compressed responses cache.
+    Big files (that are streamed from the disk) are only served compressed from a '.gz' sibling.
+    """
+    compressed_response = compressed_response_cache.get(resource, encoding)
+    if compressed_response is not None:
+        return compressed_response
+
+    # Look for a pre-compressed sibling of the file (like 'index.html.gz')
+    compressed_path = resource + '.gz'
+    if encoding == 'gzip' and os.path.isfile(compressed_path):
+        compressed_stat = os.stat(compressed_path)
+        if compressed_stat.st_mtime_ns >= file_response.mtime_ns:
+            if compressed_stat.st_size >= STREAM_MIN_FILE_SIZE:
+                body = None
+            else:
+                with open(compressed_path, 'rb') as f:
+                    body = f.read()
+            compressed_response = FileResponse(None, body, compressed_stat.st_size, file_response.content_type,
+                                               compressed_path, file_response.mtime_ns, file_response.size, encoding)
+
+    # Compress the file in memory
+    if compressed_response is None:
+        if file_response.body is None or len(file_response.body) < COMPRESSION_MIN_SIZE:
+            return None
+
+        if encoding == 'gzip':
+            body = gzip.compress(file_response.body, COMPRESSION_LEVEL, mtime=0)
+        else:
+            body = zlib.compress(file_response.body, COMPRESSION_LEVEL)
+        compressed_response = FileResponse(None, body, len(body), file_response.content_type,
+                                           resource, file_response.mtime_ns, file_response.size, encoding)
+
+    compressed_response.build_headers()
+    compressed_response_cache.put(resource, compressed_response)
+    return compressed_response
+
+
+def is_not_modified(file_response: FileResponse, request_headers: dict):
+    """
+    Checks the conditional headers of the request (If-None-Match, If-Modified-Since),
+    and returns True if the client already has the current version of the file.
+    """
+    # If-None-Match takes precedence over If-Modified-Since
+    if_none_match = request_headers.get('if-none-match')
+    if if_none_match is not None:
+        # Weak comparison, W/"x" matches "x"
+        etags = [etag.strip().removeprefix('W/') for etag in if_none_match.split(',')]
+        return '*' in etags or file_response.etag in etags
+
+    if_modified_since = request_headers.get('if-modified-since')
+    if if_modified_since is not None:
+        try:
+            since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            # Invalid dates are ignored
+            return False
+        return file_response.mtime_ns // 1_000_000_000 <= since
+
+    return False
+
+
+def parse_range_header(range_header: str, length: int):
+    """
+    Parses a 'Range: bytes=...' header of a body of the given length.
+    Returns a list of (start, count) tuples of the satisfiable ranges (an empty list if
+    none of them is satisfiable), or None if the header should be ignored.
+    Example: 'bytes=0-99, -50' on a 1000 bytes body => [(0, 100), (950, 50)]
+    """
+    if not range_header.startswith('bytes='):
+        return None
+
+    ranges = []
+    for range_spec in range_header[len('bytes='):].split(','):
+        start_text, separator, end_text = range_spec.strip().partition('-')
+        if not separator or not (start_text or end_text):
+            return None
+        if (start_text and not start_text.isdigit()) or (end_text and not end_text.isdigit()):
+            return None
+
+        if not start_text:
+            # Suffix range, the last N bytes of the body
+            suffix_length = int(end_text)
+            start = max(length - suffix_length, 0)
+            end = length - 1
+            if suffix_length == 0:
+                continue
+        else:
+            start = int(start_text)
+            end = int(end_text) if end_text else start
+            if end < start:
+                return None
+            end = min(end, length - 1) if end_text else length - 1
+
+        # Skip ranges that start after the end of the body
+        if start < length:
+            ranges.append((start, end - start + 1))
+
+    if len(ranges) > MAX_RANGES:
+        return None
+    return ranges
+
+
+def if_range_matches(file_response: FileResponse, request_headers: dict):
+    """
+    Returns True if the Range header should be used (the If-Range header is
+    missing, or it matches the current version of the file).
+    """
+    if_range = request_headers.get('if-range')
+    return if_range is None or if_range in (file_response.etag, file_response.last_modified)
+
+
+def handle_client_request(client_socket, method, resource, request_headers=None, keep_alive=False,
+                          client_address=None, request_metrics=None):
+    """
+    Serves the given resource to the client if the resource is available.
+    resource - the web page, file or other resource requested by the client.
+    request_headers - the headers of the request (lower-case names), used by
+                      conditional (ETag / If-Modified-Since) and Range requests.
+    keep_alive - whether or not the connection stays open after the response.
+    client_address - the address of the client (for the access log).
+    request_metrics - if given, the timings of the stages of the request are saved in it (see ServerMetrics).
+    Returns whether or not the connection can be kept alive after the response.
+    """
+    start_time = time.perf_counter()
+    request_headers = request_headers or {}
+
+    # Parts of the file that are sent as the body: (part_head, start, count).
+    # Used for streamed files and Range requests, instead of the in-memory body.
+    body_parts = None
+    body_trailer = b''
+
+    # Check if the resource is safe (no "/.." in it)
     if "/.." in resource or "\\.." in resource:
         # Requested resouce is unsafe
         logger.warning('!!! UNSAFE REQUEST !!!')
         status_code = 400
         phrase = 'Bad Request'
-        headers = ''
-        body = '<h1>Error 400 Bad Request.</h1>'
-    elif not os.path.isfile(resource):
-        # Resource not found, send code 404
-        logger.warning('404 ' + resource.split(webroot_path)
-                       [-1] + ' Not Found')
-
-        status_code = '404'
-        phrase = 'Not Found'
-        headers = ''
-        body = b'<h1>Error 404 File Not Found.</h1>'
+        body = b'<h1>Error 400 Bad Request.</h1>'
+        headers = f'Content-Length: {len(body)}'.encode()
     else:
-        # Resource found, send code 200
-        # and send the requested resource back to client
-        logger.info('200 ' + resource.split(webroot_path)[-1] + ' Found')
+        disk_start_time = time.perf_counter() if request_metrics is not None else 0
 
-        status_code = '200'
-        phrase = 'OK'
+        # Look for the response in the cache first, then make sure that the requested file (resource) exists
+        # (in the resource index, or on the disk)
+        file_response = file_response_cache.get(resource) if CACHE_ENABLED else None
+        if file_response is None:
+            file_metadata = resource_index.files.get(resource) if RESOURCE_INDEX_ENABLED else None
+            if file_metadata is not None or (not RESOURCE_INDEX_ENABLED and os.path.isfile(resource)):
+                try:
+                    file_response = load_file_response(resource, file_metadata)
+                except FileNotFoundError:
+                    # The file was deleted after it was indexed
+                    file_response = None
+                if CACHE_ENABLED and file_response is not None:
+                    file_response_cache.put(resource, file_response)
 
-        # Get the length of the resource file
-        content_length = os.stat(resource).st_size
+        # Send a compressed version of the file if the client accepts one.
+        # Range requests are always served from the uncompressed file.
+        if file_response is not None and COMPRESSION_ENABLED and is_compressible(file_response.content_type) \
+                and 'range' not in request_headers:
+            encoding = choose_content_encoding(request_headers.get('accept-encoding', ''))
+            if encoding is not None:
+                file_response = get_compressed_response(resource, file_response, encoding) or file_response
 
-        # Get the content type using a simple library
-        # that gives the content type for each extension file
-        content_type = mimetypes.guess_type(f'file.{resource_type}')[0]
-        content_type_is_known = content_type is not None
+        if request_metrics is not None:
+            request_metrics['disk'] = time.perf_counter() - disk_start_time
 
-        # Make sure that the library gave us a content type
-        if content_type_is_known:
-            with open(resource, 'rb') as f:
-                body = f.read()
-        else:
+        if file_response is None:
+            # Resource not found, send code 404
+            logger.debug('404 %s Not Found', resource.split(webroot_path)[-1])
+
+            status_code = '404'
+            phrase = 'Not Found'
+            body = b'<h1>Error 404 File Not Found.</h1>'
+            headers = f'Content-Length: {len(body)}'.encode()
+        elif is_not_modified(file_response, request_headers):
+            # The client already has this version of the file, send code 304 without a body
+            logger.debug('304 %s Not Modified', resource.split(webroot_path)[-1])
+
+            status_code = '304'
+            phrase = 'Not Modified'
             body = b''
+            headers = file_response.validator_headers().encode()
+        else:
+            # Resource found, send code 200
+            # and send the requested resource back to client
+            logger.debug('200 %s Found', resource.split(webroot_path)[-1])
+
+            status_code = '200'
+            phrase = 'OK'
+            headers = file_response.headers
+            body = file_response.body
+
+            # Big files are streamed from the disk
+            if body is None:
+                body_parts = [(b'', 0, file_response.length)]
 
-        # Concatenate the headers
-        headers = f'Content-Length: {content_length}\r\nContent-Type: {content_type}'
+            # Check if the client asked only for some parts of the file
+            ranges = None
+            if method == 'GET' and 'range' in request_headers and if_range_matches(file_response, request_headers):
+                ranges = parse_range_header(request_headers['range'], file_response.length)
+
+            if ranges == []:
+                # None of the ranges is inside the file, send code 416
+                status_code = '416'
+                phrase = 'Range Not Satisfiable'
+                body = b''
+                body_parts = None
+                headers = f'Content-Length: 0\r\nContent-Range: bytes */{file_response.length}'.encode()
+            elif ranges is not None and len(ranges) == 1:
+                # Send a single part of the file, with code 206
+                start, count = ranges[0]
+                status_code = '206'
+                phrase = 'Partial Content'
+                body = None
+                body_parts = [(b'', start, count)]
+                headers = (f'Content-Length: {count}\r\nContent-Type: {file_response.content_type}\r\n'
+                           f'Content-Range: bytes {start}-{start + count - 1}/{file_response.length}\r\n'
+                           f'{file_response.validator_headers()}').encode()
+            elif ranges is not None:
+                # Send multiple parts of the file in a multipart/byteranges body, with code 206
+                status_code = '206'
+                phrase = 'Partial Content'
+                body = None
+                body_parts = []
+                for start, count in ranges:
+                    part_head = (f'\r\n--{MULTIPART_BOUNDARY}\r\nContent-Type: {file_response.content_type}\r\n'
+                                 f'Content-Range: bytes {start}-{start + count - 1}/{file_response.length}\r\n\r\n').encode()
+                    body_parts.append((part_head, start, count))
+                body_trailer = f'\r\n--{MULTIPART_BOUNDARY}--\r\n'.encode()
+
+                content_length = sum(len(part_head) + count for part_head, _, count in body_parts) + len(body_trailer)
+                headers = (f'Content-Length: {content_length}\r\n'
+                           f'Content-Type: multipart/byteranges; boundary={MULTIPART_BOUNDARY}\r\n'
+                           f'{file_response.validator_headers()}').encode()
+
+    # Let the client know if it can send more requests on this connection
+    if keep_alive:
+        headers += f'\r\nConnection: keep-alive\r\nKeep-Alive: timeout={KEEP_ALIVE_TIMEOUT}, max={MAX_KEEP_ALIVE_REQUESTS}'.encode()
+    else:
+        headers += b'\r\nConnection: close'
 
     # Example: HTTP/1.1 200 OK
     response_status = f'{http_version} {status_code} {phrase}'
 
-    # Send response to client
-    client_socket.send(response_status.encode() + b'\r\n' +
-                       headers.encode() + b'\r\n\r\n' + body)
-    logger.info(response_status)
+    # Send response to client (the response to HEAD has no body)
+    response_head = response_status.encode() + b'\r\n' + headers + b'\r\n\r\n'
+    bytes_sent = len(response_head)
+    send_start_time = time.perf_counter() if request_metrics is not None else 0
+    if method == 'HEAD':
+        client_socket.sendall(response_head)
+    elif body_parts is None:
+        send_buffers(client_socket, [response_head, body])
+        bytes_sent += len(body)
+    else:
+        client_socket.sendall(response_head)
+        for part_head, start, count in body_parts:
+            if part_head:
+                client_socket.sendall(part_head)
+                bytes_sent += len(part_head)
+
+            if file_response.body is not None:
+                client_socket.sendall(memoryview(file_response.body)[start:start + count])
+            elif send_file(client_socket, file_response.path, start, count) != count:
+                # The file changed while it was sent, so the response is broken
+                logger.warning(f'{resource} changed while it was sent')
+                return False
+            bytes_sent += count
+        if body_trailer:
+            client_socket.sendall(body_trailer)
+            bytes_sent += len(body_trailer)
+
+    if request_metrics is not None:
+        end_time = time.perf_counter()
+        request_metrics['send'] = end_time - send_start_time
+        request_metrics['total'] = end_time - start_time
+        if 'accept_time' in request_metrics:
+            request_metrics['accept_to_first_byte'] = send_start_time - request_metrics['accept_time']
+        request_metrics['status'] = status_code
+        request_metrics['bytes'] = bytes_sent
+        server_metrics.observe_request(request_metrics)
+
+    log_access(client_address, method, resource, status_code, bytes_sent, start_time)
+    return keep_alive
+
+
+def send_metrics_response(client_socket: socket.socket, keep_alive: bool):
+    """
+    Sends the metrics of all the worker processes to the client (in the Prometheus text format).
+    Returns whether or not the connection can be kept alive after the response.
+    """
+    body = server_metrics.render().encode()
+    connection_header = 'keep-alive' if keep_alive else 'close'
+    client_socket.sendall(f'{http_version} 200 OK\r\nContent-Length: {len(body)}\r\n'
+                          f'Content-Type: text/plain; version=0.0.4\r\n'
+                          f'Connection: {connection_header}\r\n\r\n'.encode() + body)
+    return keep_alive
+
+
+def serve_client(client_socket: socket.socket, client_address, accept_time: float = None):
+    """
+    Serves a single client connection. Runs inside one of the worker threads.
+    The connection is kept alive (HTTP/1.1) and serves pipelined requests
+    until the client closes it, idles for too long or reaches the requests limit.
+    The client socket is always closed when the serving ends.
+    accept_time - when the connection was accepted (time.perf_counter()), used by the metrics.
+    """
+    with client_socket:
+        # Make sure that a slow client can't hold a worker thread forever
+        client_socket.settimeout(CLIENT_TIMEOUT)
+
+        # Parses the data received from the client (and keeps the data that wasn't handled yet)
+        parser = HttpRequestParser(MAX_REQUEST_HEAD_SIZE, MAX_REQUEST_BODY_SIZE, MAX_REQUEST_HEADERS)
+        recv_buffer = memoryview(bytearray(RECV_SIZE))
+        requests_served = 0
+
+        try:
+            while True:
+                # Measure the request only if the metrics are enabled
+                request_metrics = None
+                if METRICS_ENABLED:
+                    request_metrics = {}
+                    if requests_served == 0 and accept_time is not None:
+                        request_metrics['accept_time'] = accept_time
+
+                # If the client sent a valid http request, handle it
+                is_valid, method, resource, request = validate_http_request(
+                    client_socket, parser, recv_buffer, request_metrics)
+                if not is_valid:
+                    break
+                requests_served += 1
+
+                # Keep the connection open unless the client asked to close it,
+                # it used all of its requests or the server is shutting down
+                keep_alive = request.keep_alive and \
+                    requests_served < MAX_KEEP_ALIVE_REQUESTS and not shutdown_event.is_set()
+                if METRICS_ENABLED and request.target == METRICS_PATH \
+                        and client_address[0] in METRICS_ALLOWED_CLIENTS:
+                    keep_alive = send_metrics_response(client_socket, keep_alive)
+                else:
+                    keep_alive = handle_client_request(client_socket, method, resource, request.headers,
+                                                       keep_alive, client_address, request_metrics)
+                if not keep_alive:
+                    break
+
+                # Wait a shorter time for the next request
+                client_socket.settimeout(KEEP_ALIVE_TIMEOUT)
+        except socket.timeout:
+            # The client didn't send another request in time
+            logger.info(f'{client_address} Idle timeout ({requests_served} requests served)')
+        except TypeError as e:
+            exc_tb = sys.exc_info()[2]  # The exception's traceback
+            logger.critical(
+                f'{e}\tline {exc_tb.tb_lineno}\n{traceback.format_exc()}\n')
+        except OSError as e:
+            # The client disconnected or timed out in the middle of the request
+            logger.warning(f'{client_address} Connection error: {e}')
+
+
+def serve_forever(server_socket: socket.socket):
+    """
+    Accepts clients until shutdown_event is set, and hands them to a bounded pool of threads.
+    When the server shuts down, it stops accepting and lets the in-flight requests drain.
+    """
+    # Limits the amount of accepted clients that wait for a thread,
+    # so that the accept loop won't queue an unbounded amount of sockets
+    free_slots = threading.BoundedSemaphore(WORKER_THREADS + MAX_PENDING_CLIENTS)
+
+    def serve_and_release(client_socket, client_address, accept_time):
+        try:
+            serve_client(client_socket, client_address, accept_time)
+        finally:
+            free_slots.release()
+
+    # Index the webroot and keep the index up to date
+    if RESOURCE_INDEX_ENABLED:
+        resource_index.build()
+        resource_index.start_watching()
+
+    # Wake up every once in a while to check if the server should shut down
+    server_socket.settimeout(ACCEPT_TIMEOUT)
+
+    with ThreadPoolExecutor(max_workers=WORKER_THREADS) as executor:
+        while not shutdown_event.is_set():
+            # Wait for a free slot before accepting another client
+            if not free_slots.acquire(timeout=ACCEPT_TIMEOUT):
+                continue
+
+            # Accept and create a connection socket with the client
+            try:
+                client_socket, client_address = server_socket.accept()
+                accept_time = time.perf_counter() if METRICS_ENABLED else None
+            except (socket.timeout, InterruptedError):
+                free_slots.release()
+                continue
+            except OSError as e:
+                # The listening socket was closed
+                free_slots.release()
+                logger.warning(f'Accept failed: {e}')
+                break
+
+            # Client sockets must be blocking (the listening socket has a timeout)
+            client_socket.setblocking(True)
+            logger.debug('%s Connected', client_address)
+            executor.submit(serve_and_release, client_socket, client_address, accept_time)
+
+        # Leaving the 'with' block waits for the in-flight requests to finish
+        logger.info('Shutting down, waiting for in-flight requests...')
+
+
+def request_shutdown(signal_number=None, frame=None):
+    """
+    Makes the server stop accepting new clients (used as a signal handler as well).
+    """
+    shutdown_event.set()
+
+
+def worker_process_main(server_socket: socket.socket, log_file_name: str, metrics_values, process_index: int):
+    """
+    The entry point of a worker process.
+    Every worker process accepts clients from the same (shared) listening socket.
+    metrics_values, process_index - the metrics shared by all the processes, and the slot of this process in them.
+    """
+    global logger
+    logger = setup_logging(log_file_name, file_mode='a')
+    server_metrics.attach(metrics_values, process_index)
+
+    # The parent process handles Ctrl+C, the workers only stop on SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, request_shutdown)
+
+    try:
+        serve_forever(server_socket)
+    finally:
+        stop_logging()
 
 
 def main():
+    # The port can be given as an argument: python http_server.py [port]
+    global SERVER_PORT
+    if len(sys.argv) > 1:
+        if not sys.argv[1].isdigit():
+            print(f'USAGE\n\tpython {__file__} [port]\n')
+            return
+        SERVER_PORT = int(sys.argv[1])
+
     # Setup the logging for the console and log file
     global logger
     logger = setup_logging('log.txt')
 
     # Create a socket to listen to clients
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_address = ('0.0.0.0', 80)  # '0.0.0.0' stands for the local ip
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server_address = ('0.0.0.0', SERVER_PORT)  # '0.0.0.0' stands for the local ip
 
     try:
         server_socket.bind(server_address)
@@ -180,24 +1317,39 @@ def main():
         return  # The server cannot bind to the address, so we need to close it
 
     # Start listening for clients
-    server_socket.listen()
-    logger.info('Listening on port 80')
+    server_socket.listen(LISTEN_BACKLOG)
+    logger.info(f'Listening on port {SERVER_PORT}')
 
-    while True:
-        # Accept and create a connection socket with the client
-        client_socket, client_address = server_socket.accept()
+    # Stop gracefully when the server is asked to terminate.
+    # Ctrl+C is handled the same way (instead of raising KeyboardInterrupt), so that the
+    # shutdown starts right away, and the in-flight connections get 'Connection: close'
+    # while the thread pool drains (and not only after it finished).
+    signal.signal(signal.SIGTERM, request_shutdown)
+    signal.signal(signal.SIGINT, request_shutdown)
 
-        logger.info(f'{client_address} Connected')
+    # Start extra worker processes, so that all the cores are used.
+    # The current process is a worker as well.
+    workers = []
+    # The current process counts its metrics into the first slot.
+    for process_index in range(1, WORKER_PROCESSES):
+        worker = multiprocessing.Process(
+            target=worker_process_main, args=(server_socket, 'log.txt', server_metrics.values, process_index))
+        worker.start()
+        workers.append(worker)
 
-        # If the client sent a valid http request, handle it
-        try:
-            is_valid, method, resource = validate_http_request(client_socket)
-            if is_valid:
-                handle_client_request(client_socket, method, resource)
-        except TypeError as e:
-            exc_tb = sys.exc_info()[2]  # The exception's traceback
-            logger.critical(
-                f'{e}\tline {exc_tb.tb_lineno}\n{traceback.format_exc()}\n')
+    try:
+        serve_forever(server_socket)
+    finally:
+        # Let the worker processes drain their requests, then close the server
+        for worker in workers:
+            worker.terminate()  # On POSIX this sends SIGTERM (graceful shutdown)
+        for worker in workers:
+            worker.join()
+        server_socket.close()
+        logger.info(f'File cache: {file_response_cache.stats()}')
+        logger.info(f'Compressed file cache: {compressed_response_cache.stats()}')
+        logger.info('Server stopped')
+        stop_logging()
 
 
 if __name__ == '__main__':
@@ -9,17 +9,339 @@ For example, if the requesting ip is 56.104.74.10 and the port is 7070, the requ
        |--------IP--------|---PORT---|---------DATA---------|
 ASCII:  8    h    J    \n   \x1b \x9e H    T    T    P  ...
 HEX:    38   68   4A   0A   1b   9e   48   54   54   50 ...
+
+The load balancer may also open a long-lived connection in the framed version of the protocol,
+which carries many requests and responses at the same time (see proxy_protocol.py).
 """
 
 
 import socket
-import re
+import os
+import sys
+import select
+import time
+import threading
+import email.utils
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# The HTTP parser is shared with the HTTP server, it's in the 'Web Server' folder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from http_parser import HttpRequestParser, HttpResponseParser, HttpParseError
+from proxy_protocol import FRAME_PREFACE, MAX_FRAME_PAYLOAD, FLAG_END_STREAM, FLAG_RESET, \
+    FrameParser, ProtocolError, encode_frame_header
 
 MAX_PACKET_SIZE = 65536
 IP_REGEX = '(?P<src_address>(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?))'
 ENDPOINT_LENGTH = 6  # Length in bytes
 VALID_HTTP_METHODS = ['GET', 'HEAD', 'POST', 'PUT',
                       'DELETE', 'TRACE', 'OPTIONS', 'CONNECT', 'PATCH']
+VALID_METHOD_NAMES = frozenset(method.encode() for method in VALID_HTTP_METHODS)
+MAX_METHOD_LENGTH = max(len(method) for method in VALID_HTTP_METHODS)
+IDEMPOTENT_HTTP_METHODS = ['GET', 'HEAD', 'PUT', 'DELETE', 'TRACE', 'OPTIONS']
+
+# Concurrency settings
+MAX_CONCURRENT_REQUESTS = 64    # Amount of requests that are proxied at the same time
+MAX_PENDING_REQUESTS = 128      # Max accepted requests waiting for a free worker
+LISTEN_BACKLOG = 128            # Max amount of pending connections in the OS queue
+
+# Per-stage timeouts (in seconds)
+REQUEST_RECV_TIMEOUT = 5        # Receiving the request from the load balancer
+BACKEND_CONNECT_TIMEOUT = 2     # Connecting to the local server
+BACKEND_RESPONSE_TIMEOUT = 15   # Sending the request to the local server and receiving its response
+PROXY_CONNECT_TIMEOUT = 2       # Connecting back to the load balancer
+PROXY_SEND_TIMEOUT = 10         # Sending the response to the load balancer
+
+# Connection pooling settings
+BACKEND_KEEP_ALIVE = True           # Reuse the connections to the local server between requests
+POOL_PROXY_CONNECTIONS = False      # Reuse the connections back to the load balancer
+                                    # (only for a load balancer that reads many responses from one connection)
+MAX_CONNECTIONS_PER_HOST = 64       # Max amount of connections in use to the same host
+MAX_IDLE_CONNECTIONS_PER_HOST = 16  # Max amount of idle connections kept open to the same host
+MAX_IDLE_TIME = 4                   # Seconds an idle connection is kept (below the server's keep-alive timeout)
+
+# Relay settings
+STREAMING_RELAY = True              # Pipe the responses to the load balancer while they're received
+                                    # (instead of receiving the whole response first)
+RELAY_BUFFER_SIZE = 64 * 1024       # Size of the buffer that a streamed response goes through
+
+# Framed protocol settings (see proxy_protocol.py)
+FRAMED_PROTOCOL_ENABLED = True      # Accept framed connections (they start with the protocol's preface)
+MAX_FRAMED_REQUEST_SIZE = MAX_PACKET_SIZE   # Max size of a request that is received in frames
+
+# Response cache settings
+RESPONSE_CACHE_ENABLED = False                  # Serve repeated requests from a cache inside the agent
+RESPONSE_CACHE_MAX_SIZE = 64 * 1024 * 1024      # Max total size of the cached responses (in bytes)
+RESPONSE_CACHE_MAX_ENTRY_SIZE = 1024 * 1024     # Bigger responses are never cached (in bytes)
+RESPONSE_CACHE_MAX_HEURISTIC_TTL = 10           # Max seconds to cache a response without Cache-Control / Expires
+                                                # (by its Last-Modified, 0 - only cache explicitly fresh responses)
+CACHE_KEY_HEADERS = ('host', 'accept-encoding')     # Request headers that are a part of the cache key
+CACHE_BYPASS_HEADERS = ('authorization', 'cookie', 'range',     # Requests with these headers skip the cache
+                        'if-none-match', 'if-modified-since', 'if-range')
+CACHEABLE_METHODS = ('GET', 'HEAD')
+CACHEABLE_STATUS_CODES = (200, 203, 301, 404, 410)
+
+
+class ConnectionPool:
+    '''
+    A pool of persistent connections, kept separately for every host (address).
+    A connection is taken with acquire() and given back with release(), and if it can be reused
+    it waits (idle) for the next request to the same host.
+    Idle connections are checked before they're reused, so connections that were closed
+    by the other side (or that have unexpected data waiting) are thrown away.
+    '''
+
+    def __init__(self, connect_timeout, max_connections_per_host=MAX_CONNECTIONS_PER_HOST,
+                 max_idle_per_host=MAX_IDLE_CONNECTIONS_PER_HOST, max_idle_time=MAX_IDLE_TIME):
+        self.connect_timeout = connect_timeout
+        self.max_connections_per_host = max_connections_per_host
+        self.max_idle_per_host = max_idle_per_host
+        self.max_idle_time = max_idle_time
+
+        self._lock = threading.Lock()
+        self._idle_connections = {}     # Address -> list of (socket, idle since), the newest is last
+        self._host_limits = {}          # Address -> semaphore of the connections in use
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+
+    def acquire(self, address):
+        '''
+        Returns a connection to the given address and whether or not it was reused.
+        Waits (up to the connect timeout) if the host's limit of connections in use was reached.
+        '''
+        host_limit = self._get_host_limit(address)
+        if not host_limit.acquire(timeout=self.connect_timeout):
+            raise TimeoutError(f"Too many connections to {address}")
+
+        try:
+            sock = self._take_idle_connection(address)
+            if sock is not None:
+                return sock, True
+
+            sock = socket.create_connection(address, timeout=self.connect_timeout)
+            with self._lock:
+                self.created += 1
+            return sock, False
+        except BaseException:
+            host_limit.release()
+            raise
+
+    def release(self, address, sock, reusable):
+        '''
+        Gives a connection back to the pool.
+        A reusable connection is kept idle (if there's room for it), any other connection is closed.
+        '''
+        try:
+            if reusable:
+                now = time.monotonic()
+                with self._lock:
+                    idle_connections = self._idle_connections.setdefault(address, [])
+                    self._close_expired(idle_connections, now)
+                    if len(idle_connections) < self.max_idle_per_host:
+                        idle_connections.append((sock, now))
+                        return
+            sock.close()
+        finally:
+            self._host_limits[address].release()
+
+    def close_all(self):
+        '''
+        Closes all the idle connections.
+        '''
+        with self._lock:
+            for idle_connections in self._idle_connections.values():
+                for sock, _ in idle_connections:
+                    sock.close()
+                idle_connections.clear()
+
+    def _get_host_limit(self, address):
+        with self._lock:
+            if address not in self._host_limits:
+                self._host_limits[address] = threading.BoundedSemaphore(self.max_connections_per_host)
+            return self._host_limits[address]
+
+    def _take_idle_connection(self, address):
+        '''
+        Returns the most recently used healthy idle connection to the address, or None if there isn't one.
+        '''
+        now = time.monotonic()
+        with self._lock:
+            idle_connections = self._idle_connections.get(address, [])
+            self._close_expired(idle_connections, now)
+            while idle_connections:
+                sock, _ = idle_connections.pop()
+
+                # An idle connection has nothing to read - if it's readable,
+                # the other side closed it (or sent something it shouldn't have)
+                try:
+                    readable, _, _ = select.select([sock], [], [], 0)
+                except (OSError, ValueError):
+                    readable = True
+                if readable:
+                    sock.close()
+                    self.discarded += 1
+                    continue
+
+                self.reused += 1
+                return sock
+        return None
+
+    def _close_expired(self, idle_connections, now):
+        '''
+        Closes the connections that were idle for too long (the oldest connections are first).
+        Should be called while holding the lock.
+        '''
+        while idle_connections and now - idle_connections[0][1] > self.max_idle_time:
+            sock, _ = idle_connections.pop(0)
+            sock.close()
+            self.discarded += 1
+
+
+# Persistent connections to the local server and back to the load balancer
+backend_pool = ConnectionPool(BACKEND_CONNECT_TIMEOUT)
+proxy_pool = ConnectionPool(PROXY_CONNECT_TIMEOUT)
+
+
+class ResponseCache:
+    '''
+    A cache of whole responses of the local server (head and body), shared by all the workers.
+    An entry is kept for the freshness lifetime the server gave its response, and when the cache
+    is over its size limit the least recently used entries are dropped.
+    Concurrent misses of the same key are coalesced: a single request goes to the local server,
+    and the others wait for its response to be cached.
+    '''
+
+    def __init__(self, max_size, max_entry_size):
+        self.max_size = max_size
+        self.max_entry_size = max_entry_size
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # Key -> (response data, expiration time), the most recently used is last
+        self._size = 0
+        self._fetches = {}              # Key -> event that is set when the response that is being fetched is done
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def lookup(self, key, wait_timeout):
+        '''
+        Returns the cached response of the key (or None), and whether or not the caller should fetch it
+        and then call end_fetch(). If the key is already being fetched, waits for it first -
+        and if it still isn't cached, the caller fetches it without caching.
+        '''
+        with self._lock:
+            response_data = self._get_fresh(key)
+            if response_data is not None:
+                self.hits += 1
+                return response_data, False
+
+            fetch_done = self._fetches.get(key)
+            if fetch_done is None:
+                self._fetches[key] = threading.Event()
+                self.misses += 1
+                return None, True
+
+        # Wait for the request that is already fetching the same response
+        fetch_done.wait(wait_timeout)
+        with self._lock:
+            response_data = self._get_fresh(key)
+            if response_data is not None:
+                self.coalesced += 1
+            return response_data, False
+
+    def end_fetch(self, key, response_data=None, ttl=0):
+        '''
+        Ends the fetch of a key, and caches the response for ttl seconds (if there's one to cache).
+        Wakes up the requests that wait for the key.
+        '''
+        with self._lock:
+            if response_data is not None and ttl > 0 and len(response_data) <= self.max_entry_size:
+                self._remove(key)
+                self._entries[key] = (response_data, time.monotonic() + ttl)
+                self._size += len(response_data)
+
+                # Drop the least recently used entries until the cache fits its limit
+                while self._size > self.max_size:
+                    self._remove(next(iter(self._entries)))
+
+            fetch_done = self._fetches.pop(key, None)
+        if fetch_done is not None:
+            fetch_done.set()
+
+    def _get_fresh(self, key):
+        '''
+        Returns the response of the key if it's cached and fresh, should be called while holding the lock.
+        '''
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() >= entry[1]:
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry[0])
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_MAX_SIZE, RESPONSE_CACHE_MAX_ENTRY_SIZE)
+
+
+def get_cache_key(request):
+    '''
+    Returns the key of a request in the response cache, or None if the request shouldn't use the cache.
+    '''
+    if request.method not in CACHEABLE_METHODS:
+        return None
+    if any(header in request.headers for header in CACHE_BYPASS_HEADERS):
+        return None
+    cache_control = request.headers.get('cache-control', '').lower()
+    if 'no-cache' in cache_control or 'no-store' in cache_control:
+        return None
+    return (request.method, request.target) + tuple(request.headers.get(header, '') for header in CACHE_KEY_HEADERS)
+
+
+def get_freshness_lifetime(response_parser):
+    '''
+    Returns the amount of seconds a response may be served from the cache (0 if it shouldn't be cached),
+    by its Cache-Control (s-maxage / max-age), by its Expires, or a short heuristic lifetime
+    by its Last-Modified (a tenth of its age, like browsers do).
+    '''
+    headers = response_parser.headers
+    if response_parser.status_code not in CACHEABLE_STATUS_CODES or 'set-cookie' in headers:
+        return 0
+
+    # The cache key has only some of the request headers, so the response can't vary by others
+    vary = [header.strip().lower() for header in headers.get('vary', '').split(',') if header.strip()]
+    if any(header not in CACHE_KEY_HEADERS for header in vary):
+        return 0
+
+    directives = {}
+    for directive in headers.get('cache-control', '').lower().split(','):
+        name, _, value = directive.strip().partition('=')
+        directives[name] = value.strip('"')
+    if 'no-store' in directives or 'no-cache' in directives or 'private' in directives:
+        return 0
+
+    try:
+        for name in ('s-maxage', 'max-age'):
+            if name in directives:
+                return max(int(directives[name]), 0)
+
+        date = email.utils.parsedate_to_datetime(headers['date']).timestamp() if 'date' in headers else time.time()
+        if 'expires' in headers:
+            return max(email.utils.parsedate_to_datetime(headers['expires']).timestamp() - date, 0)
+        if 'last-modified' in headers:
+            last_modified = email.utils.parsedate_to_datetime(headers['last-modified']).timestamp()
+            return min(max((date - last_modified) / 10, 0), RESPONSE_CACHE_MAX_HEURISTIC_TTL)
+    except (ValueError, TypeError):
+        # An invalid date (or number) means the response is already stale
+        return 0
+    return 0
 
 
 def get_port(msg, excluded_ports=[]):
@@ -43,41 +365,597 @@ def get_port(msg, excluded_ports=[]):
     return port
 
 
-def recv_dynamic_data(sock, chunk_size):
+def send_buffers(sock, buffers):
+    '''
+    This function sends all the given buffers, without joining them into a new buffer.
+    Uses sendmsg() (scatter-gather) when the OS supports it, and keeps sending until every byte was written.
+    '''
+    if not hasattr(sock, 'sendmsg'):
+        for buffer in buffers:
+            sock.sendall(buffer)
+        return
+
+    buffers = [memoryview(buffer) for buffer in buffers if len(buffer)]
+    while buffers:
+        sent = sock.sendmsg(buffers)
+
+        # Skip the buffers that were fully sent, and cut the partially sent buffer
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers[0])
+            buffers.pop(0)
+        if buffers:
+            buffers[0] = buffers[0][sent:]
+
+
+def set_connection_header(message, connection):
+    '''
+    Returns the HTTP message (request or response) with its hop-by-hop Connection and Keep-Alive headers
+    replaced by 'Connection: <connection>'. A message without a complete head is returned as-is.
+    '''
+    head_end = message.find(b'\r\n\r\n')
+    if head_end == -1:
+        return message
+
+    lines = message[:head_end].split(b'\r\n')
+    lines = [lines[0]] + [line for line in lines[1:]
+                          if line.split(b':', 1)[0].strip().lower() not in (b'connection', b'keep-alive')]
+    lines.append(b'Connection: ' + connection.encode())
+    return b'\r\n'.join(lines) + message[head_end:]
+
+
+def request_local_server(request_data, method, local_server_port, reuse_connection):
+    '''
+    This function sends a request to the local server over a pooled connection,
+    and returns the whole response and its parser (which tells if the response was keep-alive).
+    A reused connection that the server closed while it was idle is replaced by a new one,
+    as long as the request is safe to send again.
+    '''
+    address = ("localhost", local_server_port)
+    while True:
+        local_server_socket, reused = backend_pool.acquire(address)
+        response_parser = HttpResponseParser(method)
+        response_parts = []
+        reusable = False
+        try:
+            local_server_socket.settimeout(BACKEND_RESPONSE_TIMEOUT)
+            local_server_socket.sendall(request_data)
+
+            # Receive the response until its end
+            # (a slow response only holds the thread that handles it)
+            while not response_parser.complete:
+                data = local_server_socket.recv(MAX_PACKET_SIZE)
+                if not data:
+                    response_parser.finish()
+                    break
+
+                consumed = response_parser.feed(data)
+                response_parts.append(data[:consumed])
+                # The server shouldn't send anything after the response
+                reusable = consumed == len(data)
+        except (OSError, HttpParseError):
+            backend_pool.release(address, local_server_socket, reusable=False)
+            if reused and not response_parts and method in IDEMPOTENT_HTTP_METHODS:
+                print("Reused connection was closed by the local server, retrying")
+                continue
+            raise
+
+        backend_pool.release(address, local_server_socket,
+                             reusable=reuse_connection and reusable and response_parser.keep_alive)
+        return b''.join(response_parts), response_parser
+
+
+def open_proxy_connection(first_data, address):
+    '''
+    This function connects to the load balancer's response port (or takes a pooled connection to it),
+    sends the first data of a message and returns the connection.
+    A pooled connection that turned out to be closed is replaced by a new one.
+    '''
+    while True:
+        if POOL_PROXY_CONNECTIONS:
+            proxy_response_socket, reused = proxy_pool.acquire(address)
+        else:
+            proxy_response_socket = socket.create_connection(address, timeout=PROXY_CONNECT_TIMEOUT)
+            reused = False
+
+        try:
+            proxy_response_socket.settimeout(PROXY_SEND_TIMEOUT)
+            proxy_response_socket.sendall(first_data)
+            return proxy_response_socket
+        except OSError:
+            release_proxy_connection(address, proxy_response_socket, reusable=False)
+            if reused:
+                print("Reused connection was closed by the proxy, retrying")
+                continue
+            raise
+
+
+def release_proxy_connection(address, proxy_response_socket, reusable):
+    '''
+    This function gives a connection to the load balancer back to the pool, or closes it if there's no pool.
+    '''
+    if POOL_PROXY_CONNECTIONS:
+        proxy_pool.release(address, proxy_response_socket, reusable)
+    else:
+        proxy_response_socket.close()
+
+
+class ProxyResponseChannel:
+    '''
+    Sends a response back to the load balancer in the raw protocol:
+    on its own connection to the response port, prefixed by the client's endpoint.
+    '''
+
+    def __init__(self, dst_endpoint, address):
+        self.dst_endpoint = dst_endpoint
+        self.address = address
+        self.proxy_response_socket = None
+
+    def start(self, data):
+        self.proxy_response_socket = open_proxy_connection(self.dst_endpoint + data, self.address)
+
+    def send(self, data):
+        self.proxy_response_socket.sendall(data)
+
+    def finish(self):
+        release_proxy_connection(self.address, self.proxy_response_socket, reusable=True)
+        self.proxy_response_socket = None
+
+    def abort(self):
+        # Nothing is sent, the load balancer times out the request
+        if self.proxy_response_socket is not None:
+            release_proxy_connection(self.address, self.proxy_response_socket, reusable=False)
+            self.proxy_response_socket = None
+
+
+class FramedResponseChannel:
     '''
-    This function recieves data of size total_size using given socket in chunks of chunk_size.
+    Sends a response back to the load balancer in the framed protocol:
+    as the frames of its stream, on the framed connection the request came from.
     '''
-    full_data = b''
 
-    # Receive the length of the data
-    total_size_in_bytes = sock.recv(4) # 4 is the length of int in bytes
-    # Convert the byte-formatted total size to int
-    total_size = int.from_bytes(total_size_in_bytes, byteorder="big", signed=False)
+    def __init__(self, connection, stream_id, dst_endpoint):
+        self.connection = connection
+        self.stream_id = stream_id
+        self.dst_endpoint = dst_endpoint
 
-    # Recieve the data pieces and join them together
-    while len(full_data) < total_size:
-        chunk_data = sock.recv(chunk_size)
-        print(f"Recieved {len(chunk_data)}")
-        full_data = full_data + chunk_data
-    
-    # Return the data
-    return full_data
+    def start(self, data):
+        self.send(data)
 
+    def send(self, data):
+        view = memoryview(data)
+        for offset in range(0, len(view), MAX_FRAME_PAYLOAD):
+            self.connection.send_frame(self.stream_id, self.dst_endpoint, 0, view[offset:offset + MAX_FRAME_PAYLOAD])
 
-def send_dynamic_data(sock, data, chunk_size):
+    def finish(self):
+        self.connection.send_frame(self.stream_id, self.dst_endpoint, FLAG_END_STREAM)
+
+    def abort(self):
+        try:
+            self.connection.send_frame(self.stream_id, self.dst_endpoint, FLAG_RESET)
+        except OSError:
+            # The connection itself failed, the load balancer will know
+            pass
+
+
+class CapturingResponseChannel:
+    '''
+    Passes a response to another response channel, and keeps a copy of it for the response cache.
+    A response that is bigger than max_size isn't kept (data becomes None).
+    '''
+
+    def __init__(self, response_channel, max_size):
+        self.response_channel = response_channel
+        self.max_size = max_size
+        self.data = bytearray()
+
+    def start(self, data):
+        self._capture(data)
+        self.response_channel.start(data)
+
+    def send(self, data):
+        self._capture(data)
+        self.response_channel.send(data)
+
+    def finish(self):
+        self.response_channel.finish()
+
+    def abort(self):
+        self.response_channel.abort()
+
+    def _capture(self, data):
+        if self.data is not None:
+            if len(self.data) + len(data) > self.max_size:
+                self.data = None
+            else:
+                self.data += data
+
+
+def relay_local_server_response(request_data, method, local_server_port, reuse_connection,
+                                client_keep_alive, response_channel):
+    '''
+    This function sends a request to the local server and pipes the response to the response channel
+    while it's being received.
+    The response goes through one fixed buffer, so a response of any size takes constant memory.
+    Sending blocks while the load balancer is slow to read, and meanwhile the local server isn't read
+    (so TCP slows it down as well).
+    '''
+    address = ("localhost", local_server_port)
+    buffer = bytearray(RELAY_BUFFER_SIZE)
+    view = memoryview(buffer)
+
+    while True:
+        local_server_socket, reused = backend_pool.acquire(address)
+        response_parser = HttpResponseParser(method)
+        response_head = bytearray()
+        reusable = False
+        try:
+            local_server_socket.settimeout(BACKEND_RESPONSE_TIMEOUT)
+            local_server_socket.sendall(request_data)
+
+            # Receive the head of the response (the beginning of the body may come with it)
+            while not response_parser.head_complete:
+                received = local_server_socket.recv_into(view)
+                if received == 0:
+                    # Raises, since the head isn't complete
+                    response_parser.finish()
+                consumed = response_parser.feed(view[:received])
+                response_head += view[:consumed]
+                # The server shouldn't send anything after the response
+                reusable = consumed == received
+        except (OSError, HttpParseError):
+            backend_pool.release(address, local_server_socket, reusable=False)
+            if reused and not response_head and method in IDEMPOTENT_HTTP_METHODS:
+                print("Reused connection was closed by the local server, retrying")
+                continue
+            raise
+        break
+
+    # Tell the client what it would've been told without the pooled connection
+    head_start = response_parser.interim_size
+    head_end = head_start + response_parser.head_size
+    final_head = bytes(response_head[head_start:head_end])
+    if not client_keep_alive and response_parser.keep_alive:
+        final_head = set_connection_header(final_head, 'close')
+    print("response:", final_head[:32])
+
+    try:
+        # Send the head, then pipe the rest of the body as it arrives
+        response_channel.start(response_head[:head_start] + final_head + response_head[head_end:])
+        while not response_parser.complete:
+            received = local_server_socket.recv_into(view)
+            if received == 0:
+                # Completes a body that ends with the connection, raises if the body was cut
+                response_parser.finish()
+                break
+            consumed = response_parser.feed(view[:received])
+            response_channel.send(view[:consumed])
+            reusable = consumed == received
+        response_channel.finish()
+    except (OSError, HttpParseError):
+        backend_pool.release(address, local_server_socket, reusable=False)
+        raise
+
+    backend_pool.release(address, local_server_socket,
+                         reusable=reuse_connection and reusable and response_parser.keep_alive)
+    return response_parser
+
+
+def proxy_request(request_data, method, request, response_channel, local_server_port):
+    '''
+    This function passes an HTTP request to the local server, and sends the response to the response channel.
+    request - the parsed request, or None if the request data isn't a complete valid request.
+    Raises OSError or HttpParseError if the request failed (the channel should be aborted).
+    '''
+    # The connection to the local server is ours, so it's kept alive no matter what the client asked.
+    # Only a complete request can be sent over a reused connection - if it's cut,
+    # the server would treat the next request on the connection as the rest of it.
+    client_keep_alive = True
+    reuse_connection = False
+    if BACKEND_KEEP_ALIVE and request is not None:
+        client_keep_alive = request.keep_alive
+        reuse_connection = True
+        request_data = set_connection_header(request_data, 'keep-alive')
+
+    cache_key = None
+    if RESPONSE_CACHE_ENABLED and request is not None:
+        cache_key = get_cache_key(request)
+    if cache_key is None:
+        forward_request(request_data, method, local_server_port, reuse_connection,
+                        client_keep_alive, response_channel)
+        return
+
+    cached_response, should_fetch = response_cache.lookup(cache_key, BACKEND_RESPONSE_TIMEOUT)
+    if cached_response is not None:
+        print("cache hit:", request.target)
+        # The cached copy says what its first client was told
+        cached_response = set_connection_header(cached_response, 'keep-alive' if request.keep_alive else 'close')
+        response_channel.start(cached_response)
+        response_channel.finish()
+        return
+    if not should_fetch:
+        # The response of the same request couldn't be cached
+        forward_request(request_data, method, local_server_port, reuse_connection,
+                        client_keep_alive, response_channel)
+        return
+
+    # Keep a copy of the response while it's passed to the client, and cache it if it's allowed
+    capturing_channel = CapturingResponseChannel(response_channel, RESPONSE_CACHE_MAX_ENTRY_SIZE)
+    try:
+        response_parser = forward_request(request_data, method, local_server_port, reuse_connection,
+                                          client_keep_alive, capturing_channel)
+    except BaseException:
+        response_cache.end_fetch(cache_key)
+        raise
+    if capturing_channel.data is None:
+        response_cache.end_fetch(cache_key)
+    else:
+        response_cache.end_fetch(cache_key, bytes(capturing_channel.data), get_freshness_lifetime(response_parser))
+
+
+def forward_request(request_data, method, local_server_port, reuse_connection, client_keep_alive, response_channel):
+    '''
+    This function passes a request to the local server, and its response to the response channel
+    (streamed or as a whole). Returns the parser of the response.
+    '''
+    if STREAMING_RELAY:
+        print("relaying request:", request_data[:32])
+        return relay_local_server_response(request_data, method, local_server_port, reuse_connection,
+                                           client_keep_alive, response_channel)
+
+    print("sending request:", request_data[:32])
+    response_data, response_parser = request_local_server(request_data, method,
+                                                          local_server_port, reuse_connection)
+    print("response:", response_data[:32])
+
+    # Tell the client what it would've been told without the pooled connection
+    if not client_keep_alive and response_parser.keep_alive:
+        response_data = set_connection_header(response_data, 'close')
+
+    response_channel.start(response_data)
+    response_channel.finish()
+    return response_parser
+
+
+def parse_raw_packet(packet_data):
+    '''
+    This function returns the endpoint and the HTTP method of a packet in the raw protocol,
+    or None if the packet is invalid to our protocol (it should start with the endpoint,
+    and then with a request line that starts with a valid method).
+    '''
+    method_end = packet_data.find(b' ', ENDPOINT_LENGTH, ENDPOINT_LENGTH + MAX_METHOD_LENGTH + 1)
+    if method_end == -1:
+        return None
+
+    method = packet_data[ENDPOINT_LENGTH:method_end]
+    if method not in VALID_METHOD_NAMES:
+        return None
+    return packet_data[:ENDPOINT_LENGTH], method.decode()
+
+
+def receive_proxy_request(proxy_request_socket, packet_data=b''):
+    '''
+    This function receives a request from the load balancer: the client's endpoint and an HTTP request.
+    packet_data - the beginning of the request, if it was already received.
+    The data is received until the HTTP request is complete (the load balancer doesn't close the
+    connection after it), and it's returned with the parsed request - or with None if the data
+    isn't a complete valid request, in which case it's returned as it was received.
+    '''
+    packet_data = bytearray(packet_data)
+    request_parser = HttpRequestParser(max_body_size=MAX_PACKET_SIZE)
+    # The endpoint isn't a part of the HTTP request
+    request_parser.feed(packet_data[ENDPOINT_LENGTH:])
+    proxy_request_socket.settimeout(REQUEST_RECV_TIMEOUT)
+
+    while True:
+        try:
+            request = request_parser.next_request()
+        except HttpParseError:
+            return bytes(packet_data), None
+        if request is not None:
+            if request_parser.has_buffered_data():
+                # More than one request, which isn't a part of the protocol
+                return bytes(packet_data), None
+            return bytes(packet_data), request
+
+        try:
+            data = proxy_request_socket.recv(MAX_PACKET_SIZE)
+        except socket.timeout:
+            # Whatever was received is handled like before the request was parsed
+            if packet_data:
+                return bytes(packet_data), None
+            raise
+        if not data:
+            return bytes(packet_data), None
+
+        parsed_size = max(len(packet_data), ENDPOINT_LENGTH)
+        packet_data += data
+        request_parser.feed(packet_data[parsed_size:])
+
+
+def handle_proxy_request(proxy_request_socket, proxy_address, local_server_port, proxy_response_port,
+                         packet_data=b''):
+    '''
+    This function proxies a single request in the raw protocol: it receives the request from the load balancer,
+    passes it to the local server and sends the server's response back to the load balancer.
+    Runs inside one of the worker threads, every stage is limited by its own timeout.
+    '''
+    # Receive the request and close the connection
+    with proxy_request_socket:
+        try:
+            packet_data, request = receive_proxy_request(proxy_request_socket, packet_data)
+        except OSError:
+            print("Connection failed.")
+            return
+    print("Request:", packet_data[:32])
+
+    # Make sure that the request starts with an ip
+    # The ip is the ip of the client that should be the final destination of the response
+    # Example of valid request: '8hJ\n\x1b\x9ePOST / HTTP/1.1 ...'
+    parsed_packet = parse_raw_packet(packet_data)
+    if parsed_packet is None:
+        # The packet is invalid to our proxy protocol,
+        # so there's no need to continue the connection with the client.
+        # The socket is already closed, so there's no need to close
+        print("INVALID PACKET:", packet_data)
+        return
+
+    # Take the bytes of the endpoint and save them for the response
+    dst_endpoint, method = parsed_packet
+    response_channel = ProxyResponseChannel(dst_endpoint, (proxy_address[0], proxy_response_port))
+
+    # Remove the ip from the beginning packet, the rest of the packet is a pure HTTP request
+    try:
+        proxy_request(packet_data[ENDPOINT_LENGTH:], method, request, response_channel, local_server_port)
+    except (OSError, HttpParseError) as e:
+        print("Proxying the request failed:", e)
+        response_channel.abort()
+
+
+class FramedConnection:
+    '''
+    A long-lived connection from the load balancer in the framed protocol (see proxy_protocol.py).
+    Its requests are proxied by the worker threads at the same time,
+    and their responses are sent back on the connection as the frames of their streams.
+    '''
+
+    def __init__(self, connection_socket, local_server_port, submit):
+        self.connection_socket = connection_socket
+        self.local_server_port = local_server_port
+        self.submit = submit
+        self.closed = False
+
+        self._send_lock = threading.Lock()
+        self._requests = {}             # Stream id -> the data of its request that was received so far
+        self._dropped_streams = set()   # Streams whose (too large) request is ignored until it ends
+
+    def serve(self, initial_data=b''):
+        '''
+        Receives frames until the connection closes, and hands every complete request to a worker.
+        '''
+        frame_parser = FrameParser()
+        frame_parser.feed(initial_data)
+
+        # The socket is shared with the workers, so its timeout is the one of sending a response
+        self.connection_socket.settimeout(PROXY_SEND_TIMEOUT)
+        try:
+            while True:
+                frame = frame_parser.next_frame()
+                while frame is not None:
+                    self._handle_frame(frame)
+                    frame = frame_parser.next_frame()
+
+                try:
+                    data = self.connection_socket.recv(MAX_PACKET_SIZE)
+                except socket.timeout:
+                    # The connection is long-lived, it's fine for it to be idle
+                    continue
+                if not data:
+                    break
+                frame_parser.feed(data)
+        except (OSError, ProtocolError) as e:
+            print("Framed connection failed:", e)
+        finally:
+            with self._send_lock:
+                self.closed = True
+                self.connection_socket.close()
+        print("Framed connection closed")
+
+    def send_frame(self, stream_id, endpoint, flags, payload=b''):
+        '''
+        Sends a single frame. Frames of different streams may be sent by different workers at the same time.
+        '''
+        header = encode_frame_header(stream_id, endpoint, flags, len(payload))
+        with self._send_lock:
+            if self.closed:
+                raise ConnectionError("The framed connection is closed")
+            try:
+                send_buffers(self.connection_socket, [header, payload])
+            except OSError:
+                # A partly sent frame breaks the whole connection
+                self.closed = True
+                self.connection_socket.shutdown(socket.SHUT_RDWR)
+                raise
+
+    def handle_stream(self, stream_id, dst_endpoint, request_data):
+        '''
+        Proxies the request of a single stream, runs inside one of the worker threads.
+        '''
+        response_channel = FramedResponseChannel(self, stream_id, dst_endpoint)
+
+        # A stream carries exactly one complete HTTP request
+        request_parser = HttpRequestParser(max_body_size=MAX_FRAMED_REQUEST_SIZE)
+        request_parser.feed(request_data)
+        try:
+            request = request_parser.next_request()
+        except HttpParseError:
+            request = None
+        if request is None or request_parser.has_buffered_data():
+            print("INVALID STREAM:", stream_id, request_data[:32])
+            response_channel.abort()
+            return
+
+        try:
+            proxy_request(request_data, request.method, request, response_channel, self.local_server_port)
+        except (OSError, HttpParseError) as e:
+            print("Proxying the stream failed:", stream_id, e)
+            response_channel.abort()
+
+    def _handle_frame(self, frame):
+        if frame.reset:
+            # The load balancer gave up on the request
+            self._requests.pop(frame.stream_id, None)
+            self._dropped_streams.discard(frame.stream_id)
+            return
+
+        if frame.stream_id in self._dropped_streams:
+            if frame.end_stream:
+                self._dropped_streams.discard(frame.stream_id)
+            return
+
+        request_data = self._requests.setdefault(frame.stream_id, bytearray())
+        request_data += frame.payload
+        if len(request_data) > MAX_FRAMED_REQUEST_SIZE:
+            print("Stream request is too large:", frame.stream_id)
+            del self._requests[frame.stream_id]
+            if not frame.end_stream:
+                self._dropped_streams.add(frame.stream_id)
+            self.send_frame(frame.stream_id, frame.endpoint, FLAG_RESET)
+            return
+
+        if frame.end_stream:
+            del self._requests[frame.stream_id]
+            self.submit(self.handle_stream, frame.stream_id, frame.endpoint, bytes(request_data))
+
+
+def handle_proxy_connection(proxy_request_socket, proxy_address, local_server_port, proxy_response_port, submit):
     '''
-    This function sends the given data in chunks of size chunk_size using the given socket.
+    This function handles a new connection from the load balancer by its protocol:
+    a framed connection is served by its own thread (and its requests by the workers),
+    and a raw connection is a single request.
     '''
-    # Get the length of the data
-    data_length = len(data)
-    # Convert the length (int) to bytes and send the length of the data
-    sock.send((data_length).to_bytes(4, byteorder="big"))
+    packet_data = b''
+    if FRAMED_PROTOCOL_ENABLED:
+        try:
+            # Receive enough data to tell the protocols apart
+            proxy_request_socket.settimeout(REQUEST_RECV_TIMEOUT)
+            while len(packet_data) < len(FRAME_PREFACE) and FRAME_PREFACE.startswith(packet_data):
+                data = proxy_request_socket.recv(MAX_PACKET_SIZE)
+                if not data:
+                    break
+                packet_data += data
+        except OSError:
+            print("Connection failed.")
+            proxy_request_socket.close()
+            return
+
+        if packet_data.startswith(FRAME_PREFACE):
+            print("Framed connection from", proxy_address)
+            connection = FramedConnection(proxy_request_socket, local_server_port, submit)
+            threading.Thread(target=connection.serve, args=(packet_data[len(FRAME_PREFACE):],),
+                             daemon=True).start()
+            return
 
-    # Run through the data list and jump chunk_size elements every time
-    # Stop when you get to the last chunk, then send the rest of the bytes
-    for i in range(0, chunk_size * (data_length // chunk_size) + 1, chunk_size):
-        data_to_send = data[i:i + chunk_size]
-        sock.send(data_to_send)
+    handle_proxy_request(proxy_request_socket, proxy_address, local_server_port, proxy_response_port, packet_data)
 
 
 def main():
@@ -85,69 +963,44 @@ def main():
     proxy_response_port = get_port("Proxy server port: ")
     listen_port = get_port("Agent port: ", excluded_ports=[local_server_port])
 
+    # Limits the amount of accepted requests that wait for a worker,
+    # so that the accept loop (and the framed connections) won't queue an unbounded amount of jobs
+    free_slots = threading.BoundedSemaphore(MAX_CONCURRENT_REQUESTS + MAX_PENDING_REQUESTS)
+
+    def run_and_release(function, *args):
+        try:
+            function(*args)
+        finally:
+            free_slots.release()
+
     # Create a listening socket
-    with socket.socket() as listen_socket:
-        # Bind the listening socket and start listening
-        listen_socket.bind(("0.0.0.0", listen_port))
-        listen_socket.listen()
-
-        while True:
-            # Accept a client, receive his request and close the connection
-            print("Accepting client...")
-            proxy_request_socket, proxy_address = listen_socket.accept()
-            print("Client connected:", proxy_address)
-            packet_data = b''
-            try:
-                packet_data = proxy_request_socket.recv(MAX_PACKET_SIZE)
-            except:
-                print("Connection failed.")
-                continue
-            print("Request:", packet_data[:32])
-            proxy_request_socket.close()
+    try:
+        with socket.socket() as listen_socket, \
+                ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
 
-            # Make sure that the request starts with an ip
-            # The ip is the ip of the client that should be the final destination of the response
-            # Example of matching request: '8hJ\n\x1b\x9ePOST / HTTP/1.1 ...'
-            packet_match = re.match(f'^([\s\S]{{6}})({"|".join(VALID_HTTP_METHODS)})'.encode(), packet_data)
-            if packet_match is not None:
-                # Take the bytes of the endpoint and save them for the response
-                dst_endpoint = packet_match.group(1)
-
-                with socket.socket() as local_server_socket:
-                    # Connect to the local server
-                    print("connecting to", ("localhost", local_server_port))
-                    local_server_socket.connect(("localhost", local_server_port))
-
-                    # Remove the ip from the beginning packet
-                    # and send the rest of the packet as a pure HTTP request
-                    print("sending request:", packet_data[ENDPOINT_LENGTH:32])
-                    local_server_socket.send(packet_data[ENDPOINT_LENGTH:])
-
-                    # Get the response from the local server
-                    # This is a time consuming action, it should be done in a thread
-                    print("receiving response")
-                    response_data = local_server_socket.recv(MAX_PACKET_SIZE)
-                    print("response:", packet_data[ENDPOINT_LENGTH:32])
-                    with socket.socket() as proxy_response_socket:
-                        # Connect to the proxy server
-                        print("connecting to proxy to respond")
-                        proxy_response_socket.connect(
-                            (proxy_address[0], proxy_response_port))
-                        print("connected to proxy on", (proxy_address[0], proxy_response_port))
-                        # Send the response to the proxy with
-                        # the ip that we removed earlier
-                        print("sending response to proxy", (proxy_address[0], proxy_response_port))
-                        proxy_response_socket.send(
-                            dst_endpoint + response_data)
-                        proxy_response_socket.close()
-                        print("sent response: ", dst_endpoint + response_data[:32])
-                    local_server_socket.close()
-            else:
-                # The packet is invalid to our proxy protocol,
-                # so there's no need to continue the connection with the client.
-				# The socket is already closed, so there's no need to close
-                print("INVALID PACKET:", packet_data)
-                pass
+            def submit(function, *args):
+                # Wait for a free worker before queueing another job
+                free_slots.acquire()
+                executor.submit(run_and_release, function, *args)
+
+            # Bind the listening socket and start listening
+            listen_socket.bind(("0.0.0.0", listen_port))
+            listen_socket.listen(LISTEN_BACKLOG)
+
+            while True:
+                # Wait for a free worker before accepting another client
+                free_slots.acquire()
+
+                # Accept a client and let a worker handle his request
+                print("Accepting client...")
+                proxy_request_socket, proxy_address = listen_socket.accept()
+                print("Client connected:", proxy_address)
+                executor.submit(run_and_release, handle_proxy_connection, proxy_request_socket, proxy_address,
+                                local_server_port, proxy_response_port, submit)
+    finally:
+        # Close the pooled connections that are left
+        backend_pool.close_all()
+        proxy_pool.close_all()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,446 @@
+"""
+An incremental HTTP/1.x parser, shared by the HTTP server and the proxy agent.
+
+The data is fed to the parser as it arrives from the socket (split in any way),
+and the parser returns every request once all of its bytes were received:
+
+    parser = HttpRequestParser()
+    parser.feed(client_socket.recv(4096))
+    request = parser.next_request()  # None until the whole request arrived
+
+Pipelined requests are kept in the parser's buffer until they are asked for.
+
+Responses are tracked by HttpResponseParser, which finds where a response ends
+(so the connection it came from can be reused) without keeping its body:
+
+    parser = HttpResponseParser('GET')
+    while not parser.complete:
+        data = server_socket.recv(4096)
+        if not data:
+            parser.finish()
+            break
+        consumed = parser.feed(data)  # The bytes of data that belong to the response
+"""
+
+
+DEFAULT_MAX_HEAD_SIZE = 8192            # Max size of a request line + headers (in bytes)
+DEFAULT_MAX_BODY_SIZE = 1024 * 1024     # Max size of a request body (in bytes)
+DEFAULT_MAX_HEADERS = 100               # Max amount of header lines in a request
+VALID_HTTP_METHODS = ['GET', 'HEAD', 'POST', 'PUT',
+                      'DELETE', 'TRACE', 'OPTIONS', 'CONNECT', 'PATCH']
+SUPPORTED_HTTP_VERSIONS = ['HTTP/1.0', 'HTTP/1.1']
+
+# Parser states
+_READING_HEAD = 0
+_READING_BODY = 1
+_READING_CHUNK_SIZE = 2
+_READING_CHUNK_DATA = 3
+_READING_TRAILERS = 4
+_READING_UNTIL_CLOSE = 5
+_DONE = 6
+
+# Responses that never have a body (besides the responses to HEAD requests)
+_BODILESS_STATUS_CODES = (204, 304)
+
+
+class HttpParseError(Exception):
+    """
+    Raised when the received data isn't a valid (or acceptable) HTTP message.
+    status_code and phrase - the HTTP error that should be sent back to the client.
+    """
+
+    def __init__(self, message: str, status_code: int = 400, phrase: str = 'Bad Request'):
+        super().__init__(message)
+        self.status_code = status_code
+        self.phrase = phrase
+
+
+class HttpRequest:
+    """
+    A parsed HTTP request.
+    headers - a dictionary of the headers, the header names are in lower-case.
+    """
+    __slots__ = ('method', 'target', 'version', 'headers', 'body')
+
+    def __init__(self, method: str, target: str, version: str, headers: dict, body: bytes = b''):
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers
+        self.body = body
+
+    @property
+    def keep_alive(self):
+        """
+        Whether or not the client wants to keep the connection open after the response.
+        HTTP/1.1 connections are persistent by default, HTTP/1.0 ones only if asked.
+        """
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.1':
+            return connection != 'close'
+        return connection == 'keep-alive'
+
+
+def parse_headers(header_lines: list, max_headers: int):
+    """
+    Parses 'Name: value' header lines to a dictionary with lower-case names.
+    Repeated headers are joined with ', '.
+    """
+    if len(header_lines) > max_headers:
+        raise HttpParseError('Too many headers', 431, 'Request Header Fields Too Large')
+
+    headers = {}
+    for header_line in header_lines:
+        name, separator, value = header_line.partition(':')
+        name = name.strip().lower()
+        if not separator or not name or ' ' in name:
+            raise HttpParseError(f'Invalid header line: {header_line!r}')
+
+        value = value.strip()
+        if name in headers:
+            headers[name] += ', ' + value
+        else:
+            headers[name] = value
+    return headers
+
+
+class HttpRequestParser:
+    """
+    An incremental parser of HTTP/1.x requests.
+    Buffers the received data until a whole request (head and body) is available.
+    The body is read by its Content-Length or by the chunked transfer encoding.
+    """
+
+    def __init__(self, max_head_size: int = DEFAULT_MAX_HEAD_SIZE,
+                 max_body_size: int = DEFAULT_MAX_BODY_SIZE,
+                 max_headers: int = DEFAULT_MAX_HEADERS):
+        self.max_head_size = max_head_size
+        self.max_body_size = max_body_size
+        self.max_headers = max_headers
+
+        # The data that was received but wasn't parsed yet
+        self.buffer = bytearray()
+
+        self._state = _READING_HEAD
+        self._scanned = 0           # Amount of buffered bytes that were already searched for the head's end
+        self._request = None        # The request whose body is being read
+        self._body = None           # The parts of the (chunked) body
+        self._body_size = 0         # The total size of the parts of the (chunked) body
+        self._remaining = 0         # Amount of bytes left in the body / current chunk
+
+    def feed(self, data):
+        """
+        Adds data that was received from the client to the parser's buffer.
+        """
+        self.buffer += data
+
+    def has_buffered_data(self):
+        """
+        Returns True if there's received data that wasn't returned as a request yet.
+        """
+        return len(self.buffer) > 0 or self._state != _READING_HEAD
+
+    def next_request(self):
+        """
+        Returns the next complete request in the buffer,
+        or None if more data is needed. Raises HttpParseError on invalid requests.
+        """
+        while True:
+            if self._state == _READING_HEAD:
+                if not self._parse_head():
+                    return None
+            elif self._state == _READING_BODY:
+                if len(self.buffer) < self._remaining:
+                    return None
+                self._request.body = bytes(self.buffer[:self._remaining])
+                del self.buffer[:self._remaining]
+                return self._finish_request()
+            elif self._state == _READING_CHUNK_SIZE:
+                if not self._parse_chunk_size():
+                    return None
+            elif self._state == _READING_CHUNK_DATA:
+                # The chunk's data is followed by CRLF
+                if len(self.buffer) < self._remaining + 2:
+                    return None
+                self._body.append(bytes(self.buffer[:self._remaining]))
+                del self.buffer[:self._remaining + 2]
+                self._state = _READING_CHUNK_SIZE
+            elif self._state == _READING_TRAILERS:
+                line_end = self.buffer.find(b'\r\n')
+                if line_end == -1:
+                    return None
+                del self.buffer[:line_end + 2]
+
+                # An empty line ends the trailers (the trailers themselves are ignored)
+                if line_end == 0:
+                    self._request.body = b''.join(self._body)
+                    return self._finish_request()
+
+    def _parse_head(self):
+        """
+        Parses the request line and the headers, if the whole head was received.
+        Returns False if more data is needed.
+        """
+        # Skip empty lines before the request line (allowed by the RFC)
+        while self.buffer.startswith(b'\r\n'):
+            del self.buffer[:2]
+
+        # Search only the new data for the end of the head
+        head_end = self.buffer.find(b'\r\n\r\n', max(self._scanned - 3, 0))
+        if head_end == -1:
+            self._scanned = len(self.buffer)
+            if self._scanned > self.max_head_size:
+                raise HttpParseError('Request head is too large', 431, 'Request Header Fields Too Large')
+            return False
+        if head_end > self.max_head_size:
+            raise HttpParseError('Request head is too large', 431, 'Request Header Fields Too Large')
+
+        lines = self.buffer[:head_end].decode('latin-1').split('\r\n')
+        del self.buffer[:head_end + 4]
+        self._scanned = 0
+
+        # Parse the request line, for example: 'GET /index.html HTTP/1.1'
+        request_line = lines[0].split(' ')
+        if len(request_line) != 3:
+            raise HttpParseError(f'Invalid request line: {lines[0]!r}')
+        method, target, version = request_line
+        if method not in VALID_HTTP_METHODS:
+            raise HttpParseError(f'Invalid method: {method!r}', 501, 'Not Implemented')
+        if version not in SUPPORTED_HTTP_VERSIONS:
+            raise HttpParseError(f'Unsupported version: {version!r}', 505, 'HTTP Version Not Supported')
+        # Only paths (origin-form, like '/index.html?a=1') are served,
+        # besides 'OPTIONS *' (asterisk-form) which asks about the server itself
+        if not target.startswith('/') and not (method == 'OPTIONS' and target == '*'):
+            raise HttpParseError(f'Invalid request target: {target!r}')
+
+        self._request = HttpRequest(method, target, version, parse_headers(lines[1:], self.max_headers))
+        headers = self._request.headers
+
+        # Find out how the body is sent
+        if headers.get('transfer-encoding', '').lower().endswith('chunked'):
+            self._body = []
+            self._body_size = 0
+            self._remaining = 0
+            self._state = _READING_CHUNK_SIZE
+        elif 'content-length' in headers:
+            content_length = headers['content-length']
+            if not content_length.isdigit():
+                raise HttpParseError(f'Invalid Content-Length: {content_length!r}')
+            self._remaining = int(content_length)
+            if self._remaining > self.max_body_size:
+                raise HttpParseError('Request body is too large', 413, 'Payload Too Large')
+            self._state = _READING_BODY
+        else:
+            # No body
+            self._state = _READING_BODY
+            self._remaining = 0
+        return True
+
+    def _parse_chunk_size(self):
+        """
+        Parses the size line of the next chunk (like '1a3f;extension=x').
+        Returns False if more data is needed.
+        """
+        line_end = self.buffer.find(b'\r\n')
+        if line_end == -1:
+            if len(self.buffer) > self.max_head_size:
+                raise HttpParseError('Chunk size line is too long')
+            return False
+
+        size_text = bytes(self.buffer[:line_end]).split(b';', 1)[0].strip()
+        del self.buffer[:line_end + 2]
+        try:
+            self._remaining = int(size_text, 16)
+        except ValueError:
+            raise HttpParseError(f'Invalid chunk size: {size_text!r}')
+
+        if self._remaining == 0:
+            # The last chunk, the trailers come next
+            self._state = _READING_TRAILERS
+            return True
+
+        self._body_size += self._remaining
+        if self._body_size > self.max_body_size:
+            raise HttpParseError('Request body is too large', 413, 'Payload Too Large')
+        self._state = _READING_CHUNK_DATA
+        return True
+
+    def _finish_request(self):
+        request = self._request
+        self._request = None
+        self._body = None
+        self._remaining = 0
+        self._state = _READING_HEAD
+        return request
+
+
+class HttpResponseParser:
+    """
+    An incremental tracker of a single HTTP/1.x response.
+    Only the head of the response is kept (status_code, version and headers),
+    the body is read by its Content-Length, by the chunked transfer encoding,
+    or until the server closes the connection - and its bytes are only counted.
+    """
+
+    def __init__(self, request_method: str = 'GET', max_head_size: int = DEFAULT_MAX_HEAD_SIZE,
+                 max_headers: int = DEFAULT_MAX_HEADERS):
+        self.request_method = request_method
+        self.max_head_size = max_head_size
+        self.max_headers = max_headers
+
+        self.status_code = None
+        self.version = None
+        self.headers = None
+        self.head_size = 0          # Size of the final head of the response, including its empty line
+        self.interim_size = 0       # Size of the interim (1xx) heads that came before the final head
+        self.complete = False
+
+        self._state = _READING_HEAD
+        self._line = bytearray()    # The head / line that is being received
+        self._remaining = 0         # Amount of bytes left in the body / current chunk (with its CRLF)
+        self._read_until_close = False
+
+    @property
+    def keep_alive(self):
+        """
+        Whether or not the server keeps the connection open after this response
+        (known once the final head was received).
+        """
+        if not self.head_complete or self._read_until_close:
+            return False
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.1':
+            return connection != 'close'
+        return connection == 'keep-alive'
+
+    @property
+    def head_complete(self):
+        """
+        Whether or not the whole final head (status line and headers) was received.
+        """
+        return self._state != _READING_HEAD
+
+    def feed(self, data):
+        """
+        Tracks the next piece of the response (any bytes-like object).
+        Returns the amount of bytes at the beginning of data that belong to the response -
+        it's smaller than len(data) only if the response completed in the middle of it.
+        Raises HttpParseError on invalid responses.
+        """
+        view = memoryview(data)
+        position = 0
+        while position < len(view) and not self.complete:
+            if self._state == _READING_HEAD:
+                position, head = self._read_until(view, position, b'\r\n\r\n', self.max_head_size)
+                if head is not None:
+                    self.head_size = len(head) + 4
+                    self._parse_head(head)
+            elif self._state in (_READING_BODY, _READING_CHUNK_DATA):
+                amount = min(self._remaining, len(view) - position)
+                position += amount
+                self._remaining -= amount
+                if self._remaining == 0:
+                    if self._state == _READING_BODY:
+                        self._finish()
+                    else:
+                        self._state = _READING_CHUNK_SIZE
+            elif self._state == _READING_CHUNK_SIZE:
+                position, line = self._read_until(view, position, b'\r\n', self.max_head_size)
+                if line is not None:
+                    self._parse_chunk_size(line)
+            elif self._state == _READING_TRAILERS:
+                position, line = self._read_until(view, position, b'\r\n', self.max_head_size)
+                # An empty line ends the trailers (the trailers themselves are ignored)
+                if line is not None and len(line) == 0:
+                    self._finish()
+            elif self._state == _READING_UNTIL_CLOSE:
+                position = len(view)
+        return position
+
+    def finish(self):
+        """
+        Should be called when the server closed the connection.
+        Completes a response that is read until the connection closes,
+        and raises HttpParseError if the response was cut in the middle.
+        """
+        if self._state == _READING_UNTIL_CLOSE:
+            self._finish()
+        elif not self.complete:
+            raise HttpParseError('The connection closed before the response was complete', 502, 'Bad Gateway')
+
+    def _read_until(self, view, position: int, terminator: bytes, max_size: int):
+        """
+        Adds the data from the given position to the current line, until the terminator.
+        Returns the position after the used data, and the whole line (without the terminator)
+        if it was found, or None if more data is needed.
+        """
+        previous_size = len(self._line)
+        self._line += view[position:position + max_size + len(terminator) - previous_size]
+
+        # Search only the new data (and the end of the old one) for the terminator
+        line_end = self._line.find(terminator, max(previous_size - len(terminator) + 1, 0))
+        if line_end == -1:
+            if len(self._line) > max_size:
+                raise HttpParseError('Response head is too large', 502, 'Bad Gateway')
+            return position + len(self._line) - previous_size, None
+
+        line = bytes(self._line[:line_end])
+        self._line.clear()
+        return position + line_end + len(terminator) - previous_size, line
+
+    def _parse_head(self, head: bytes):
+        """
+        Parses the status line and the headers, and finds out how the body is sent.
+        """
+        lines = head.decode('latin-1').split('\r\n')
+
+        # Parse the status line, for example: 'HTTP/1.1 200 OK'
+        status_line = lines[0].split(' ', 2)
+        if len(status_line) < 2 or status_line[0] not in SUPPORTED_HTTP_VERSIONS or not status_line[1].isdigit():
+            raise HttpParseError(f'Invalid status line: {lines[0]!r}', 502, 'Bad Gateway')
+        self.version = status_line[0]
+        self.status_code = int(status_line[1])
+        self.headers = parse_headers(lines[1:], self.max_headers)
+
+        if 100 <= self.status_code < 200:
+            # An interim response (like '100 Continue'), the final one comes next
+            self.interim_size += self.head_size
+            return
+        if self.request_method == 'HEAD' or self.status_code in _BODILESS_STATUS_CODES:
+            self._finish()
+        elif self.headers.get('transfer-encoding', '').lower().endswith('chunked'):
+            self._state = _READING_CHUNK_SIZE
+        elif 'content-length' in self.headers:
+            content_length = self.headers['content-length']
+            if not content_length.isdigit():
+                raise HttpParseError(f'Invalid Content-Length: {content_length!r}', 502, 'Bad Gateway')
+            self._remaining = int(content_length)
+            self._state = _READING_BODY
+            if self._remaining == 0:
+                self._finish()
+        else:
+            # The body ends when the server closes the connection
+            self._read_until_close = True
+            self._state = _READING_UNTIL_CLOSE
+
+    def _parse_chunk_size(self, line: bytes):
+        """
+        Parses the size line of the next chunk (like '1a3f;extension=x').
+        """
+        size_text = line.split(b';', 1)[0].strip()
+        try:
+            chunk_size = int(size_text, 16)
+        except ValueError:
+            raise HttpParseError(f'Invalid chunk size: {size_text!r}', 502, 'Bad Gateway')
+
+        if chunk_size == 0:
+            # The last chunk, the trailers come next
+            self._state = _READING_TRAILERS
+        else:
+            # The chunk's data is followed by CRLF
+            self._remaining = chunk_size + 2
+            self._state = _READING_CHUNK_DATA
+
+    def _finish(self):
+        self._state = _DONE
+        self.complete = True
@@ -0,0 +1,119 @@
+"""
+The framed version of our proxy protocol, between the load balancer and the proxy agents.
+
+In the raw protocol every message is sent on its own connection: <endpoint><HTTP data>.
+In the framed protocol one long-lived connection carries many requests and responses at once.
+
+The load balancer opens the connection with a preface:
+    <6 zero bytes>PROXY-FRAMED/1\r\n
+(an agent that only knows the raw protocol sees an empty endpoint without an HTTP method,
+and drops it as an invalid packet - when the connection closes before any frame arrives,
+the load balancer passes the requests to that agent in the raw protocol from then on).
+
+After the preface both sides send frames. Every frame is a 16 bytes header followed by its payload:
+       |-VERSION-|-FLAGS-|-STREAM ID-|---ENDPOINT---|-LENGTH-|---PAYLOAD---|
+bytes:      1         1        4             6          4       LENGTH
+The numbers are big-endian (network order), and the endpoint is in the same format as in the raw protocol.
+
+A stream is a single request and its response, and its id is picked by the load balancer.
+The request is sent in one or more frames of its stream, and the last one has the END_STREAM flag.
+The agent answers on the same stream with the frames of the response (the last one with END_STREAM),
+or with a RESET frame if the request couldn't be served. Frames of different streams may be interleaved.
+"""
+
+
+import struct
+
+
+PROTOCOL_VERSION = 1
+FRAME_PREFACE = b'\x00' * 6 + b'PROXY-FRAMED/1\r\n'
+FRAME_HEADER = struct.Struct('!BBI6sI')   # Version, flags, stream id, endpoint, payload length
+FRAME_HEADER_SIZE = FRAME_HEADER.size
+MAX_FRAME_PAYLOAD = 64 * 1024             # Max size of the payload of a single frame (in bytes)
+
+# Frame flags
+FLAG_END_STREAM = 0x01      # The last frame of the stream's message
+FLAG_RESET = 0x02           # The stream was aborted
+
+
+class ProtocolError(Exception):
+    """
+    Raised when the received data isn't a valid frame.
+    """
+
+
+class Frame:
+    """
+    A single received frame.
+    """
+    __slots__ = ('flags', 'stream_id', 'endpoint', 'payload')
+
+    def __init__(self, flags: int, stream_id: int, endpoint: bytes, payload: bytes):
+        self.flags = flags
+        self.stream_id = stream_id
+        self.endpoint = endpoint
+        self.payload = payload
+
+    @property
+    def end_stream(self):
+        return bool(self.flags & FLAG_END_STREAM)
+
+    @property
+    def reset(self):
+        return bool(self.flags & FLAG_RESET)
+
+
+def encode_frame_header(stream_id: int, endpoint: bytes, flags: int, length: int):
+    """
+    Returns the header of a frame, the payload should be sent right after it.
+    """
+    if length > MAX_FRAME_PAYLOAD:
+        raise ProtocolError(f'Frame payload is too large: {length}')
+    return FRAME_HEADER.pack(PROTOCOL_VERSION, flags, stream_id, endpoint, length)
+
+
+class FrameParser:
+    """
+    An incremental parser of frames.
+    The received data is fed to the parser as it arrives (split in any way),
+    and every frame is returned by next_frame() once all of its bytes were received.
+    """
+
+    def __init__(self, max_payload: int = MAX_FRAME_PAYLOAD):
+        self.max_payload = max_payload
+        self.buffer = bytearray()
+        self._offset = 0            # Where the next frame starts in the buffer
+
+    def feed(self, data):
+        """
+        Adds received data to the parser's buffer.
+        """
+        # Drop the frames that were already returned (once per feed, not once per frame)
+        if self._offset:
+            del self.buffer[:self._offset]
+            self._offset = 0
+        self.buffer += data
+
+    def next_frame(self):
+        """
+        Returns the next complete frame in the buffer, or None if more data is needed.
+        Raises ProtocolError on invalid frames.
+        """
+        if len(self.buffer) - self._offset < FRAME_HEADER_SIZE:
+            return None
+
+        version, flags, stream_id, endpoint, length = FRAME_HEADER.unpack_from(self.buffer, self._offset)
+        if version != PROTOCOL_VERSION:
+            raise ProtocolError(f'Unsupported protocol version: {version}')
+        if length > self.max_payload:
+            raise ProtocolError(f'Frame payload is too large: {length}')
+
+        payload_start = self._offset + FRAME_HEADER_SIZE
+        payload_end = payload_start + length
+        if len(self.buffer) < payload_end:
+            return None
+
+        with memoryview(self.buffer) as view:
+            payload = view[payload_start:payload_end].tobytes()
+        self._offset = payload_end
+        return Frame(flags, stream_id, endpoint, payload)
@@ -0,0 +1,306 @@
+"""
+Conformance tests of the proxy agent's side of the framed proxy protocol.
+A real FramedConnection is served on a loopback connection, and the tests play the load balancer on its
+other end. The requests are proxied to a small local HTTP server that stands in for the web server.
+Run from the 'Web Server' folder: python -m pytest tests
+"""
+
+
+import os
+import socket
+import sys
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Proxy Agent'))
+from http_parser import HttpRequestParser, HttpResponseParser
+from proxy_protocol import FRAME_PREFACE, MAX_FRAME_PAYLOAD, FLAG_END_STREAM, FLAG_RESET, \
+    FrameParser, encode_frame_header
+import proxy_agent
+
+
+ENDPOINT = bytes([10, 0, 0, 7, 0xc3, 0x50])
+BIG_BODY_SIZE = 5 * MAX_FRAME_PAYLOAD + 123     # Sent back in many frames
+SLOW_BODY_CHUNKS = 40                           # The slow response is sent in chunks, 50ms apart
+RECV_TIMEOUT = 5
+
+
+def get_response_body(path: str):
+    """
+    The body that the stand-in web server answers for the given path.
+    """
+    if path == '/big':
+        return bytes(index % 251 for index in range(BIG_BODY_SIZE))
+    return f'<h1>{path}</h1>'.encode()
+
+
+class StandInWebServer:
+    """
+    A small keep-alive HTTP server on a loopback port, that stands in for the local web server.
+    '/slow' is answered with a body that is sent slowly, every other path with get_response_body().
+    """
+
+    def __init__(self):
+        self.listen_socket = socket.create_server(('127.0.0.1', 0))
+        self.port = self.listen_socket.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def close(self):
+        self.listen_socket.close()
+
+    def _accept(self):
+        while True:
+            try:
+                client_socket, _ = self.listen_socket.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(client_socket,), daemon=True).start()
+
+    def _serve(self, client_socket):
+        parser = HttpRequestParser()
+        with client_socket:
+            try:
+                while True:
+                    request = parser.next_request()
+                    if request is None:
+                        data = client_socket.recv(65536)
+                        if not data:
+                            return
+                        parser.feed(data)
+                        continue
+
+                    if request.target == '/slow':
+                        self._send_slow_response(client_socket)
+                        return
+                    body = get_response_body(request.target)
+                    client_socket.sendall(f'HTTP/1.1 200 OK\r\nContent-Length: {len(body)}\r\n\r\n'.encode() + body)
+            except OSError:
+                return
+
+    def _send_slow_response(self, client_socket):
+        client_socket.sendall(f'HTTP/1.1 200 OK\r\nContent-Length: {SLOW_BODY_CHUNKS}\r\n\r\n'.encode())
+        for _ in range(SLOW_BODY_CHUNKS):
+            client_socket.sendall(b'x')
+            time.sleep(0.05)
+
+
+class StandInLoadBalancer:
+    """
+    The load balancer's end of a framed connection: sends the requests as frames,
+    and collects the frames of the responses by their streams.
+    """
+
+    def __init__(self, connection_socket):
+        self.connection_socket = connection_socket
+        self.connection_socket.settimeout(RECV_TIMEOUT)
+        self.frame_parser = FrameParser()
+        self.responses = {}     # Stream id -> the payload received so far
+        self.frame_counts = {}  # Stream id -> the amount of frames received
+        self.ended = {}         # Stream id -> 'END' or 'RESET'
+
+    def send_frame(self, stream_id, flags, payload=b''):
+        self.connection_socket.sendall(encode_frame_header(stream_id, ENDPOINT, flags, len(payload)) + payload)
+
+    def send_request(self, stream_id, request, frame_size=MAX_FRAME_PAYLOAD):
+        for offset in range(0, len(request), frame_size):
+            is_last = offset + frame_size >= len(request)
+            self.send_frame(stream_id, FLAG_END_STREAM if is_last else 0, request[offset:offset + frame_size])
+
+    def receive_until_ended(self, stream_ids):
+        """
+        Receives frames until all the given streams ended (with END_STREAM or RESET).
+        """
+        while not all(stream_id in self.ended for stream_id in stream_ids):
+            data = self.connection_socket.recv(65536)
+            if not data:
+                raise ConnectionError('The agent closed the connection')
+            self.frame_parser.feed(data)
+            frame = self.frame_parser.next_frame()
+            while frame is not None:
+                assert frame.endpoint == ENDPOINT, 'The response must be sent to the endpoint of the request'
+                assert frame.stream_id not in self.ended, f'Frame after the end of stream {frame.stream_id}'
+                self.responses.setdefault(frame.stream_id, bytearray()).extend(frame.payload)
+                self.frame_counts[frame.stream_id] = self.frame_counts.get(frame.stream_id, 0) + 1
+                if frame.reset:
+                    self.ended[frame.stream_id] = 'RESET'
+                elif frame.end_stream:
+                    self.ended[frame.stream_id] = 'END'
+                frame = self.frame_parser.next_frame()
+
+    def get_response_body(self, stream_id):
+        """
+        Parses the response of the given stream, and returns its body.
+        """
+        response = bytes(self.responses[stream_id])
+        parser = HttpResponseParser('GET')
+        consumed = parser.feed(response)
+        assert parser.complete and consumed == len(response), 'The stream must carry exactly one response'
+        assert parser.status_code == 200
+        return response[parser.head_size:]
+
+
+def build_request(path: str, body: bytes = b''):
+    head = f'GET {path} HTTP/1.1\r\nHost: example\r\n'
+    if body:
+        head += f'Content-Length: {len(body)}\r\n'
+    return (head + '\r\n').encode() + body
+
+
+class FramedConnectionTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.web_server = StandInWebServer()
+        cls.executor = ThreadPoolExecutor(max_workers=8)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.executor.shutdown(wait=True)
+        cls.web_server.close()
+        proxy_agent.backend_pool.close_all()
+
+    def setUp(self):
+        # The agent accepts the load balancer's connection on a loopback port
+        listen_socket = socket.create_server(('127.0.0.1', 0))
+        self.addCleanup(listen_socket.close)
+        self.load_balancer_socket = socket.create_connection(listen_socket.getsockname())
+        self.addCleanup(self.load_balancer_socket.close)
+        self.agent_socket, agent_address = listen_socket.accept()
+
+        self.jobs = []
+        self.agent_thread = threading.Thread(
+            target=proxy_agent.handle_proxy_connection,
+            args=(self.agent_socket, agent_address, self.web_server.port, 0, self.submit), daemon=True)
+        self.load_balancer = StandInLoadBalancer(self.load_balancer_socket)
+
+    def submit(self, function, *args):
+        # The workers of the agent (the jobs are kept to check that none of them failed)
+        self.jobs.append(self.executor.submit(function, *args))
+
+    def start_agent(self, preface=FRAME_PREFACE):
+        self.agent_thread.start()
+        self.load_balancer_socket.sendall(preface)
+
+    def wait_for_jobs(self):
+        for job in list(self.jobs):
+            self.assertIsNone(job.exception(timeout=RECV_TIMEOUT))
+
+    def test_preface_split_at_every_byte(self):
+        self.agent_thread.start()
+        for byte in FRAME_PREFACE:
+            self.load_balancer_socket.sendall(bytes([byte]))
+            time.sleep(0.001)
+        self.load_balancer.send_request(1, build_request('/index.html'))
+        self.load_balancer.receive_until_ended([1])
+        self.assertEqual(self.load_balancer.ended[1], 'END')
+        self.assertEqual(self.load_balancer.get_response_body(1), get_response_body('/index.html'))
+
+    def test_preface_with_first_frame(self):
+        # The preface and the first frames may arrive in the same read
+        self.agent_thread.start()
+        request = build_request('/first')
+        self.load_balancer_socket.sendall(FRAME_PREFACE + encode_frame_header(1, ENDPOINT, FLAG_END_STREAM,
+                                                                              len(request)) + request)
+        self.load_balancer.receive_until_ended([1])
+        self.assertEqual(self.load_balancer.get_response_body(1), get_response_body('/first'))
+
+    def test_interleaved_streams(self):
+        self.start_agent()
+        paths = {stream_id: f'/page{stream_id}' for stream_id in range(1, 20, 2)}
+        requests = {stream_id: build_request(path, body=b'b' * stream_id) for stream_id, path in paths.items()}
+
+        # Every request is sent in three frames, and the frames of all the streams are interleaved
+        for part in range(3):
+            for stream_id, request in requests.items():
+                part_size = len(request) // 3 + 1
+                payload = request[part * part_size:(part + 1) * part_size]
+                self.load_balancer.send_frame(stream_id, FLAG_END_STREAM if part == 2 else 0, payload)
+
+        self.load_balancer.receive_until_ended(list(requests))
+        for stream_id, path in paths.items():
+            self.assertEqual(self.load_balancer.ended[stream_id], 'END')
+            self.assertEqual(self.load_balancer.get_response_body(stream_id), get_response_body(path))
+        self.wait_for_jobs()
+
+    def test_multi_frame_response(self):
+        self.start_agent()
+        self.load_balancer.send_request(1, build_request('/big'))
+        self.load_balancer.send_request(3, build_request('/small'))
+        self.load_balancer.receive_until_ended([1, 3])
+        self.assertEqual(self.load_balancer.get_response_body(1), get_response_body('/big'))
+        self.assertEqual(self.load_balancer.get_response_body(3), get_response_body('/small'))
+        self.assertGreater(self.load_balancer.frame_counts[1], BIG_BODY_SIZE // MAX_FRAME_PAYLOAD)
+        self.wait_for_jobs()
+
+    def test_reset_on_invalid_request(self):
+        self.start_agent()
+        self.load_balancer.send_request(1, b'garbage\r\n\r\n')
+        self.load_balancer.send_request(3, build_request('/a') + build_request('/b'))   # Two requests in a stream
+        self.load_balancer.send_request(5, build_request('/valid'))
+        self.load_balancer.receive_until_ended([1, 3, 5])
+        self.assertEqual(self.load_balancer.ended[1], 'RESET')
+        self.assertEqual(self.load_balancer.ended[3], 'RESET')
+        self.assertEqual(self.load_balancer.responses.get(1, b''), b'')
+
+        # The connection still serves the other streams
+        self.assertEqual(self.load_balancer.ended[5], 'END')
+        self.assertEqual(self.load_balancer.get_response_body(5), get_response_body('/valid'))
+        self.wait_for_jobs()
+
+    def test_reset_on_oversized_request(self):
+        self.start_agent()
+        request = build_request('/upload', body=b'u' * proxy_agent.MAX_FRAMED_REQUEST_SIZE)
+        self.load_balancer.send_request(1, request, frame_size=MAX_FRAME_PAYLOAD // 4)
+        self.load_balancer.receive_until_ended([1])
+        self.assertEqual(self.load_balancer.ended[1], 'RESET')
+
+        # The rest of the oversized stream was ignored, and the connection still serves other streams
+        self.load_balancer.send_request(3, build_request('/after'))
+        self.load_balancer.receive_until_ended([3])
+        self.assertEqual(self.load_balancer.get_response_body(3), get_response_body('/after'))
+        self.wait_for_jobs()
+        self.assertEqual(len(self.jobs), 1)
+
+    def test_reset_by_load_balancer(self):
+        # A stream that the load balancer reset is never proxied
+        self.start_agent()
+        request = build_request('/never')
+        self.load_balancer.send_frame(1, 0, request[:10])
+        self.load_balancer.send_frame(1, FLAG_RESET)
+        self.load_balancer.send_request(3, build_request('/after'))
+        self.load_balancer.receive_until_ended([3])
+        self.assertNotIn(1, self.load_balancer.responses)
+        self.wait_for_jobs()
+        self.assertEqual(len(self.jobs), 1)
+
+    def test_connection_closed_while_sending(self):
+        self.start_agent()
+        self.load_balancer.send_request(1, build_request('/slow'))
+
+        # Wait for the beginning of the response, then close the connection in the middle of it
+        frame = None
+        while frame is None:
+            self.load_balancer.frame_parser.feed(self.load_balancer_socket.recv(65536))
+            frame = self.load_balancer.frame_parser.next_frame()
+        self.assertEqual(frame.stream_id, 1)
+        self.assertFalse(frame.end_stream or frame.reset)
+        self.load_balancer_socket.close()
+        close_time = time.monotonic()
+
+        # The agent closes its end of the connection
+        while self.agent_socket.fileno() != -1:
+            self.assertLess(time.monotonic() - close_time, RECV_TIMEOUT)
+            time.sleep(0.01)
+
+        # The worker stops relaying the response (long before the web server finished sending it),
+        # and gives up on the stream without failing
+        self.wait_for_jobs()
+        self.assertEqual(len(self.jobs), 1)
+        self.assertLess(time.monotonic() - close_time, SLOW_BODY_CHUNKS * 0.05 / 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
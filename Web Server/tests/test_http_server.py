@@ -0,0 +1,102 @@
+"""
+Tests of the HTTP server's keep-alive connections: every response must end exactly where the next one starts.
+A real client connection is served by serve_client() on a socket pair, with a temporary webroot.
+Run from the 'Web Server' folder: python -m pytest tests
+"""
+
+
+import logging
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'HTTP Server'))
+from http_parser import HttpResponseParser
+import http_server
+
+
+INDEX_BODY = b'<html>' + b'index ' * 1000 + b'</html>'
+PAGE_BODY = b'<html>page</html>'
+RECV_TIMEOUT = 5
+
+
+class KeepAliveTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.webroot_path = tempfile.mkdtemp()
+        with open(os.path.join(cls.webroot_path, 'index.html'), 'wb') as index_file:
+            index_file.write(INDEX_BODY)
+        with open(os.path.join(cls.webroot_path, 'page.html'), 'wb') as page_file:
+            page_file.write(PAGE_BODY)
+
+        cls.patched_settings = {name: getattr(http_server, name) for name in ('webroot_path', 'default_url', 'logger')}
+        http_server.webroot_path = os.path.join(cls.webroot_path, '')
+        http_server.default_url = http_server.webroot_path + 'index.html'
+        http_server.logger = logging.getLogger('http_server_test')
+
+    @classmethod
+    def tearDownClass(cls):
+        for name, value in cls.patched_settings.items():
+            setattr(http_server, name, value)
+        shutil.rmtree(cls.webroot_path)
+
+    def exchange(self, requests):
+        """
+        Sends the given (pipelined) requests on one connection, and returns everything that was received
+        until the server closed it.
+        """
+        client_socket, server_socket = socket.socketpair()
+        with client_socket:
+            serving_thread = threading.Thread(target=http_server.serve_client,
+                                              args=(server_socket, ('127.0.0.1', 0)), daemon=True)
+            serving_thread.start()
+            client_socket.settimeout(RECV_TIMEOUT)
+            client_socket.sendall(requests)
+
+            received = bytearray()
+            data = client_socket.recv(65536)
+            while data:
+                received += data
+                data = client_socket.recv(65536)
+        serving_thread.join(RECV_TIMEOUT)
+        return bytes(received)
+
+    def split_responses(self, data, methods):
+        """
+        Splits the received data into the responses of the requests of the given methods,
+        and returns their (status code, body). Fails if there's data after the last response.
+        """
+        responses = []
+        for method in methods:
+            parser = HttpResponseParser(method)
+            consumed = parser.feed(data)
+            self.assertTrue(parser.complete, f'The response to {method} is incomplete')
+            responses.append((parser.status_code, data[parser.head_size:consumed]))
+            data = data[consumed:]
+        self.assertEqual(data, b'', 'Data after the last response')
+        return responses
+
+    def test_head_root_then_request(self):
+        data = self.exchange(b'HEAD / HTTP/1.1\r\nHost: test\r\n\r\n'
+                             b'HEAD /index.html HTTP/1.1\r\nHost: test\r\n\r\n'
+                             b'GET /page.html HTTP/1.1\r\nHost: test\r\nConnection: close\r\n\r\n')
+        responses = self.split_responses(data, ['HEAD', 'HEAD', 'GET'])
+        self.assertEqual(responses, [(200, b''), (200, b''), (200, PAGE_BODY)])
+
+        # The HEAD response describes the body that GET would've sent
+        self.assertIn(f'Content-Length: {len(INDEX_BODY)}'.encode(), data.split(b'\r\n\r\n', 1)[0])
+
+    def test_get_root_then_request(self):
+        data = self.exchange(b'GET / HTTP/1.1\r\nHost: test\r\n\r\n'
+                             b'GET /page.html HTTP/1.1\r\nHost: test\r\nConnection: close\r\n\r\n')
+        self.assertEqual(self.split_responses(data, ['GET', 'GET']), [(200, INDEX_BODY), (200, PAGE_BODY)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+"""
+Conformance tests of the frame parser of the framed proxy protocol (see proxy_protocol.py).
+Run from the 'Web Server' folder: python -m pytest tests
+"""
+
+
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from proxy_protocol import FRAME_HEADER, FRAME_HEADER_SIZE, MAX_FRAME_PAYLOAD, PROTOCOL_VERSION, \
+    FLAG_END_STREAM, FLAG_RESET, FrameParser, ProtocolError, encode_frame_header
+
+
+ENDPOINT = bytes([127, 0, 0, 1, 0x1f, 0x90])
+
+# (stream id, flags, payload) of the frames that are sent in the tests
+FRAMES = [
+    (1, 0, b'GET /index.html HTTP/1.1\r\n'),
+    (3, FLAG_END_STREAM, b'GET / HTTP/1.1\r\n\r\n'),
+    (1, FLAG_END_STREAM, b'Host: example\r\n\r\n'),
+    (5, FLAG_RESET, b''),
+    (7, FLAG_END_STREAM, bytes(range(256)) * 8),
+]
+
+
+def encode_frames(frames):
+    return b''.join(encode_frame_header(stream_id, ENDPOINT, flags, len(payload)) + payload
+                    for stream_id, flags, payload in frames)
+
+
+def read_frames(parser):
+    """
+    Returns the (stream id, flags, payload) of every complete frame in the parser.
+    """
+    frames = []
+    frame = parser.next_frame()
+    while frame is not None:
+        assert frame.endpoint == ENDPOINT
+        frames.append((frame.stream_id, frame.flags, frame.payload))
+        frame = parser.next_frame()
+    return frames
+
+
+class FrameParserTest(unittest.TestCase):
+
+    def test_frames_in_one_read(self):
+        parser = FrameParser()
+        parser.feed(encode_frames(FRAMES))
+        self.assertEqual(read_frames(parser), FRAMES)
+        self.assertIsNone(parser.next_frame())
+
+    def test_split_at_every_byte(self):
+        data = encode_frames(FRAMES)
+        for split in range(len(data) + 1):
+            parser = FrameParser()
+            parser.feed(data[:split])
+            frames = read_frames(parser)
+            parser.feed(data[split:])
+            frames += read_frames(parser)
+            self.assertEqual(frames, FRAMES, f'split at byte {split}')
+
+    def test_byte_by_byte(self):
+        parser = FrameParser()
+        frames = []
+        for byte in encode_frames(FRAMES):
+            parser.feed(bytes([byte]))
+            frames += read_frames(parser)
+        self.assertEqual(frames, FRAMES)
+
+    def test_frame_flags(self):
+        parser = FrameParser()
+        parser.feed(encode_frames(FRAMES))
+        flags = []
+        frame = parser.next_frame()
+        while frame is not None:
+            flags.append((frame.end_stream, frame.reset))
+            frame = parser.next_frame()
+        self.assertEqual(flags, [(False, False), (True, False), (True, False), (False, True), (True, False)])
+
+    def test_empty_payload(self):
+        parser = FrameParser()
+        parser.feed(encode_frame_header(9, ENDPOINT, FLAG_END_STREAM, 0))
+        self.assertEqual(read_frames(parser), [(9, FLAG_END_STREAM, b'')])
+
+    def test_max_payload(self):
+        payload = b'x' * MAX_FRAME_PAYLOAD
+        parser = FrameParser()
+        parser.feed(encode_frame_header(1, ENDPOINT, FLAG_END_STREAM, len(payload)) + payload)
+        self.assertEqual(read_frames(parser), [(1, FLAG_END_STREAM, payload)])
+
+    def test_wrong_version(self):
+        parser = FrameParser()
+        parser.feed(FRAME_HEADER.pack(PROTOCOL_VERSION + 1, 0, 1, ENDPOINT, 4) + b'data')
+        with self.assertRaises(ProtocolError):
+            parser.next_frame()
+
+    def test_wrong_version_after_valid_frames(self):
+        parser = FrameParser()
+        parser.feed(encode_frames(FRAMES[:2]) + FRAME_HEADER.pack(0, 0, 1, ENDPOINT, 0))
+        self.assertEqual(parser.next_frame().stream_id, 1)
+        self.assertEqual(parser.next_frame().stream_id, 3)
+        with self.assertRaises(ProtocolError):
+            parser.next_frame()
+
+    def test_oversized_length(self):
+        # The frame is rejected by its header, before its payload arrives
+        parser = FrameParser()
+        parser.feed(FRAME_HEADER.pack(PROTOCOL_VERSION, 0, 1, ENDPOINT, MAX_FRAME_PAYLOAD + 1))
+        with self.assertRaises(ProtocolError):
+            parser.next_frame()
+
+    def test_oversized_length_of_smaller_limit(self):
+        parser = FrameParser(max_payload=16)
+        parser.feed(encode_frame_header(1, ENDPOINT, 0, 17) + b'x' * 17)
+        with self.assertRaises(ProtocolError):
+            parser.next_frame()
+
+    def test_encode_oversized_payload(self):
+        with self.assertRaises(ProtocolError):
+            encode_frame_header(1, ENDPOINT, 0, MAX_FRAME_PAYLOAD + 1)
+
+    def test_incomplete_header(self):
+        parser = FrameParser()
+        parser.feed(encode_frames(FRAMES[:1])[:FRAME_HEADER_SIZE - 1])
+        self.assertIsNone(parser.next_frame())
+
+    def test_header_layout(self):
+        # |-VERSION-|-FLAGS-|-STREAM ID-|---ENDPOINT---|-LENGTH-| in network order
+        header = encode_frame_header(0x01020304, ENDPOINT, FLAG_END_STREAM, 0x1234)
+        self.assertEqual(header, bytes([PROTOCOL_VERSION, FLAG_END_STREAM, 1, 2, 3, 4]) + ENDPOINT +
+                         bytes([0, 0, 0x12, 0x34]))
+        self.assertEqual(FRAME_HEADER_SIZE, 16)
+
+
+if __name__ == '__main__':
+    unittest.main()